@@ -0,0 +1,221 @@
+"""
+Микробенчмарки слоя доступа к данным (src/database/requests.py) на SQLite и Redis без сети.
+
+По умолчанию используется временный файл SQLite через aiosqlite и fakeredis в памяти
+(pip install "fakeredis[lua]"), с флагом --redis-url можно взять локальный Redis.
+Результаты сохраняются в JSON, чтобы сравнивать их между коммитами.
+
+Запуск из папки app:
+    python -m benchmarks.data_access --iterations 2000 --output bench.json
+    python -m benchmarks.data_access --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+def setup_environment(db_path: str, redis_url: Optional[str]) -> None:
+    """
+    Настраивает БД и Redis до импорта src: движок и клиент Redis создаются при импорте модулей
+    """
+    os.environ['DB_URL'] = f'sqlite+aiosqlite:///{db_path}'
+    os.environ['DB_ECHO'] = 'false'
+
+    import src.database.redis_connection as redis_connection
+    if redis_url:
+        from redis.asyncio import Redis
+        redis_connection.redis = Redis.from_url(redis_url)
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit('Для запуска без Redis установите fakeredis: pip install "fakeredis[lua]"')
+        redis_connection.redis = fakeredis.FakeAsyncRedis()
+
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    ordered = sorted(durations)
+
+    def percentile(percent: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+    total = sum(ordered)
+    return {
+        'n': len(ordered),
+        'ops_per_sec': len(ordered) / total if total else 0.0,
+        'mean_ms': total / len(ordered) * 1000,
+        'p50_ms': percentile(50) * 1000,
+        'p95_ms': percentile(95) * 1000,
+        'p99_ms': percentile(99) * 1000,
+        'min_ms': ordered[0] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+async def measure(iterations: int, operation: Callable[[int], Awaitable],
+                  prepare: Optional[Callable[[int], Awaitable]] = None) -> Dict[str, float]:
+    """
+    Выполняет operation iterations раз подряд, prepare (например сброс кеша) в замер не входит
+    """
+    durations = []
+    for index in range(iterations):
+        if prepare:
+            await prepare(index)
+        started = time.perf_counter()
+        await operation(index)
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+
+async def seed(categories: int, products: int, users: int, cart_items: int) -> Dict[str, list]:
+    """
+    Заполняет каталог и корзины напрямую через SQL, кеши после этого пустые
+    """
+    from sqlalchemy import select
+
+    from src.database.engine import session_maker, upgrade_db
+    from src.database.models import Category, Product, Cart
+
+    await upgrade_db()
+    async with session_maker() as session:
+        session.add_all(Category(name=f'Категория {index}') for index in range(categories))
+        await session.flush()
+        category_ids = list(await session.scalars(select(Category.id)))
+
+        session.add_all(
+            Product(name=f'Товар {category_id}-{index}', description='Описание товара для бенчмарка',
+                    price=random.randint(300, 900), category_id=category_id, photo_path='images/bench.jpg')
+            for category_id in category_ids for index in range(products)
+        )
+        await session.flush()
+        product_ids = list(await session.scalars(select(Product.id)))
+
+        user_ids = list(range(1, users + 1))
+        session.add_all(
+            Cart(user_id=user_id, product_id=product_id, quantity=random.randint(1, 3))
+            for user_id in user_ids for product_id in random.sample(product_ids, k=min(cart_items, len(product_ids)))
+        )
+        await session.commit()
+    return {'categories': category_ids, 'products': product_ids, 'users': user_ids}
+
+
+async def run(args: argparse.Namespace) -> Dict[str, dict]:
+    from src.database import requests
+    from src.database.cache import invalidate
+    from src.database.redis_connection import redis
+
+    ids = await seed(args.categories, args.products, args.users, args.cart_items)
+    await redis.flushdb()
+    n = args.iterations
+
+    def pick(key: str) -> Callable[[int], int]:
+        return lambda index: ids[key][index % len(ids[key])]
+
+    category, product, user = pick('categories'), pick('products'), pick('users')
+
+    async def drop_cart(index: int) -> None:
+        await redis.delete(f'cart:{user(index)}')
+
+    benchmarks = {
+        'get_categories[cold]': (lambda i: requests.get_categories(),
+                                 lambda i: invalidate(requests.get_categories.key())),
+        'get_categories[warm]': (lambda i: requests.get_categories(), None),
+        'get_products[cold]': (lambda i: requests.get_products(category(i)),
+                               lambda i: invalidate(requests.get_products.key(category(i)))),
+        'get_products[warm]': (lambda i: requests.get_products(category(i)), None),
+        'get_product[cold]': (lambda i: requests.get_product(product(i)),
+                              lambda i: invalidate(requests.get_product.key(product(i)))),
+        'get_product[warm]': (lambda i: requests.get_product(product(i)), None),
+        'get_cart_product[cold]': (lambda i: requests.get_cart_product(user(i)), drop_cart),
+        'get_cart_product[warm]': (lambda i: requests.get_cart_product(user(i)), None),
+        'add_product_to_cart': (lambda i: requests.add_product_to_cart(user(i), product(i * 7)), None),
+        'get_cart_summary': (lambda i: requests.get_cart_summary(user(i)), None),
+        'flush_carts': (lambda i: requests.flush_carts(), lambda i: requests.add_product_to_cart(user(i), product(i))),
+    }
+
+    results = {}
+    for name, (operation, prepare) in benchmarks.items():
+        if args.only and not any(part in name for part in args.only):
+            continue
+        if prepare is None:
+            # Теплые замеры: сначала один непосчитанный проход, чтобы все ключи попали в кеш
+            for index in range(n):
+                await operation(index)
+        results[name] = await measure(n, operation, prepare)
+        print(format_row(name, results[name]), flush=True)
+    return results
+
+
+def format_row(name: str, result: Dict[str, float], previous: Optional[Dict[str, float]] = None) -> str:
+    row = (f'{name:<26}{result["ops_per_sec"]:>12.0f}{result["p50_ms"]:>10.3f}'
+           f'{result["p95_ms"]:>10.3f}{result["p99_ms"]:>10.3f}{result["max_ms"]:>10.3f}')
+    if previous:
+        change = (result['ops_per_sec'] / previous['ops_per_sec'] - 1) * 100 if previous['ops_per_sec'] else 0
+        row += f'{change:>+10.1f}%'
+    return row
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Микробенчмарки src/database/requests.py')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--products', type=int, default=50, help='товаров в каждой категории')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--cart-items', type=int, default=5, help='позиций в корзине каждого пользователя')
+    parser.add_argument('--redis-url', help='локальный Redis вместо fakeredis (база будет очищена!)')
+    parser.add_argument('--only', nargs='*', help='запустить только бенчмарки, в имени которых есть подстрока')
+    parser.add_argument('--output', help='куда сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON с предыдущими результатами для сравнения')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    previous = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)['results']
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup_environment(os.path.join(directory, 'bench.sqlite'), args.redis_url)
+        print(f'{"бенчмарк":<26}{"ops/s":>12}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}{"max, мс":>10}')
+        results = asyncio.run(run(args))
+
+    if previous:
+        print('\nСравнение с', args.compare)
+        for name, result in results.items():
+            print(format_row(name, result, previous.get(name)))
+
+    if args.output:
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            },
+            'results': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'\nРезультаты сохранены в {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Время импорта модулей при запуске бота (python -X importtime): запускает интерпретатор в отдельном процессе,
+разбирает его отчет и печатает общее время импорта и самые медленные модули.
+Несколько повторов нужны, чтобы отсеять холодный кеш файловой системы и компиляцию .pyc.
+
+Запуск из папки app:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --module src.handlers.admin --top 30
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module: str) -> List[Tuple[str, int, int]]:
+    """
+    Один запуск: [(модуль, собственное время, время с вложенными импортами)] в микросекундах
+    """
+    # Движок БД создается при импорте, но не подключается: без .env хватит SQLite в памяти
+    env = {'DB_URL': 'sqlite+aiosqlite://', **os.environ}
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               cwd=APP_DIR, env=env, capture_output=True, text=True)
+    if completed.returncode:
+        sys.exit(f'Не удалось импортировать {module}:\n{completed.stderr[-2000:]}')
+
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Время импорта модулей бота (-X importtime)')
+    parser.add_argument('--module', default='main', help='модуль, импорт которого замеряется')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    # Минимум по повторам для каждого модуля: шум бывает только в большую сторону
+    best: Dict[str, Tuple[int, int]] = {}
+    totals = []
+    for _ in range(args.repeat):
+        rows = measure(args.module)
+        totals.append(sum(self_us for _, self_us, _ in rows))
+        for name, self_us, cumulative_us in rows:
+            previous = best.get(name)
+            best[name] = (self_us, cumulative_us) if previous is None else \
+                (min(previous[0], self_us), min(previous[1], cumulative_us))
+
+    print(f'Импорт {args.module}: {min(totals) / 1000:.1f} мс (лучший из {args.repeat}), модулей {len(best)}\n')
+    print(f'{"модуль":<60}{"свое, мс":>10}{"всего, мс":>12}')
+    for name, (self_us, cumulative_us) in sorted(best.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f'{name:<60}{self_us / 1000:>10.1f}{cumulative_us / 1000:>12.1f}')
+
+    heavy = [name for name in best if name.split('.')[0] in ('PIL', 'alembic')]
+    if heavy:
+        print(f'\nИмпортируются модули, нужные только администраторам или миграциям: {", ".join(sorted(heavy))}')
+
+
+if __name__ == '__main__':
+    main()
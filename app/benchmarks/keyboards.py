@@ -0,0 +1,106 @@
+"""
+Микробенчмарк клавиатур: сборка разметки на каждый апдейт (как раньше) против готовых клавиатур
+из keyboard_builder (постоянные - при импорте, каталожные - из кеша по версии каталога).
+Показывает время CPU и объем выделенной памяти на одну клавиатуру.
+
+Запуск из папки app:
+    python -m benchmarks.keyboards --iterations 20000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict
+
+from .data_access import setup_environment, seed
+
+
+async def cpu_per_call(operation: Callable[[int], Awaitable], iterations: int) -> float:
+    started = time.process_time()
+    for index in range(iterations):
+        await operation(index)
+    return (time.process_time() - started) / iterations
+
+
+async def allocated_per_call(operation: Callable[[int], Awaitable], iterations: int) -> float:
+    """
+    Средний пик выделенной памяти за один вызов (байты сверх уже занятой памяти)
+    """
+    tracemalloc.start()
+    total = 0
+    for index in range(iterations):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        await operation(index)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / iterations
+
+
+async def run(args: argparse.Namespace) -> None:
+    from src.database.requests import get_categories, get_products
+    from src.utils import keyboard_builder as kb
+
+    ids = await seed(args.categories, args.products, users=1, cart_items=0)
+    category_ids = ids['categories']
+
+    def category(index: int) -> int:
+        return category_ids[index % len(category_ids)]
+
+    async def rebuild_static(index: int):
+        return kb.get_inline_buttons(btns={"На главную 🔙": 'to main'})
+
+    async def registry_static(index: int):
+        return kb.TO_MAIN
+
+    async def rebuild_categories(index: int):
+        return kb.get_inline_buttons(btns={c['name']: f'category_{c["id"]}' for c in await get_categories()})
+
+    async def cached_categories(index: int):
+        return await kb.get_categories_keyboard('category_')
+
+    async def rebuild_pagination(index: int):
+        return kb.build_products_pagination(await get_products(category(index)), index % args.products)
+
+    async def cached_pagination(index: int):
+        return await kb.get_products_pagination(category(index), index % args.products)
+
+    cases: Dict[str, tuple] = {
+        'на главную': (rebuild_static, registry_static),
+        'список категорий': (rebuild_categories, cached_categories),
+        'листание товаров': (rebuild_pagination, cached_pagination),
+    }
+
+    print(f'{"клавиатура":<20}{"сборка, мкс":>14}{"кеш, мкс":>12}{"x":>8}{"сборка, Б":>12}{"кеш, Б":>10}')
+    for name, (rebuild, cached) in cases.items():
+        # Прогрев: кеши каталога и клавиатур заполняются до замеров
+        for index in range(len(category_ids) * args.products):
+            await rebuild(index)
+            await cached(index)
+
+        rebuild_cpu = await cpu_per_call(rebuild, args.iterations)
+        cached_cpu = await cpu_per_call(cached, args.iterations)
+        rebuild_memory = await allocated_per_call(rebuild, args.iterations // 10 or 1)
+        cached_memory = await allocated_per_call(cached, args.iterations // 10 or 1)
+        print(f'{name:<20}{rebuild_cpu * 1e6:>14.2f}{cached_cpu * 1e6:>12.2f}'
+              f'{rebuild_cpu / cached_cpu if cached_cpu else 0:>8.1f}'
+              f'{rebuild_memory:>12.0f}{cached_memory:>10.0f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Микробенчмарк клавиатур keyboard_builder')
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--categories', type=int, default=8)
+    parser.add_argument('--products', type=int, default=20, help='товаров в каждой категории')
+    parser.add_argument('--redis-url', help='локальный Redis вместо fakeredis (база будет очищена!)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup_environment(os.path.join(directory, 'bench.sqlite'), args.redis_url)
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """
+    Локальная замена Bot API: отвечает на запросы бота правдоподобными объектами,
+    отдает синтетические апдейты через getUpdates и считает вызовы методов.
+
+    latency - задержка каждого ответа в секундах (плюс случайный разброс до jitter),
+    rate_limit_ratio - доля запросов, на которые отвечаем 429 с retry_after
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8081, latency: float = 0, jitter: float = 0,
+                 rate_limit_ratio: float = 0, retry_after: int = 1) -> None:
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def push_updates(self, updates: List[Dict[str, Any]]) -> None:
+        for update in updates:
+            self.updates.put_nowait(update)
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=self.host, port=self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(await request.post())
+
+        if method.lower() != 'getupdates':
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+            if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+                self.rate_limited[method] += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after}
+                }, status=429)
+
+        result = await self.respond(method, params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def respond(self, method: str, params: Dict[str, Any]) -> Any:
+        lowered = method.lower()
+        if lowered == 'getupdates':
+            return await self._get_updates(params)
+        if lowered == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if lowered.startswith(('send', 'edit')):
+            return self._message(params, with_photo=lowered in ('sendphoto', 'editmessagemedia'))
+        return True
+
+    async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        batch = []
+        if self.updates.empty() and timeout:
+            try:
+                batch.append(await asyncio.wait_for(self.updates.get(), timeout=min(timeout, 1)))
+            except asyncio.TimeoutError:
+                return []
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    def _message(self, params: Dict[str, Any], with_photo: bool = False) -> Dict[str, Any]:
+        message_id = next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id') or 1), 'type': 'private'},
+            'text': params.get('text') or '',
+        }
+        if with_photo:
+            message['photo'] = [{'file_id': f'fake-file-{message_id}', 'file_unique_id': f'fake-{message_id}',
+                                 'width': 1, 'height': 1}]
+        return message
+
+
+def make_message_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """
+    Синтетический апдейт с текстовым сообщением от пользователя
+    """
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'},
+            'text': text,
+        }
+    }
+
+
+def make_callback_update(update_id: int, user_id: int, data: str) -> Dict[str, Any]:
+    """
+    Синтетический апдейт с нажатием inline-кнопки
+    """
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': user,
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'FakeBot'},
+                'text': '...',
+            },
+        }
+    }
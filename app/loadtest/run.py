@@ -0,0 +1,173 @@
+"""
+Нагрузочный прогон настоящего Dispatcher (роутеры user и admin) без Telegram.
+
+Бот ходит в локальную замену Bot API (loadtest.fake_api) с настраиваемой задержкой и долей 429,
+виртуальные пользователи проходят типичные сценарии (loadtest.scenarios), а в конце печатается
+пропускная способность, перцентили задержки по шагам и количество вызовов Bot API на один сценарий.
+Бот создается так же, как в main.py, поэтому в задержки входит ожидание в планировщике запросов к Bot API.
+Нужны БД из DB_URL и Redis, как и для самого бота.
+
+Запуск из папки app:
+    python -m loadtest.run --seed --users 2000 --concurrency 200 --api-latency 0.03 --rate-limit 0.01
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from .fake_api import FakeBotAPI
+from .scenarios import user_journey
+
+TOKEN = '123456:fake-token-for-local-benchmarks'
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def seed_catalog(categories: int, products_per_category: int) -> None:
+    """
+    Создает тестовые категории и товары, если каталог пуст
+    """
+    from src.database.requests import get_categories, create_categorie, get_categorie_id, create_product
+
+    if await get_categories():
+        return
+
+    from io import BytesIO
+    from PIL import Image
+    from src.utils.storage import storage
+
+    # Фотография создается на лету и кладется в хранилище бота, как загруженная администратором
+    photo = BytesIO()
+    Image.new('RGB', (64, 64), (200, 60, 30)).save(photo, 'JPEG')
+    photo_path = await storage.save(photo.getvalue(), 'jpg')
+
+    for category_index in range(categories):
+        name = f'Нагрузка {category_index}'
+        await create_categorie(name)
+        category_id = await get_categorie_id(name)
+        for product_index in range(products_per_category):
+            await create_product(f'Пицца {category_index}-{product_index}', 'Тестовый товар',
+                                 random.randint(300, 900), category_id, photo_path)
+
+
+async def load_catalog() -> Dict[int, List[int]]:
+    from src.database.requests import get_categories, get_products
+
+    return {category['id']: [product['id'] for product in await get_products(category['id'])]
+            for category in await get_categories()}
+
+
+class LoadTest:
+    def __init__(self, bot: Bot, dp: Dispatcher, catalog: Dict[int, List[int]], think_time: float) -> None:
+        self.bot = bot
+        self.dp = dp
+        self.catalog = catalog
+        self.think_time = think_time
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.updates = 0
+
+    async def journey(self, user_id: int) -> None:
+        for step, update in user_journey(user_id, self.catalog):
+            started = time.perf_counter()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception as e:
+                self.errors[f'{step}: {type(e).__name__}'] += 1
+            self.latencies[step].append(time.perf_counter() - started)
+            self.updates += 1
+            if self.think_time:
+                await asyncio.sleep(random.uniform(0, self.think_time))
+
+    async def run(self, users: int, concurrency: int, first_user_id: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(user_id: int) -> None:
+            async with semaphore:
+                await self.journey(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(first_user_id + index) for index in range(users)))
+        return time.perf_counter() - started
+
+
+def print_report(test: LoadTest, api: FakeBotAPI, users: int, elapsed: float) -> None:
+    print(f'\nСценариев: {users}, апдейтов: {test.updates}, время: {elapsed:.2f} с')
+    print(f'Пропускная способность: {test.updates / elapsed:.0f} upd/s, {users / elapsed:.1f} сценариев/с\n')
+
+    print(f'{"шаг":<16}{"кол-во":>8}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}{"max, мс":>10}')
+    for step, values in test.latencies.items():
+        print(f'{step:<16}{len(values):>8}'
+              f'{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}'
+              f'{percentile(values, 99) * 1000:>10.1f}{max(values) * 1000:>10.1f}')
+
+    print('\nВызовы Bot API на один сценарий:')
+    for method, count in api.calls.most_common():
+        limited = f' (429: {api.rate_limited[method]})' if api.rate_limited[method] else ''
+        print(f'  {method:<24}{count / users:>8.2f}{limited}')
+
+    if test.errors:
+        print('\nОшибки:')
+        for error, count in test.errors.most_common():
+            print(f'  {error}: {count}')
+
+
+async def main(args: argparse.Namespace) -> None:
+    from main import create_bot, create_dispatcher
+
+    api = FakeBotAPI(port=args.api_port, latency=args.api_latency, jitter=args.api_jitter,
+                     rate_limit_ratio=args.rate_limit, retry_after=args.retry_after)
+    await api.start()
+
+    # Тот же бот, что в main.py: с планировщиком запросов и таймингами, отличается только адрес Bot API
+    bot = create_bot(TOKEN, AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+    dp = create_dispatcher()
+    await dp.emit_startup(bot=bot)
+
+    try:
+        if args.seed:
+            await seed_catalog(args.categories, args.products)
+        catalog = await load_catalog()
+        if not catalog:
+            raise SystemExit('Каталог пуст, запустите с --seed')
+
+        test = LoadTest(bot, dp, catalog, args.think_time)
+        elapsed = await test.run(args.users, args.concurrency, args.first_user_id)
+        print_report(test, api, args.users, elapsed)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        await api.stop()
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота на локальной замене Bot API')
+    parser.add_argument('--users', type=int, default=500, help='сколько сценариев пройти')
+    parser.add_argument('--concurrency', type=int, default=100, help='сколько пользователей одновременно')
+    parser.add_argument('--think-time', type=float, default=0, help='пауза между шагами, до N секунд')
+    parser.add_argument('--first-user-id', type=int, default=1_000_000)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа Bot API, с')
+    parser.add_argument('--api-jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', action='store_true', help='создать тестовый каталог, если он пуст')
+    parser.add_argument('--categories', type=int, default=5)
+    parser.add_argument('--products', type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    cli()
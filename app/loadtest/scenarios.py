@@ -0,0 +1,39 @@
+import itertools
+import random
+from typing import Dict, Iterator, List, Tuple
+
+from .fake_api import make_message_update, make_callback_update
+
+_update_ids = itertools.count(1)
+
+
+def user_journey(user_id: int, catalog: Dict[int, List[int]], max_pages: int = 3,
+                 checkout_ratio: float = 0.3) -> Iterator[Tuple[str, dict]]:
+    """
+    Генерирует шаги типичного пути пользователя: (название шага, апдейт).
+    /start -> меню -> категория -> листание -> в корзину -> корзина -> (иногда) оформление заказа.
+    catalog - {category_id: [product_id, ...]}
+    """
+    yield 'start', make_message_update(next(_update_ids), user_id, '/start')
+    yield 'menu', make_callback_update(next(_update_ids), user_id, 'menu')
+
+    category_id = random.choice(list(catalog))
+    products = catalog[category_id]
+    yield 'category', make_callback_update(next(_update_ids), user_id, f'category_{category_id}')
+
+    pages = random.randint(0, min(max_pages, len(products) - 1)) if products else 0
+    for page in range(1, pages + 1):
+        yield 'page', make_callback_update(next(_update_ids), user_id, f'page:{page}')
+
+    if not products:
+        return
+
+    for product_id in random.sample(products, k=random.randint(1, min(3, len(products)))):
+        yield 'add_to_cart', make_callback_update(next(_update_ids), user_id, f'product_{product_id}')
+
+    yield 'cart', make_callback_update(next(_update_ids), user_id, 'cart')
+
+    if random.random() < checkout_ratio:
+        for step, data in (('go_to_pay', 'go to pay'), ('pickup', 'pickup'),
+                           ('payment_method', 'online card'), ('checkout', 'confirm order')):
+            yield step, make_callback_update(next(_update_ids), user_id, data)
@@ -0,0 +1,157 @@
+"""
+Сравнение пропускной способности long polling и вебхука без выхода в сеть.
+
+Запуск из папки app:
+    python -m loadtest.transport_bench --mode polling --updates 5000
+    python -m loadtest.transport_bench --mode webhook --updates 5000 --concurrency 200
+
+С флагом --bare вместо настоящих роутеров используется простой эхо-роутер,
+которому не нужны БД и Redis, и измеряется только накладной расход транспорта.
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+import aiohttp
+from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message, CallbackQuery, TelegramObject
+
+from .fake_api import FakeBotAPI, make_message_update, make_callback_update
+
+TOKEN = '123456:fake-token-for-local-benchmarks'
+SECRET = 'local-bench-secret'
+
+
+class ProcessedCounter:
+    """
+    Outer-middleware, которая считает полностью обработанные апдейты
+    """
+
+    def __init__(self, expected: int) -> None:
+        self.expected = expected
+        self.processed = 0
+        self.done = asyncio.Event()
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            self.processed += 1
+            if self.processed >= self.expected:
+                self.done.set()
+
+
+def bare_dispatcher() -> Dispatcher:
+    router = Router()
+
+    @router.message(F.text)
+    async def _(message: Message):
+        await message.answer('ok')
+
+    @router.callback_query()
+    async def _(callback: CallbackQuery):
+        await callback.answer()
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+def synthetic_updates(count: int, users: int) -> list:
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = 10_000 + update_id % users
+        if update_id % 2:
+            updates.append(make_message_update(update_id, user_id, '/start'))
+        else:
+            updates.append(make_callback_update(update_id, user_id, 'menu'))
+    return updates
+
+
+async def run_polling(bot: Bot, dp: Dispatcher, api: FakeBotAPI, updates: list, counter: ProcessedCounter) -> None:
+    api.push_updates(updates)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    await counter.done.wait()
+    await dp.stop_polling()
+    await polling
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, updates: list, counter: ProcessedCounter,
+                      port: int, concurrency: int) -> float:
+    from aiohttp import web
+    from src.webhook import build_webhook_app, WEBHOOK_PATH
+
+    runner = web.AppRunner(build_webhook_app(bot, dp, secret_token=SECRET), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host='127.0.0.1', port=port).start()
+
+    url = f'http://127.0.0.1:{port}{WEBHOOK_PATH}'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+    semaphore = asyncio.Semaphore(concurrency)
+    ack_started = time.perf_counter()
+
+    async with aiohttp.ClientSession() as client:
+        async def post(update: dict) -> None:
+            async with semaphore:
+                async with client.post(url, json=update, headers=headers) as response:
+                    response.raise_for_status()
+
+        await asyncio.gather(*(post(update) for update in updates))
+    ack_time = time.perf_counter() - ack_started
+
+    await counter.done.wait()
+    await runner.cleanup()
+    return ack_time
+
+
+async def bench(args: argparse.Namespace) -> None:
+    api = FakeBotAPI(port=args.api_port)
+    await api.start()
+
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+    if args.bare:
+        dp = bare_dispatcher()
+    else:
+        from main import create_dispatcher
+        dp = create_dispatcher()
+
+    updates = synthetic_updates(args.updates, args.users)
+    counter = ProcessedCounter(len(updates))
+    dp.update.outer_middleware(counter)
+
+    started = time.perf_counter()
+    ack_time = None
+    if args.mode == 'polling':
+        await run_polling(bot, dp, api, updates, counter)
+    else:
+        ack_time = await run_webhook(bot, dp, updates, counter, args.webhook_port, args.concurrency)
+    elapsed = time.perf_counter() - started
+
+    await bot.session.close()
+    await api.stop()
+
+    print(f'Режим: {args.mode}{" (bare)" if args.bare else ""}')
+    print(f'Апдейтов обработано: {counter.processed} за {elapsed:.2f} с ({counter.processed / elapsed:.0f} upd/s)')
+    if ack_time is not None:
+        print(f'Все POST подтверждены за {ack_time:.2f} с ({len(updates) / ack_time:.0f} req/s)')
+    print(f'Вызовы Bot API: {dict(api.calls)}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Сравнение polling и webhook на синтетических апдейтах')
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8082)
+    parser.add_argument('--bare', action='store_true')
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,218 @@
 import asyncio
+import multiprocessing
 import os
+from typing import Optional
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.redis import RedisStorage
 
 from dotenv import load_dotenv
-from app.src.database.redis_connection import redis
 
 from src.handlers.admin import admin
 from src.handlers.user import user
-from src.database.engine import create_db
-from src.utils.middlewares import UserMiddleware, ThrottlingMiddleware
+from src.database.engine import upgrade_db
+from src.database.requests import (cart_flusher, flush_carts, registration_flusher, flush_registrations,
+                                   storage_gc)
+from src.database.cache import invalidation_listener
+from src.utils.middlewares import (UserMiddleware, ThrottlingMiddleware, InstrumentationMiddleware,
+                                   BotAPITimingMiddleware, BotAPISchedulerMiddleware)
+from src.utils.fsm import create_storage, migrate_fsm_states
+from src.utils.images import shutdown_executor
+from src.utils.outbox import outbox_worker
+from src.utils.broadcast import resume_broadcasts, cancel_broadcast_tasks
+from src.utils.scheduler import BOT_API_GLOBAL_RATE, create_scheduler
+from src.utils.warmup import CACHE_WARMUP, warm_up_caches
+from src.utils.metrics import METRICS_HOST, METRICS_PORT, start_metrics_server
+from src.webhook import WEBHOOK_WORKERS, set_webhook, serve_webhook
+from src.streams import (STREAM_WORKERS, STREAM_RECEIVER, STREAM_ROLE, receive_polling, receive_webhook,
+                         run_stream_worker)
 
 load_dotenv()
 
 os.makedirs('images', exist_ok=True)
 
+# polling, webhook или streams (приемник апдейтов и воркеры через Redis Streams)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Применять миграции при запуске. В быстром запуске (false) схему заранее обновляет шаг деплоя: alembic upgrade head
+RUN_MIGRATIONS = os.getenv('RUN_MIGRATIONS', 'true').lower() in ('1', 'true', 'yes')
 
-async def main():
-    bot = Bot(token=os.getenv('TOKEN'), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher(storage=RedisStorage(redis=redis))
+background_tasks = set()
+background_runners = []
+
+
+def create_bot(token: Optional[str] = None, session: Optional[BaseSession] = None) -> Bot:
+    """
+    Бот с планировщиком и таймингами запросов к Bot API. session - своя сессия (например, к замене Bot API)
+    """
+    bot = Bot(token=token or os.getenv('TOKEN'), session=session,
+              default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Планировщик внешний, поэтому в таймингах только сами запросы, без ожидания в очереди.
+    # Общий лимит бота делится между воркерами вебхука
+    workers = {'webhook': WEBHOOK_WORKERS, 'streams': STREAM_WORKERS}.get(BOT_MODE, 1)
+    bot.session.middleware(BotAPISchedulerMiddleware(create_scheduler(BOT_API_GLOBAL_RATE / workers)))
+    bot.session.middleware(BotAPITimingMiddleware())
+    return bot
+
+
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=create_storage())
 
     dp.message.middleware(ThrottlingMiddleware())
     dp.callback_query.middleware(ThrottlingMiddleware())
     dp.message.middleware(UserMiddleware())
+    dp.callback_query.middleware(UserMiddleware())
+
+    for name, router in (('user', user), ('admin', admin)):
+        router.message.middleware(InstrumentationMiddleware(name))
+        router.callback_query.middleware(InstrumentationMiddleware(name))
+        router.pre_checkout_query.middleware(InstrumentationMiddleware(name))
+        router.inline_query.middleware(InstrumentationMiddleware(name))
 
     dp.include_routers(user, admin)
 
-    await create_db()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def on_startup(bot: Bot):
+    if METRICS_PORT:
+        # У каждого воркера вебхука свой порт метрик: METRICS_PORT + номер воркера
+        background_runners.append(await start_metrics_server(METRICS_HOST,
+                                                             METRICS_PORT + int(os.getenv('WORKER_INDEX', 0))))
+    if CACHE_WARMUP == 'wait':
+        # on_startup отрабатывает до начала polling и до открытия порта вебхука
+        await warm_up_caches()
+    elif CACHE_WARMUP == 'background':
+        background_tasks.add(asyncio.create_task(warm_up_caches()))
+    background_tasks.add(asyncio.create_task(cart_flusher()))
+    background_tasks.add(asyncio.create_task(registration_flusher()))
+    background_tasks.add(asyncio.create_task(invalidation_listener()))
+    background_tasks.add(asyncio.create_task(storage_gc()))
+    background_tasks.add(asyncio.create_task(migrate_fsm_states()))
+    background_tasks.add(asyncio.create_task(outbox_worker(bot)))
+    await resume_broadcasts(bot)
+
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await cancel_broadcast_tasks()
+    for runner in background_runners:
+        await runner.cleanup()
+    background_runners.clear()
+    shutdown_executor()
+
+    # Дописываем в БД корзины, которые не успел сбросить фоновый флашер
+    while await flush_carts():
+        pass
+    while await flush_registrations():
+        pass
+
+
+async def main():
+    bot = create_bot()
+    dp = create_dispatcher()
+
+    if RUN_MIGRATIONS:
+        await upgrade_db()
 
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot)
 
 
+async def webhook_worker():
+    await serve_webhook(create_bot(), create_dispatcher())
+
+
+def run_webhook_worker(index: int = 0):
+    os.environ['WORKER_INDEX'] = str(index)
+    try:
+        asyncio.run(webhook_worker())
+    except KeyboardInterrupt:
+        pass
+
+
+async def prepare_webhook():
+    bot = create_bot()
+    if RUN_MIGRATIONS:
+        await upgrade_db()
+    await set_webhook(bot)
+    await bot.session.close()
+
+
+def run_webhook():
+    asyncio.run(prepare_webhook())
+
+    if WEBHOOK_WORKERS == 1:
+        run_webhook_worker()
+        return
+
+    # spawn, чтобы воркеры не унаследовали соединения с БД и Redis от родителя
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_webhook_worker, args=(index,)) for index in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+async def stream_worker():
+    await run_stream_worker(create_bot(), create_dispatcher(), int(os.getenv('WORKER_INDEX', 0)))
+
+
+def run_stream_worker_process(index: int = 0):
+    os.environ['WORKER_INDEX'] = str(index)
+    try:
+        asyncio.run(stream_worker())
+    except KeyboardInterrupt:
+        pass
+
+
+async def stream_receiver():
+    bot = create_bot()
+    try:
+        if STREAM_RECEIVER == 'webhook':
+            await set_webhook(bot)
+            await receive_webhook()
+        else:
+            await receive_polling(bot, create_dispatcher().resolve_used_update_types())
+    finally:
+        await bot.session.close()
+
+
+def run_streams():
+    if STREAM_ROLE == 'worker':
+        run_stream_worker_process(int(os.getenv('WORKER_INDEX', 0)))
+        return
+
+    if RUN_MIGRATIONS:
+        asyncio.run(upgrade_db())
+    workers = []
+    if STREAM_ROLE == 'all':
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_stream_worker_process, args=(index,))
+                   for index in range(STREAM_WORKERS)]
+        for worker in workers:
+            worker.start()
+    try:
+        asyncio.run(stream_receiver())
+    finally:
+        for worker in workers:
+            worker.join()
+
+
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if BOT_MODE == 'webhook':
+            run_webhook()
+        elif BOT_MODE == 'streams':
+            run_streams()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        pass
\ No newline at end of file
+        pass
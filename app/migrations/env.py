@@ -0,0 +1,57 @@
+import asyncio
+import os
+from logging.config import fileConfig
+
+from alembic import context
+from dotenv import load_dotenv
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src.database.models import Base
+
+load_dotenv()
+
+config = context.config
+if config.config_file_name is not None and config.attributes.get('configure_logger', True):
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+
+def run_migrations_offline() -> None:
+    """
+    Генерирует SQL миграций без подключения к БД (alembic upgrade head --sql)
+    """
+    context.configure(url=os.getenv('DB_URL'), target_metadata=target_metadata, literal_binds=True,
+                      dialect_opts={'paramstyle': 'named'}, render_as_batch=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection: Connection) -> None:
+    # render_as_batch: SQLite не умеет ALTER для ограничений, alembic пересоздает таблицу
+    context.configure(connection=connection, target_metadata=target_metadata, render_as_batch=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_async_migrations() -> None:
+    engine = create_async_engine(os.getenv('DB_URL'))
+    async with engine.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+    await engine.dispose()
+
+
+def run_migrations_online() -> None:
+    # Бот передает свое соединение через config.attributes (src/database/engine.py: upgrade_db)
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        do_run_migrations(connection)
+    else:
+        asyncio.run(run_async_migrations())
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,163 @@
+"""cart constraints, photos, stored files, orders and outbox
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:05:00
+
+До миграций схема создавалась через create_all при старте, поэтому в существующей базе
+часть этих таблиц и индексов уже может быть: создается только то, чего нет
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def timestamps():
+    return (
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+    )
+
+
+def create_table(name: str, *columns) -> bool:
+    if sa.inspect(op.get_bind()).has_table(name):
+        return False
+    op.create_table(name, *columns)
+    return True
+
+
+def has_constraint(table: str, name: str) -> bool:
+    inspector = sa.inspect(op.get_bind())
+    return (any(constraint['name'] == name for constraint in inspector.get_unique_constraints(table))
+            or any(index['name'] == name for index in inspector.get_indexes(table)))
+
+
+def upgrade() -> None:
+    if not has_constraint('carts', 'uq_carts_user_product'):
+        # Старые корзины могли содержать несколько строк на один товар: сводим их в одну
+        op.execute("""
+            UPDATE carts SET quantity = (
+                SELECT SUM(c.quantity) FROM carts c
+                WHERE c.user_id = carts.user_id AND c.product_id = carts.product_id
+            )
+            WHERE id IN (SELECT MIN(id) FROM carts GROUP BY user_id, product_id HAVING COUNT(*) > 1)
+        """)
+        op.execute('DELETE FROM carts WHERE id NOT IN (SELECT MIN(id) FROM carts GROUP BY user_id, product_id)')
+        with op.batch_alter_table('carts') as batch_op:
+            batch_op.create_unique_constraint('uq_carts_user_product', ['user_id', 'product_id'])
+    if not has_constraint('carts', 'ix_carts_product_id'):
+        op.create_index('ix_carts_product_id', 'carts', ['product_id'])
+
+    if create_table(
+        'product_photos',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('path', sa.String(length=255), nullable=False),
+        sa.Column('format', sa.String(length=10), nullable=False),
+        sa.Column('width', sa.Integer(), nullable=False),
+        sa.Column('height', sa.Integer(), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=True),
+        *timestamps(),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('product_id', 'kind', name='uq_product_photos_product_kind'),
+    ):
+        op.create_index('ix_product_photos_product_id', 'product_photos', ['product_id'])
+
+    create_table(
+        'photos',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('path', sa.String(length=255), nullable=False),
+        sa.Column('file_id', sa.String(length=255), nullable=False),
+        *timestamps(),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('path'),
+    )
+
+    create_table(
+        'stored_files',
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('refcount', sa.Integer(), nullable=False),
+        sa.Column('released', sa.DateTime(), nullable=True),
+        *timestamps(),
+        sa.PrimaryKeyConstraint('key'),
+    )
+
+    if create_table(
+        'orders',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('delivery_method', sa.String(length=20), nullable=True),
+        sa.Column('payment_method', sa.String(length=20), nullable=True),
+        sa.Column('address', sa.Text(), nullable=True),
+        *timestamps(),
+        sa.PrimaryKeyConstraint('id'),
+    ):
+        op.create_index('ix_orders_user_id', 'orders', ['user_id'])
+
+    if create_table(
+        'order_items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=150), nullable=False),
+        sa.Column('price', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        *timestamps(),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    ):
+        op.create_index('ix_order_items_order_id', 'order_items', ['order_id'])
+
+    create_table(
+        'payments',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('telegram_payment_charge_id', sa.String(length=255), nullable=False),
+        sa.Column('provider_payment_charge_id', sa.String(length=255), nullable=True),
+        sa.Column('currency', sa.String(length=3), nullable=False),
+        sa.Column('total_amount', sa.Integer(), nullable=False),
+        sa.Column('invoice_payload', sa.String(length=128), nullable=True),
+        *timestamps(),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('order_id'),
+        sa.UniqueConstraint('telegram_payment_charge_id'),
+    )
+
+    if create_table(
+        'outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('event_type', sa.String(length=50), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=10), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('available_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        *timestamps(),
+        sa.PrimaryKeyConstraint('id'),
+    ):
+        op.create_index('ix_outbox_status_available_at', 'outbox', ['status', 'available_at'])
+
+
+def downgrade() -> None:
+    op.drop_table('outbox')
+    op.drop_table('payments')
+    op.drop_table('order_items')
+    op.drop_table('orders')
+    op.drop_table('stored_files')
+    op.drop_table('photos')
+    op.drop_table('product_photos')
+    op.drop_index('ix_carts_product_id', table_name='carts')
+    with op.batch_alter_table('carts') as batch_op:
+        batch_op.drop_constraint('uq_carts_user_product', type_='unique')
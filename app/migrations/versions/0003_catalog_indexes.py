@@ -0,0 +1,27 @@
+"""index on products.category_id
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:10:00
+
+Товары категории (get_products) выбираются по category_id: без индекса это полный просмотр products.
+Корзина пользователя выбирается по user_id через уникальный индекс uq_carts_user_product,
+где user_id - первая колонка, поэтому отдельный индекс на carts.user_id не нужен
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_products_category_id', 'products', ['category_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_products_category_id', table_name='products')
@@ -1,5 +1,4 @@
 from pydantic import BaseModel, Field, ConfigDict, field_validator
-from PIL import Image as PILImage
 from io import BytesIO
 
 class CategorySchema(BaseModel):
@@ -28,6 +27,9 @@ class ImageProductSchema(ProductSchema):
 
     @field_validator('image_data')
     def validate_image(cls, data: bytes):
+        # PIL нужен только при добавлении товара администратором, поэтому импортируется здесь
+        from PIL import Image as PILImage
+
         try:
             img = PILImage.open(BytesIO(data))
             if img.format not in ['JPEG', 'PNG', 'JPG']:
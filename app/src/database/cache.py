@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import inspect
+import json
+import os
+import random
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from cachetools import TTLCache
+from redis.exceptions import LockError
+
+from ..database.redis_connection import redis
+from ..utils.logger import Logger
+from ..utils.metrics import register_collector, sample
+
+# Значение-заглушка в Redis для отсутствующих в БД объектов (негативное кеширование)
+NEGATIVE = b'__none__'
+
+# Канал, через который процессы бота сообщают друг другу об изменённых ключах
+INVALIDATION_CHANNEL = 'cache_invalidation'
+# Страховочный срок жизни локальной копии на случай потерянного сообщения об инвалидации
+LOCAL_TTL = float(os.getenv('LOCAL_CACHE_TTL', 60))
+# Сколько ключей максимум держит локальный кеш: ключи по пользователям и поисковым запросам не копятся без предела
+LOCAL_SIZE = int(os.getenv('LOCAL_CACHE_SIZE', 10_000))
+
+# Счетчики по каждому кешу: local_hits, hits, negative_hits, misses, loads, lock_waits
+_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+# Локальный (L1) кеш процесса: ключ -> уже декодированное значение. Сверх LOCAL_SIZE вытесняются
+# давно не читавшиеся ключи, а каждый ключ живет не дольше LOCAL_TTL
+_local: Dict[str, Any] = TTLCache(maxsize=LOCAL_SIZE, ttl=LOCAL_TTL)
+_MISSING = object()
+# Увеличивается при каждой инвалидации, чтобы не положить в L1 значение, прочитанное до неё
+_local_version = 0
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Возвращает счетчики попаданий и промахов по всем кешам
+    """
+    return {name: dict(counters) for name, counters in _stats.items()}
+
+
+def _collect_cache_metrics():
+    yield '# HELP bot_cache_events_total Попадания и промахи кешей requests.py'
+    yield '# TYPE bot_cache_events_total counter'
+    for name, counters in cache_stats().items():
+        for result, value in counters.items():
+            yield sample('bot_cache_events_total', value, cache=name, result=result)
+
+
+register_collector(_collect_cache_metrics)
+
+
+def local_get(key: str) -> tuple:
+    """
+    Возвращает (найдено, значение) из локального кеша процесса
+    """
+    value = _local.get(key, _MISSING)
+    if value is _MISSING:
+        return False, None
+    return True, value
+
+
+def _evict_local(keys) -> None:
+    global _local_version
+    _local_version += 1
+    for key in keys:
+        _local.pop(key, None)
+
+
+async def invalidate(*keys: str) -> None:
+    """
+    Удаляет ключи из Redis и из локальных кешей всех процессов бота
+    """
+    if not keys:
+        return
+    _evict_local(keys)
+    await redis.delete(*keys)
+    await redis.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+
+
+async def invalidation_listener() -> None:
+    """
+    Фоновая задача: слушает канал инвалидации и выкидывает изменённые ключи из локального кеша.
+    После (пере)подключения локальный кеш очищается целиком, так как сообщения могли быть пропущены
+    """
+    global _local_version
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            _local_version += 1
+            _local.clear()
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    _evict_local(json.loads(message['data']))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            Logger.error(f'Ошибка подписки на инвалидацию кеша: {e}')
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+
+def cached(key: str,
+           ttl: Optional[int] = 3600,
+           negative_ttl: Optional[int] = 60,
+           jitter: float = 0.1,
+           lock: bool = False,
+           lock_timeout: float = 10,
+           local: bool = False):
+    """
+    Декоратор кеширования асинхронных функций чтения в Redis.
+
+    key - шаблон ключа, который форматируется аргументами функции, например 'product:{product_id}'.
+    ttl - время жизни в секундах (None - без срока), к нему добавляется случайный разброс jitter,
+    чтобы ключи, заполненные одновременно, не истекали одновременно.
+    Если функция вернула None, результат кешируется как отсутствующий на negative_ttl секунд.
+    Одновременные промахи по одному ключу внутри процесса ждут один общий запрос к БД,
+    а при lock=True дополнительно берется Redis-блокировка, чтобы в БД шел один процесс из всех.
+    При local=True декодированное значение хранится еще и в памяти процесса, и повторные чтения
+    обходятся без Redis; такие значения общие для всех вызовов, изменять их нельзя.
+
+    У обернутой функции есть методы key(*args, **kwargs) и invalidate(*args, **kwargs).
+    """
+
+    def decorator(func: Callable[..., Awaitable[Any]]):
+        signature = inspect.signature(func)
+        name = func.__name__
+        inflight: Dict[str, asyncio.Task] = {}
+
+        def make_key(*args, **kwargs) -> str:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return key.format(**bound.arguments)
+
+        def expire(seconds: Optional[int]) -> Optional[int]:
+            if not seconds:
+                return None
+            return int(seconds * (1 + random.uniform(0, jitter)))
+
+        async def store(cache_key: str, value: Any) -> None:
+            if value is None:
+                if negative_ttl:
+                    await redis.set(cache_key, NEGATIVE, ex=expire(negative_ttl))
+            else:
+                await redis.set(cache_key, json.dumps(value), ex=expire(ttl))
+
+        async def read(cache_key: str) -> tuple:
+            raw = await redis.get(cache_key)
+            if raw is None:
+                return False, None
+            if raw == NEGATIVE:
+                _stats[name]['negative_hits'] += 1
+                return True, None
+            _stats[name]['hits'] += 1
+            return True, json.loads(raw)
+
+        async def load(cache_key: str, args: tuple, kwargs: dict) -> Any:
+            if not lock:
+                value = await func(*args, **kwargs)
+                _stats[name]['loads'] += 1
+                await store(cache_key, value)
+                return value
+
+            redis_lock = redis.lock(f'lock:{cache_key}', timeout=lock_timeout, blocking_timeout=lock_timeout)
+            acquired = await redis_lock.acquire()
+            try:
+                if acquired:
+                    # Пока ждали блокировку, значение мог загрузить другой процесс
+                    found, value = await read(cache_key)
+                    if found:
+                        _stats[name]['lock_waits'] += 1
+                        return value
+                value = await func(*args, **kwargs)
+                _stats[name]['loads'] += 1
+                await store(cache_key, value)
+                return value
+            finally:
+                if acquired:
+                    try:
+                        await redis_lock.release()
+                    except LockError:
+                        pass
+
+        async def fetch(cache_key: str, args: tuple, kwargs: dict) -> Any:
+            try:
+                found, value = await read(cache_key)
+            except Exception as e:
+                Logger.error(f'Ошибка чтения кеша {cache_key}: {e}')
+                return await func(*args, **kwargs)
+            if found:
+                return value
+
+            _stats[name]['misses'] += 1
+            task = inflight.get(cache_key)
+            if task is None:
+                task = asyncio.ensure_future(load(cache_key, args, kwargs))
+                inflight[cache_key] = task
+                task.add_done_callback(lambda _: inflight.pop(cache_key, None))
+            return await asyncio.shield(task)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = make_key(*args, **kwargs)
+            if not local:
+                return await fetch(cache_key, args, kwargs)
+
+            found, value = local_get(cache_key)
+            if found:
+                _stats[name]['local_hits'] += 1
+                return value
+
+            version = _local_version
+            value = await fetch(cache_key, args, kwargs)
+            if version == _local_version:
+                _local[cache_key] = value
+            return value
+
+        async def invalidate_key(*args, **kwargs) -> None:
+            await invalidate(make_key(*args, **kwargs))
+
+        wrapper.key = make_key
+        wrapper.invalidate = invalidate_key
+        return wrapper
+
+    return decorator
@@ -1,21 +1,247 @@
 import os
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
 
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Connection, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from dotenv import load_dotenv
 
 from ..database.models import Base
+from ..database.redis_connection import redis
+from ..utils.metrics import db_query_latency, register_collector, sample
 
 load_dotenv()
-engine = create_async_engine(os.getenv("DB_URL"), echo=True)
+
+# Логирование SQL отдельно от логов приложения: включается только явно через DB_ECHO
+DB_ECHO = os.getenv('DB_ECHO', 'false').lower() in ('1', 'true', 'yes')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+ALEMBIC_INI = os.path.join(os.path.dirname(__file__), '..', '..', 'alembic.ini')
+# Реплика для чтения (если не задана, все запросы идут в основную БД)
+DB_REPLICA_URL = os.getenv('DB_REPLICA_URL')
+# Сколько секунд после записи читать данные из основной БД: верхняя граница отставания реплики
+DB_STICKY_SECONDS = float(os.getenv('DB_STICKY_SECONDS', 5))
+# Размер кеша подготовленных выражений asyncpg (0 - выключить, например за pgbouncer в transaction mode)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 500))
+
+# Наблюдения по пулам: имя движка -> {'checkout_wait': [count, sum, max], 'connect_latency': [count, sum, max]}
+_pool_timings: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0.0]))
+_engines: Dict[str, AsyncEngine] = {}
+
+
+def _observe(name: str, metric: str, seconds: float) -> None:
+    timing = _pool_timings[name][metric]
+    timing[0] += 1
+    timing[1] += seconds
+    timing[2] = max(timing[2], seconds)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, который замеряет, сколько времени обработчики ждут свободное соединение
+    (включая открытие нового соединения, если пул еще не заполнен)
+    """
+    engine_name = 'primary'
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            _observe(self.engine_name, 'checkout_wait', time.perf_counter() - started)
+
+
+def create_engine_from_env(url: Optional[str] = None, name: str = 'primary') -> AsyncEngine:
+    """
+    Создает движок с настройками пула из окружения и инструментированием пула
+    """
+    url = make_url(url or os.getenv('DB_URL'))
+    kwargs = {'echo': DB_ECHO}
+
+    if url.get_backend_name() == 'postgresql' and url.get_driver_name() == 'asyncpg':
+        kwargs['connect_args'] = {'statement_cache_size': DB_STATEMENT_CACHE_SIZE}
+        url = url.update_query_dict({'prepared_statement_cache_size': str(DB_STATEMENT_CACHE_SIZE)})
+
+    if url.database not in (None, '', ':memory:'):
+        kwargs.update(
+            poolclass=type(f'InstrumentedPool_{name}', (InstrumentedPool,), {'engine_name': name}),
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+
+    new_engine = create_async_engine(url, **kwargs)
+
+    @event.listens_for(new_engine.sync_engine, 'do_connect')
+    def _connect_started(dialect, conn_rec, cargs, cparams):
+        conn_rec.info['connect_started'] = time.perf_counter()
+
+    @event.listens_for(new_engine.sync_engine, 'connect')
+    def _connected(dbapi_connection, conn_rec):
+        started = conn_rec.info.pop('connect_started', None)
+        if started is not None:
+            _observe(name, 'connect_latency', time.perf_counter() - started)
+
+    @event.listens_for(new_engine.sync_engine, 'before_cursor_execute')
+    def _query_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(new_engine.sync_engine, 'after_cursor_execute')
+    def _query_finished(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        db_query_latency.observe(time.perf_counter() - started, engine=name, operation=operation)
+
+    @event.listens_for(new_engine.sync_engine, 'handle_error')
+    def _query_failed(context):
+        if context.connection is not None and context.connection.info.get('query_started'):
+            context.connection.info['query_started'].pop()
+
+    _engines[name] = new_engine
+    return new_engine
+
+
+def pool_stats() -> Dict[str, dict]:
+    """
+    Возвращает состояние пулов соединений: занято, свободно, переполнение,
+    а также время ожидания соединения и время подключения (количество, сумма, максимум)
+    """
+    stats = {}
+    for name, current_engine in _engines.items():
+        pool = current_engine.sync_engine.pool
+        stats[name] = {
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+            'checked_in': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+            **{metric: {'count': timing[0], 'sum': timing[1], 'max': timing[2]}
+               for metric, timing in _pool_timings[name].items()}
+        }
+    return stats
+
+
+def _collect_pool_metrics():
+    for metric, help_text in (('checked_out', 'Занятые соединения пула'), ('checked_in', 'Свободные соединения пула'),
+                              ('overflow', 'Соединения сверх pool_size'), ('size', 'Размер пула')):
+        yield f'# HELP bot_db_pool_{metric} {help_text}'
+        yield f'# TYPE bot_db_pool_{metric} gauge'
+        for name, stats in pool_stats().items():
+            if stats[metric] is not None:
+                yield sample(f'bot_db_pool_{metric}', stats[metric], engine=name)
+
+    for metric, help_text in (('checkout_wait', 'Ожидание соединения из пула'),
+                              ('connect_latency', 'Время открытия соединения')):
+        yield f'# HELP bot_db_pool_{metric}_seconds {help_text}'
+        yield f'# TYPE bot_db_pool_{metric}_seconds summary'
+        for name, stats in pool_stats().items():
+            if metric in stats:
+                yield sample(f'bot_db_pool_{metric}_seconds_count', stats[metric]['count'], engine=name)
+                yield sample(f'bot_db_pool_{metric}_seconds_sum', stats[metric]['sum'], engine=name)
+
+
+register_collector(_collect_pool_metrics)
+
+engine = create_engine_from_env()
+replica_engine = create_engine_from_env(DB_REPLICA_URL, name='replica') if DB_REPLICA_URL else engine
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+replica_session_maker = async_sessionmaker(bind=replica_engine, class_=AsyncSession, expire_on_commit=False)
+
+# Области данных (cart:{user_id}, catalog, ...), в которые этот процесс недавно писал: область -> до какого момента
+_written_locally: Dict[str, float] = {}
+
+
+def _sticky_key(scope: str) -> str:
+    return f'db_sticky:{scope}'
+
+
+async def _recently_written(scopes: tuple) -> bool:
+    now = time.monotonic()
+    if any(_written_locally.get(scope, 0) > now for scope in scopes):
+        return True
+    try:
+        return bool(await redis.exists(*map(_sticky_key, scopes)))
+    except Exception:
+        return True  # без Redis не знаем, была ли запись - читаем из основной
+
+
+async def _mark_written(scopes: tuple) -> None:
+    until = time.monotonic() + DB_STICKY_SECONDS
+    for scope in scopes:
+        _written_locally[scope] = until
+    if len(_written_locally) > 10_000:
+        for scope in [scope for scope, expires in _written_locally.items() if expires <= time.monotonic()]:
+            del _written_locally[scope]
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for scope in scopes:
+                pipe.set(_sticky_key(scope), 1, px=int(DB_STICKY_SECONDS * 1000))
+            await pipe.execute()
+    except Exception:
+        pass  # другие процессы могут прочитать старые данные с реплики, но только в пределах отставания
+
+
+@asynccontextmanager
+async def read_session(*scopes: str) -> AsyncIterator[AsyncSession]:
+    """
+    Сессия для чтения: с реплики, но если в одну из областей scopes недавно писали
+    (этот или другой процесс), то из основной БД, чтобы пользователь сразу видел свои изменения
+    """
+    maker = replica_session_maker
+    if maker is not session_maker and scopes and await _recently_written(scopes):
+        maker = session_maker
+    async with maker() as session:
+        yield session
+
+
+@asynccontextmanager
+async def write_session(*scopes: str) -> AsyncIterator[AsyncSession]:
+    """
+    Сессия основной БД для записи. Чтения областей scopes уходят в основную БД уже во время записи
+    (внутри блока сбрасывается кеш, и его не должно заполнить старое значение с реплики)
+    и еще DB_STICKY_SECONDS после нее, пока реплика догоняет
+    """
+    sticky = bool(scopes) and replica_session_maker is not session_maker
+    if sticky:
+        await _mark_written(scopes)
+    async with session_maker() as session:
+        yield session
+    if sticky:
+        await _mark_written(scopes)
+
+
+def _upgrade(connection: Connection, revision: str) -> None:
+    # alembic нужен только для миграций, а его импорт заметно удлиняет запуск процесса
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(ALEMBIC_INI)
+    config.attributes['connection'] = connection
+    config.attributes['configure_logger'] = False
+    tables = inspect(connection).get_table_names()
+    if 'users' in tables and 'alembic_version' not in tables:
+        # База создана через create_all до появления миграций: 0002 досоздаст недостающее
+        command.stamp(config, '0001')
+    command.upgrade(config, revision)
 
 
-async def create_db():
+async def upgrade_db(revision: str = 'head'):
+    """
+    Применяет миграции alembic к базе (при старте бота и в бенчмарках)
+    """
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_upgrade, revision)
 
 
 async def drop_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.drop_all)
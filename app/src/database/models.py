@@ -1,4 +1,4 @@
-from sqlalchemy import BigInteger, ForeignKey, Text, String, DateTime, func
+from sqlalchemy import BigInteger, ForeignKey, Text, String, DateTime, UniqueConstraint, Index, func
 from sqlalchemy.orm import relationship, Mapped, mapped_column, DeclarativeBase
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
@@ -26,6 +26,11 @@ class Cart(Base):
     product_id: Mapped[int] = mapped_column(ForeignKey('products.id'), nullable=False)
     quantity: Mapped[int] = mapped_column()
 
+    __table_args__ = (
+        UniqueConstraint('user_id', 'product_id', name='uq_carts_user_product'),
+        Index('ix_carts_product_id', 'product_id'),
+    )
+
 
 class Category(Base):
     __tablename__ = 'categories'
@@ -43,8 +48,104 @@ class Product(Base):
     name: Mapped[str] = mapped_column(String(150), nullable=False)
     description: Mapped[str] = mapped_column(Text)
     price: Mapped[int] = mapped_column()
-    category_id: Mapped[int] = mapped_column(ForeignKey('categories.id'))
+    category_id: Mapped[int] = mapped_column(ForeignKey('categories.id'), index=True)
     photo_path: Mapped[str] = mapped_column(String(255))
 
     category = relationship('Category', back_populates='products')
+    renditions = relationship('ProductPhoto', back_populates='product', cascade='all, delete-orphan',
+                              passive_deletes=True)
+
+
+class ProductPhoto(Base):
+    __tablename__ = 'product_photos'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    product_id: Mapped[int] = mapped_column(ForeignKey('products.id', ondelete='CASCADE'), index=True)
+    kind: Mapped[str] = mapped_column(String(20))
+    path: Mapped[str] = mapped_column(String(255))
+    format: Mapped[str] = mapped_column(String(10))
+    width: Mapped[int] = mapped_column()
+    height: Mapped[int] = mapped_column()
+    size: Mapped[int] = mapped_column(nullable=True)
+
+    product = relationship('Product', back_populates='renditions')
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'kind', name='uq_product_photos_product_kind'),
+    )
+
+
+class Photo(Base):
+    __tablename__ = 'photos'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    path: Mapped[str] = mapped_column(String(255), unique=True)
+    file_id: Mapped[str] = mapped_column(String(255))
+
+
+class StoredFile(Base):
+    __tablename__ = 'stored_files'
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    refcount: Mapped[int] = mapped_column(default=0)
+    released: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
+
+
+class Order(Base):
+    __tablename__ = 'orders'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[BigInteger] = mapped_column(BigInteger, index=True)
+    status: Mapped[str] = mapped_column(String(20), default='paid')
+    total: Mapped[int] = mapped_column()
+    delivery_method: Mapped[str] = mapped_column(String(20), nullable=True)
+    payment_method: Mapped[str] = mapped_column(String(20), nullable=True)
+    address: Mapped[str] = mapped_column(Text, nullable=True)
+
+    items = relationship('OrderItem', back_populates='order', cascade='all, delete-orphan')
+    payment = relationship('Payment', back_populates='order', uselist=False, cascade='all, delete-orphan')
+
+
+class OrderItem(Base):
+    __tablename__ = 'order_items'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    order_id: Mapped[int] = mapped_column(ForeignKey('orders.id', ondelete='CASCADE'), index=True)
+    # Снимок товара на момент заказа: товар могут изменить или удалить из каталога
+    product_id: Mapped[int] = mapped_column()
+    name: Mapped[str] = mapped_column(String(150))
+    price: Mapped[int] = mapped_column()
+    quantity: Mapped[int] = mapped_column()
+
+    order = relationship('Order', back_populates='items')
 
+
+class Payment(Base):
+    __tablename__ = 'payments'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    order_id: Mapped[int] = mapped_column(ForeignKey('orders.id', ondelete='CASCADE'), unique=True)
+    telegram_payment_charge_id: Mapped[str] = mapped_column(String(255), unique=True)
+    provider_payment_charge_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    currency: Mapped[str] = mapped_column(String(3))
+    total_amount: Mapped[int] = mapped_column()
+    invoice_payload: Mapped[str] = mapped_column(String(128), nullable=True)
+
+    order = relationship('Order', back_populates='payment')
+
+
+class OutboxEvent(Base):
+    __tablename__ = 'outbox'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    event_type: Mapped[str] = mapped_column(String(50))
+    payload: Mapped[str] = mapped_column(Text)
+    # pending - ждет обработки (или повтора), done - обработано, failed - исчерпаны попытки
+    status: Mapped[str] = mapped_column(String(10), default='pending')
+    attempts: Mapped[int] = mapped_column(default=0)
+    available_at: Mapped[DateTime] = mapped_column(DateTime)
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+
+    __table_args__ = (
+        Index('ix_outbox_status_available_at', 'status', 'available_at'),
+    )
@@ -1,3 +1,8 @@
+import os
+
 from redis.asyncio import Redis
+from dotenv import load_dotenv
+
+load_dotenv()
 
-redis = Redis(host='localhost', port=6379)
\ No newline at end of file
+redis = Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
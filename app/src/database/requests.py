@@ -1,87 +1,275 @@
-from typing import List, Optional
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
 import os
 import json
+import random
+import time
+import uuid
 
-from sqlalchemy import select
+from sqlalchemy import select, delete, update, tuple_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from redis.exceptions import ConnectionError as RedisConnectionError
+from cachetools import LRUCache
 
-from .models import Category, Product, Cart, User
-from .engine import session_maker
+from .models import (Category, Product, Cart, User, Photo, ProductPhoto, StoredFile, Order, OrderItem, Payment,
+                     OutboxEvent)
+from .engine import read_session, write_session
+from .cache import cached, invalidate, local_get, NEGATIVE
 from ..database.redis_connection import redis
 from ..utils.logger import Logger
+from ..utils.storage import is_content_key, storage
+
+CATALOG_TTL = int(os.getenv('CATALOG_CACHE_TTL', 3600))
+
+
+def _product_to_dict(product: Product) -> dict:
+    return {
+        'name': product.name,
+        'description': product.description,
+        'price': product.price,
+        'id': product.id,
+        'photo_path': product.photo_path
+    }
+
+
+def _utcnow() -> datetime:
+    """
+    Текущее время UTC без часового пояса, как в колонках DateTime
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _dialect_insert(session: AsyncSession):
+    """
+    Возвращает insert с поддержкой ON CONFLICT для текущей БД (PostgreSQL или SQLite)
+    """
+    if session.bind.dialect.name == 'postgresql':
+        return postgresql_insert
+    return sqlite_insert
 
 
 # Взаимодействие с пользователем
+# Айди всех известных пользователей лежат в Redis-множестве known_users (плюс небольшой кеш в памяти процесса),
+# а новые пользователи попадают в очередь registration_queue и пишутся в БД пачками через flush_registrations
+KNOWN_USERS_KEY = 'known_users'
+KNOWN_USERS_LOADED_KEY = 'known_users_loaded'
+REGISTRATION_QUEUE_KEY = 'registration_queue'
+# Записи очереди, которые БД отвергла (нарушение ограничений): лежат для разбора, а не повторяются вечно
+REGISTRATION_DEAD_KEY = 'registration_dead'
+REGISTRATION_FLUSH_INTERVAL = float(os.getenv('REGISTRATION_FLUSH_INTERVAL', 1))
+REGISTRATION_FLUSH_BATCH = int(os.getenv('REGISTRATION_FLUSH_BATCH', 500))
+
+_known_users = LRUCache(maxsize=int(os.getenv('KNOWN_USERS_LOCAL_SIZE', 100_000)))
+_known_users_load_lock = asyncio.Lock()
+
+
+async def load_known_users(chunk_size: int = 10_000) -> int:
+    """
+    Загружает айди всех пользователей из БД в Redis-множество known_users.
+    Возвращает количество загруженных айди
+    """
+    try:
+        loaded = 0
+        async with read_session() as session:
+            result = await session.stream_scalars(select(User.telegram_id).execution_options(yield_per=chunk_size))
+            async for chunk in result.partitions(chunk_size):
+                await redis.sadd(KNOWN_USERS_KEY, *chunk)
+                loaded += len(chunk)
+        await redis.set(KNOWN_USERS_LOADED_KEY, 1)
+        return loaded
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к load_known_users: {e}')
+        raise e
+
+
 async def is_user_exists(user_id: int) -> bool:
     """
-    Проверяет, есть ли пользователь в БД
+    Проверяет, известен ли пользователь боту (зарегистрирован или уже стоит в очереди на регистрацию)
     """
     try:
-        res = await redis.get(name=f'is_user_exists: {str(user_id)}')
-        if not res:
-            async with session_maker() as session:
-                query_result = await session.scalar(select(User).where(User.telegram_id == user_id))
-                await redis.set(name=f'is_user_exists: {str(user_id)}', value=1 if query_result else 0, ex=3600)
-                return bool(query_result)
+        if user_id in _known_users:
+            return True
 
-        return bool(res)
+        if not await redis.sismember(KNOWN_USERS_KEY, user_id):
+            if await redis.exists(KNOWN_USERS_LOADED_KEY):
+                return False
+            # Redis пустой (перезапуск, очистка) - восстанавливаем множество из БД
+            async with _known_users_load_lock:
+                if not await redis.exists(KNOWN_USERS_LOADED_KEY):
+                    await load_known_users()
+            if not await redis.sismember(KNOWN_USERS_KEY, user_id):
+                return False
+
+        _known_users[user_id] = True
+        return True
     except Exception as e:
         Logger.error(f"Ошибка при проверки наличия пользователя в БД: {e}")
         raise e
 
 
+async def register_user(user_id: int, name: str, username: str, phone: str = 'не указан') -> bool:
+    """
+    Ставит нового пользователя в очередь на запись в БД.
+    Возвращает False, если пользователь уже был известен (например, его зарегистрировал другой процесс)
+    """
+    try:
+        added = await redis.sadd(KNOWN_USERS_KEY, user_id)
+        _known_users[user_id] = True
+        if not added:
+            return False
+        # У пользователя Telegram может не быть username, а в таблице users это поле обязательное
+        await redis.rpush(REGISTRATION_QUEUE_KEY, json.dumps(
+            {'telegram_id': user_id, 'name': name or '', 'username': username or '', 'phone': phone}
+        ))
+        return True
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к register_user: {e}')
+        raise e
+
+
 async def add_user(user_id: int, name: str, username: str, phone: str = 'не указан') -> None:
     """
     Добавляет пользователя в БД
     """
     try:
-        async with session_maker() as session:
-            new_user = User(
-                telegram_id=user_id,
-                name=name,
-                username=username,
-                phone=phone
-            )
-            session.add(new_user)
+        async with write_session() as session:
+            statement = _dialect_insert(session)(User).values(telegram_id=user_id, name=name,
+                                                              username=username, phone=phone)
+            await session.execute(statement.on_conflict_do_nothing(index_elements=[User.telegram_id]))
             await session.commit()
+        await redis.sadd(KNOWN_USERS_KEY, user_id)
     except Exception as e:
         Logger.exception(f'Ошибка при добавлении пользователя: {e}')
-        await session.rollback()
         raise e
 
 
+async def _insert_users(users: List[dict]) -> None:
+    async with write_session() as session:
+        statement = _dialect_insert(session)(User).values(users)
+        await session.execute(statement.on_conflict_do_nothing(index_elements=[User.telegram_id]))
+        await session.commit()
+
+
+async def flush_registrations(batch_size: int = REGISTRATION_FLUSH_BATCH) -> int:
+    """
+    Записывает пользователей из очереди регистрации в БД одним INSERT ... ON CONFLICT DO NOTHING на пачку.
+    Если БД отвергла пачку из-за данных, пользователи записываются по одному, а отвергнутые уходят
+    в registration_dead, чтобы одна плохая запись не останавливала очередь.
+    Возвращает количество обработанных записей
+    """
+    items = await redis.lpop(REGISTRATION_QUEUE_KEY, batch_size) or []
+    if not items:
+        return 0
+
+    try:
+        users = list({user['telegram_id']: user for user in map(json.loads, items)}.values())
+        failed = []
+        try:
+            await _insert_users(users)
+        except IntegrityError:
+            for user in users:
+                try:
+                    await _insert_users([user])
+                except IntegrityError as e:
+                    Logger.error(f'Пользователь {user["telegram_id"]} не записан в БД: {e}')
+                    failed.append(json.dumps(user))
+            if failed:
+                await redis.rpush(REGISTRATION_DEAD_KEY, *failed)
+        Logger.info(f'Зарегистрировано пользователей: {len(users) - len(failed)}')
+        return len(items)
+    except Exception as e:
+        await redis.lpush(REGISTRATION_QUEUE_KEY, *reversed(items))
+        Logger.error(f'Ошибка при обращении к flush_registrations: {e}')
+        raise e
+
+
+async def registration_flusher(interval: float = REGISTRATION_FLUSH_INTERVAL) -> None:
+    """
+    Фоновая задача, которая периодически записывает новых пользователей в БД
+    """
+    while True:
+        try:
+            while await flush_registrations() == REGISTRATION_FLUSH_BATCH:
+                pass
+        except Exception:
+            pass  # уже залогировано, записи вернулись в очередь
+        await asyncio.sleep(interval)
+
+
+async def get_user_ids_after(after: int, limit: int) -> List[int]:
+    """
+    Следующая пачка айди пользователей по возрастанию: keyset-пагинация по уникальному индексу telegram_id,
+    поэтому каждая пачка читается одинаково быстро независимо от того, как далеко продвинулась выборка
+    """
+    try:
+        async with read_session() as session:
+            result = await session.scalars(
+                select(User.telegram_id).where(User.telegram_id > after).order_by(User.telegram_id).limit(limit)
+            )
+            return list(result)
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_user_ids_after: {e}')
+        raise e
+
+
+async def count_users() -> int:
+    try:
+        async with read_session() as session:
+            return await session.scalar(select(func.count()).select_from(User))
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к count_users: {e}')
+        raise e
+
+
+# Версия каталога: увеличивается при любом изменении категорий или товаров.
+# Состояние пользователя хранит только (категория, версия, страница), а по версии видно, что список устарел
+CATALOG_VERSION_KEY = 'catalog_version'
+
+
+@cached('catalog_version:cached', ttl=CATALOG_TTL, local=True)
+async def get_catalog_version() -> int:
+    """
+    Возвращает текущую версию каталога (копия в памяти процесса сбрасывается вместе с кешем каталога)
+    """
+    try:
+        return int(await redis.get(CATALOG_VERSION_KEY) or 0)
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_catalog_version: {e}')
+        raise e
+
+
+async def _bump_catalog_version() -> None:
+    await redis.incr(CATALOG_VERSION_KEY)
+    await invalidate(get_catalog_version.key())
+
+
 # Взаимодействие с категорией
-async def get_categories() -> dict:
+@cached('categories', ttl=CATALOG_TTL, lock=True, local=True)
+async def get_categories() -> list:
     """
     Возвращает все категории товаров
     """
     try:
-        categories_json = await redis.get(name=f'categories')
-        if categories_json:
-            categories = json.loads(categories_json.decode('utf-8'))
-        else:
-            async with session_maker() as session:
-                query = await session.scalars(select(Category))
-                categories = query.all()
-                categories = [{'name': c.name, 'id': c.id} for c in categories]
-                categories_json = json.dumps(categories)
-                await redis.set('categories', categories_json)
-        return categories
+        async with read_session('catalog') as session:
+            query = await session.scalars(select(Category))
+            return [{'name': c.name, 'id': c.id} for c in query.all()]
     except Exception as e:
         Logger.error(f'Ошибка при обращении к get_categories: {e}')
         raise e
 
 
+@cached('category_id:{category_name}', ttl=CATALOG_TTL, local=True)
 async def get_categorie_id(category_name: str) -> Optional[int]:
     """
     Возвращает айди выбранной категории
     """
     try:
-        category_id = await redis.get(name=f'categorie_id:{category_name}')
-        if not category_id:
-            async with session_maker() as session:
-                category_id = await session.scalar(select(Category).where(Category.name == category_name))
-                await redis.set(f'category_id:{category_name}', category_id)
-        return category_id
+        async with read_session('catalog') as session:
+            return await session.scalar(select(Category.id).where(Category.name == category_name))
     except Exception as e:
         Logger.error(f"Ошибка при обращении к get_categorie_id: {e}")
         raise e
@@ -92,11 +280,12 @@ async def create_categorie(name_category: str) -> None:
     Создаёт новую категорию товаров
     """
     try:
-        async with session_maker() as session:
+        async with write_session('catalog') as session:
             new_category = Category(name=name_category)
             session.add(new_category)
             await session.commit()
-            await redis.delete('categories')
+            await invalidate(get_categories.key(), get_categorie_id.key(name_category))
+            await _bump_catalog_version()
     except Exception as e:
         Logger.error(f'Ошибка при обращении к create_categorie: {e}')
         raise e
@@ -107,12 +296,15 @@ async def change_categorie(category_id: int, category_name: str) -> None:
     Изменяет название категории
     """
     try:
-        async with session_maker() as session:
+        async with write_session('catalog') as session:
             result = await session.scalars(select(Category).where(Category.id == int(category_id)))
             category = result.first()
+            old_name = category.name
             category.name = category_name
             await session.commit()
-            await redis.delete('categories')
+            await invalidate(get_categories.key(), get_categorie_id.key(old_name),
+                               get_categorie_id.key(category_name))
+            await _bump_catalog_version()
     except Exception as e:
         Logger.error(f'Ошибка при обращении к change_categorie: {e}')
         raise e
@@ -123,87 +315,120 @@ async def delete_categorie(category_id: int) -> None:
     Удаляет категорию
     """
     try:
-        async with session_maker() as session:
+        async with write_session('catalog') as session:
             result = await session.scalars(select(Category).where(Category.id == int(category_id)))
             category = result.first()
             await session.delete(category)
             await session.commit()
-            await redis.delete('categories')
+            await invalidate(get_categories.key(), get_categorie_id.key(category.name),
+                               get_products.key(category_id))
+            await _bump_catalog_version()
     except Exception as e:
         Logger.error(f'Ошибка при обращении к delete_categorie: {e}')
         raise e
 
 
 # Взаимодействие с товаром
-async def get_products(category_id: int) -> List[Product]:
+@cached('products_on_category:{category_id}', ttl=CATALOG_TTL, lock=True, local=True)
+async def get_products(category_id: int) -> List[dict]:
     """
     Возвращает список товаров по определенной категории
     """
     try:
-        products_json = await redis.get(f'products_on_category:{category_id}')
-        if products_json:
-            products = json.loads(products_json.decode('utf-8'))
-        else:
-            async with session_maker() as session:
-                products = await session.scalars(select(Product).where(Product.category_id == int(category_id)))
-                products = [
-                    {
-                     'name': c.name,
-                     'description': c.description,
-                     'id': c.id,
-                     'price': c.price
-                     }
-                    for c in products.all()
-                ]
-                products_json = json.dumps(products)
-                await redis.set(f'products_on_category:{category_id}', products_json)
-        return products
+        async with read_session('catalog') as session:
+            products = await session.scalars(
+                select(Product).where(Product.category_id == int(category_id)).order_by(Product.id))
+            return [_product_to_dict(product) for product in products.all()]
     except Exception as e:
         Logger.error(f'Ошибка при обращении к get_products: {e}')
         raise e
 
 
-async def get_product(product_id: int) -> Product:
+@cached('product:{product_id}', ttl=CATALOG_TTL, local=True)
+async def get_product(product_id: int) -> Optional[dict]:
     """
-    Возвращает модель товара, чтобы в последующем обращаться к его значениям
+    Возвращает товар в виде словаря, чтобы в последующем обращаться к его значениям.
+    Если товара нет, возвращает None
     """
     try:
-        product_json = await redis.get(f'product:{product_id}')
-        if product_json:
-            product = json.loads(product_json.decode('utf-8'))
-        else:
-            async with session_maker() as session:
-                product = await session.scalar(select(Product).where(Product.id == int(product_id)))
-                product = {
-                           'name': product.name,
-                           'description': product.description,
-                           'price': product.price,
-                           'id': product.id,
-                           'photo_path': product.photo_path
-                           }
-
-                product_json = json.dumps(product)
-                await redis.set(f'product:{product_id}', product_json)
-        return product
+        async with read_session('catalog') as session:
+            product = await session.scalar(select(Product).where(Product.id == int(product_id)))
+            return _product_to_dict(product) if product else None
     except Exception as e:
         Logger.error(f'Ошибка при обращении к get_product: {e}')
         raise e
 
 
-async def create_product(name: str, description: str, price: int, category_id: int, photo_path: str) -> None:
+async def get_products_by_ids(product_ids: List[int]) -> Dict[int, dict]:
+    """
+    Возвращает товары по списку айди: одним MGET из Redis, одним запросом WHERE id IN (...) для промахов
+    и одним пайплайном для записи промахов обратно в кеш
+    """
+    try:
+        product_ids = list(dict.fromkeys(int(product_id) for product_id in product_ids))
+        if not product_ids:
+            return {}
+
+        products = {}
+        known_missing = set()
+        not_local = []
+        for product_id in product_ids:
+            found, product = local_get(get_product.key(product_id))
+            if not found:
+                not_local.append(product_id)
+            elif product is None:
+                known_missing.add(product_id)
+            else:
+                products[product_id] = product
+
+        if not_local:
+            cached_products = await redis.mget([get_product.key(product_id) for product_id in not_local])
+            for product_id, product_json in zip(not_local, cached_products):
+                if product_json == NEGATIVE:
+                    known_missing.add(product_id)
+                elif product_json:
+                    products[product_id] = json.loads(product_json)
+
+        missing = [product_id for product_id in product_ids
+                   if product_id not in products and product_id not in known_missing]
+        if missing:
+            async with read_session('catalog') as session:
+                result = await session.scalars(select(Product).where(Product.id.in_(missing)))
+                loaded = {product.id: _product_to_dict(product) for product in result.all()}
+            async with redis.pipeline(transaction=False) as pipe:
+                for product_id in missing:
+                    if product_id in loaded:
+                        pipe.set(get_product.key(product_id), json.dumps(loaded[product_id]), ex=CATALOG_TTL)
+                    else:
+                        pipe.set(get_product.key(product_id), NEGATIVE, ex=60)
+                await pipe.execute()
+            products.update(loaded)
+        return products
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_products_by_ids: {e}')
+        raise e
+
+
+async def create_product(name: str, description: str, price: int, category_id: int, photo_path: str,
+                         renditions: Optional[List[dict]] = None) -> int:
     """
-    Создаёт новый товар в определенной категории по заданным параметрам
+    Создаёт новый товар в определенной категории по заданным параметрам.
+    renditions - версии фотографии (основная, превью), которые сохраняются вместе с товаром
     """
     try:
-        async with session_maker() as session:
+        async with write_session('catalog') as session:
             new_product = Product(name=name,
                                   description=description,
                                   price=price,
                                   category_id=category_id,
-                                  photo_path=photo_path)
+                                  photo_path=photo_path,
+                                  renditions=[ProductPhoto(**rendition) for rendition in renditions or []])
             session.add(new_product)
+            await _acquire_files(session, {photo_path, *(rendition['path'] for rendition in renditions or [])})
             await session.commit()
-            await redis.delete(f'products_on_category:{category_id}')
+            await invalidate(get_products.key(category_id))
+            await _bump_catalog_version()
+            return new_product.id
     except Exception as e:
         Logger.error(f'Ошибка при обращении к create_product: {e}')
         raise e
@@ -211,87 +436,726 @@ async def create_product(name: str, description: str, price: int, category_id: i
 
 async def delete_product(product_id: int, category_id: int) -> None:
     """
-    Удаляет товар (что тут еще сказать xD)
+    Удаляет товар и отпускает ссылки на его фотографии: сами файлы удалит сборщик мусора,
+    если они не используются другими товарами
     """
     try:
-        async with session_maker() as session:
+        async with write_session('catalog') as session:
             product = await session.get(Product, int(product_id))
             if product:
-                product_file = product.photo_path
-                if product_file and os.path.exists(product_file):
-                    try:
-                        os.remove(product_file)
-                    except Exception as e:
-                        Logger.error(f'Ошибка при удалении файла: {e}')
-
+                rendition_files = list(await session.scalars(
+                    select(ProductPhoto.path).where(ProductPhoto.product_id == product.id)))
+                await _release_files(session, {product.photo_path, *rendition_files})
 
+                await session.execute(delete(ProductPhoto).where(ProductPhoto.product_id == product.id))
                 await session.delete(product)
                 await session.commit()
 
-                await redis.delete(f'products_on_category:{category_id}')
-                await redis.delete(f'product:{product_id}')
+                await invalidate(get_products.key(category_id), get_product.key(product_id))
+                await _bump_catalog_version()
     except Exception as e:
         Logger.error(f'Ошибка при обращении к delete_product: {e}')
         raise e
 
 
+# Взаимодействие с фотографиями товаров
+@cached('photo_file_id:{photo_path}', ttl=None, negative_ttl=300)
+async def get_photo_file_id(photo_path: str) -> Optional[str]:
+    """
+    Возвращает file_id фотографии, уже загруженной в Telegram, чтобы не отправлять файл повторно
+    """
+    try:
+        async with read_session(f'photo:{photo_path}') as session:
+            return await session.scalar(select(Photo.file_id).where(Photo.path == photo_path))
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_photo_file_id: {e}')
+        raise e
+
+
+async def get_photo_file_ids(photo_paths: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Возвращает file_id нескольких фотографий: одним MGET из Redis и одним запросом WHERE path IN (...)
+    для промахов, которые записываются обратно в кеш (отсутствующие - как отрицательный результат)
+    """
+    try:
+        photo_paths = list(dict.fromkeys(photo_paths))
+        if not photo_paths:
+            return {}
+
+        file_ids = {}
+        cached_file_ids = await redis.mget([get_photo_file_id.key(photo_path) for photo_path in photo_paths])
+        for photo_path, file_id_json in zip(photo_paths, cached_file_ids):
+            if file_id_json == NEGATIVE:
+                file_ids[photo_path] = None
+            elif file_id_json:
+                file_ids[photo_path] = json.loads(file_id_json)
+
+        missing = [photo_path for photo_path in photo_paths if photo_path not in file_ids]
+        if missing:
+            async with read_session(*(f'photo:{photo_path}' for photo_path in missing)) as session:
+                result = await session.execute(select(Photo.path, Photo.file_id).where(Photo.path.in_(missing)))
+                loaded = dict(result.all())
+            async with redis.pipeline(transaction=False) as pipe:
+                for photo_path in missing:
+                    if photo_path in loaded:
+                        pipe.set(get_photo_file_id.key(photo_path), json.dumps(loaded[photo_path]))
+                    else:
+                        pipe.set(get_photo_file_id.key(photo_path), NEGATIVE, ex=300)
+                await pipe.execute()
+            file_ids.update({photo_path: loaded.get(photo_path) for photo_path in missing})
+        return file_ids
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_photo_file_ids: {e}')
+        raise e
+
+
+async def set_photo_file_id(photo_path: str, file_id: str) -> None:
+    """
+    Запоминает file_id, который Telegram вернул после отправки фотографии
+    """
+    try:
+        async with write_session(f'photo:{photo_path}') as session:
+            statement = _dialect_insert(session)(Photo).values(path=photo_path, file_id=file_id)
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[Photo.path],
+                set_={'file_id': statement.excluded.file_id}
+            ))
+            await session.commit()
+            await redis.set(get_photo_file_id.key(photo_path), json.dumps(file_id))
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к set_photo_file_id: {e}')
+        raise e
+
+
+async def delete_photo_file_id(photo_path: str) -> None:
+    """
+    Забывает file_id фотографии (например, если Telegram его больше не принимает)
+    """
+    try:
+        async with write_session(f'photo:{photo_path}') as session:
+            photo = await session.scalar(select(Photo).where(Photo.path == photo_path))
+            if photo:
+                await session.delete(photo)
+                await session.commit()
+            await get_photo_file_id.invalidate(photo_path)
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к delete_photo_file_id: {e}')
+        raise e
+
+
+# Прогрев кеша после деплоя: каталог и file_id фотографий загружаются из БД несколькими запросами
+# и пишутся в Redis пайплайнами, чтобы первые пользователи не шли в БД одновременно.
+# Запись через SET NX: ключи, которые уже есть в Redis, не перезаписываются
+WARMUP_CHUNK = int(os.getenv('WARMUP_CHUNK', 5000))
+
+
+def _warmup_ttl(ttl: int) -> int:
+    # Тот же разброс, что у декоратора cached, чтобы прогретые ключи не истекали одновременно
+    return int(ttl * (1 + random.uniform(0, 0.1)))
+
+
+async def warm_catalog_cache() -> int:
+    """
+    Кладет в Redis категории, списки товаров по категориям и карточки товаров.
+    Если каталог изменился во время загрузки, ничего не пишет (кеш заполнится при обращениях).
+    Возвращает количество товаров
+    """
+    try:
+        version = await redis.get(CATALOG_VERSION_KEY)
+        async with read_session('catalog') as session:
+            categories = [{'name': c.name, 'id': c.id} for c in await session.scalars(select(Category))]
+            products = list(await session.scalars(select(Product).order_by(Product.id)))
+        if await redis.get(CATALOG_VERSION_KEY) != version:
+            return 0
+
+        by_category = {category['id']: [] for category in categories}
+        for product in products:
+            by_category.setdefault(product.category_id, []).append(_product_to_dict(product))
+
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(get_categories.key(), json.dumps(categories), ex=_warmup_ttl(CATALOG_TTL), nx=True)
+            for category in categories:
+                pipe.set(get_categorie_id.key(category['name']), json.dumps(category['id']),
+                         ex=_warmup_ttl(CATALOG_TTL), nx=True)
+            for category_id, category_products in by_category.items():
+                pipe.set(get_products.key(category_id), json.dumps(category_products),
+                         ex=_warmup_ttl(CATALOG_TTL), nx=True)
+                for product in category_products:
+                    pipe.set(get_product.key(product['id']), json.dumps(product),
+                             ex=_warmup_ttl(CATALOG_TTL), nx=True)
+            await pipe.execute()
+        return len(products)
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к warm_catalog_cache: {e}')
+        raise e
+
+
+async def warm_photo_cache(chunk_size: int = WARMUP_CHUNK) -> int:
+    """
+    Кладет в Redis file_id всех фотографий, уже загруженных в Telegram, по пайплайну на пачку.
+    Возвращает количество фотографий
+    """
+    try:
+        loaded = 0
+        async with read_session() as session:
+            result = await session.stream(select(Photo.path, Photo.file_id).execution_options(yield_per=chunk_size))
+            async for chunk in result.partitions(chunk_size):
+                async with redis.pipeline(transaction=False) as pipe:
+                    for photo_path, file_id in chunk:
+                        pipe.set(get_photo_file_id.key(photo_path), json.dumps(file_id), nx=True)
+                    await pipe.execute()
+                loaded += len(chunk)
+        return loaded
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к warm_photo_cache: {e}')
+        raise e
+
+
+# Файлы в хранилище
+# Одна и та же фотография (ключ по хэшу содержимого) может использоваться несколькими товарами,
+# поэтому на каждый ключ ведется счетчик ссылок в stored_files, а удаляет файлы только сборщик мусора
+STORAGE_GC_INTERVAL = float(os.getenv('STORAGE_GC_INTERVAL', 3600))
+# Сколько файл без ссылок живет до удаления: защищает загрузки, которые еще не дошли до create_product
+STORAGE_GC_GRACE = float(os.getenv('STORAGE_GC_GRACE', 3600))
+STORAGE_GC_LOCK_KEY = 'storage_gc_lock'
+
+
+async def _acquire_files(session: AsyncSession, keys: Iterable[str]) -> None:
+    keys = [key for key in keys if key]
+    if not keys:
+        return
+    statement = _dialect_insert(session)(StoredFile).values([{'key': key, 'refcount': 1} for key in keys])
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[StoredFile.key],
+        set_={'refcount': StoredFile.refcount + 1, 'released': None}
+    ))
+
+
+async def _release_files(session: AsyncSession, keys: Iterable[str]) -> None:
+    keys = [key for key in keys if key]
+    if not keys:
+        return
+    await session.execute(
+        StoredFile.__table__.update()
+        .where(StoredFile.key.in_(keys))
+        .values(refcount=StoredFile.refcount - 1)
+    )
+    await session.execute(
+        StoredFile.__table__.update()
+        .where(StoredFile.key.in_(keys), StoredFile.refcount <= 0)
+        .values(released=_utcnow())
+    )
+
+
+async def collect_garbage(grace: float = STORAGE_GC_GRACE) -> List[str]:
+    """
+    Удаляет из хранилища файлы без ссылок: отпущенные товарами дольше grace секунд назад
+    и файлы-сироты с ключами по хэшу содержимого (например, от прерванных загрузок).
+    Остальные файлы папки хранилища не трогаются. Возвращает удаленные ключи
+    """
+    try:
+        cutoff = _utcnow() - timedelta(seconds=grace)
+        async with write_session() as session:
+            released = list(await session.scalars(
+                delete(StoredFile)
+                .where(StoredFile.refcount <= 0, StoredFile.released < cutoff)
+                .returning(StoredFile.key)
+            ))
+            referenced = set(await session.scalars(select(StoredFile.key)))
+            referenced.update(await session.scalars(select(Product.photo_path)))
+            await session.commit()
+
+        now = time.time()
+        orphans = [key async for key, modified in storage.keys()
+                   if is_content_key(key) and key not in referenced and now - modified > grace]
+
+        removed = sorted(set(released) | set(orphans))
+        for key in removed:
+            await storage.delete(key)
+
+        if removed:
+            async with write_session() as session:
+                await session.execute(delete(Photo).where(Photo.path.in_(removed)))
+                await session.commit()
+            await invalidate(*(get_photo_file_id.key(key) for key in removed))
+            Logger.info(f'Сборщик мусора удалил файлов: {len(removed)}')
+        return removed
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к collect_garbage: {e}')
+        raise e
+
+
+async def storage_gc(interval: float = STORAGE_GC_INTERVAL) -> None:
+    """
+    Фоновая задача сборки мусора в хранилище. Если ботов несколько, проход выполняет только
+    тот, кто взял блокировку в Redis
+    """
+    while True:
+        try:
+            # Блокировка не снимается и истекает сама, так что за интервал проходит только одна сборка
+            lock = redis.lock(STORAGE_GC_LOCK_KEY, timeout=max(interval, 60))
+            if await lock.acquire(blocking=False):
+                await collect_garbage()
+        except Exception:
+            pass  # уже залогировано, попробуем на следующем проходе
+        await asyncio.sleep(interval)
+
+
 # Взаимодействие с корзиной
-async def create_user_cart(user_id: int, product_id: int, quantity: int = 1) -> None:
+# Живая корзина хранится в Redis-хэше cart:{user_id} (product_id -> quantity), а в таблицу Cart
+# изменения попадают пачками через flush_carts. Поле _loaded отличает пустую корзину от непрогретой.
+CART_TTL = int(os.getenv('CART_TTL', 7 * 24 * 3600))
+CART_FLUSH_INTERVAL = float(os.getenv('CART_FLUSH_INTERVAL', 2))
+CART_FLUSH_BATCH = int(os.getenv('CART_FLUSH_BATCH', 500))
+DIRTY_CARTS_KEY = 'carts_dirty'
+# Пользователи, корзины которых БД отвергла (например, нет строки в users для внешнего ключа carts.user_id).
+# Корзина остается в Redis и снова попадет в очередь при следующем изменении
+CARTS_DEAD_KEY = 'carts_dead'
+
+_load_cart_script = redis.register_script("""
+if redis.call('HEXISTS', KEYS[1], '_loaded') == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], '_loaded', 1, unpack(ARGV))
+redis.call('EXPIRE', KEYS[1], %d)
+return 1
+""" % CART_TTL)
+
+
+async def increment_cart_item(user_id: int, product_id: int, quantity: int = 1) -> None:
     """
-    Создает новую запись в таблице Cart для указанного пользователя и товара.
+    Атомарно увеличивает количество товара в таблице Cart одним запросом
+    INSERT ... ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + :quantity
     """
     try:
-        async with session_maker() as session:
-            cart_item = Cart(user_id=user_id, product_id=product_id, quantity=quantity)
-            session.add(cart_item)
+        async with write_session(f'cart:{user_id}') as session:
+            statement = _dialect_insert(session)(Cart).values(user_id=user_id, product_id=int(product_id),
+                                                              quantity=quantity)
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[Cart.user_id, Cart.product_id],
+                set_={'quantity': Cart.quantity + statement.excluded.quantity}
+            ))
             await session.commit()
     except Exception as e:
-        Logger.error(f'Ошибка при обращении к create_user_cart: {e}')
+        Logger.error(f'Ошибка при обращении к increment_cart_item: {e}')
         raise e
 
 
+def _cart_key(user_id: int) -> str:
+    return f'cart:{user_id}'
+
+
+async def _ensure_cart_loaded(user_id: int) -> None:
+    """
+    Если корзины пользователя нет в Redis (холодный старт, вытеснение), восстанавливает её из таблицы Cart
+    """
+    if await redis.hexists(_cart_key(user_id), '_loaded'):
+        return
+
+    async with read_session(f'cart:{user_id}') as session:
+        rows = await session.execute(select(Cart.product_id, Cart.quantity).where(Cart.user_id == user_id))
+        mapping = []
+        for product_id, quantity in rows:
+            mapping.extend((product_id, quantity))
+    await _load_cart_script(keys=[_cart_key(user_id)], args=mapping)
+
+
+async def _change_cart(user_id: int, product_id: int, delta: Optional[int]) -> None:
+    """
+    Атомарно меняет корзину в Redis и помечает её для записи в БД.
+    delta=None удаляет товар из корзины
+    """
+    await _ensure_cart_loaded(user_id)
+    key = _cart_key(user_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        if delta is None:
+            pipe.hdel(key, int(product_id))
+        else:
+            pipe.hincrby(key, int(product_id), delta)
+        pipe.expire(key, CART_TTL)
+        pipe.sadd(DIRTY_CARTS_KEY, user_id)
+        await pipe.execute()
+
+
 async def add_product_to_cart(user_id: int, product_id: int):
     """
-    Увеличивает количество товара на единицу если есть корзина, иначе передает параметры функции для создания корзины
+    Увеличивает количество товара в корзине на единицу (без обращения к БД).
+    Если Redis недоступен, товар добавляется сразу в таблицу Cart атомарным upsert
     """
     try:
-        async with session_maker() as session:
-            cart = await session.scalar(select(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id))
-            if cart:
-                cart.quantity += 1
-            else:
-                await create_user_cart(user_id, product_id)
-            await session.commit()
+        try:
+            await _change_cart(user_id, product_id, 1)
+        except RedisConnectionError as e:
+            Logger.warning(f'Redis недоступен, добавляю товар в корзину напрямую в БД: {e}')
+            await increment_cart_item(user_id, product_id)
     except Exception as e:
         Logger.error(f'Ошибка при обращении к add_to_cart: {e}')
         raise e
 
 
-async def get_cart_product(user_id: int) -> List[Cart]:
+async def get_cart_product(user_id: int) -> List[dict]:
     """
-    Возвращает модель корзины пользователя, к которой можно обращаться по её данным
+    Возвращает содержимое корзины пользователя в виде списка {'product_id': ..., 'quantity': ...}
     """
     try:
-        cart = await redis.get(f'cart_for_user:{user_id}')
-        if not cart:
-            async with session_maker() as session:
-                cart = await session.scalars(select(Cart).where(Cart.user_id == user_id))
-                cart = cart.all()
-        return cart
+        await _ensure_cart_loaded(user_id)
+        cart = await redis.hgetall(_cart_key(user_id))
+        return [
+            {'product_id': int(product_id), 'quantity': int(quantity)}
+            for product_id, quantity in cart.items()
+            if product_id != b'_loaded' and int(quantity) > 0
+        ]
     except Exception as e:
         Logger.error(f"Ошибка при обращении к get_cart_product: {e}")
         raise e
 
 
+async def get_cart_summary(user_id: int) -> dict:
+    """
+    Возвращает корзину вместе с данными товаров, суммами по строкам и общей суммой:
+    {'items': [{'product_id', 'name', 'price', 'quantity', 'total'}, ...], 'total': ...}
+    Товары, которых уже нет в каталоге, пропускаются
+    """
+    try:
+        cart = await get_cart_product(user_id)
+        products = await get_products_by_ids([item['product_id'] for item in cart])
+
+        items = []
+        for item in cart:
+            product = products.get(item['product_id'])
+            if product:
+                items.append({
+                    'product_id': item['product_id'],
+                    'name': product['name'],
+                    'price': product['price'],
+                    'quantity': item['quantity'],
+                    'total': product['price'] * item['quantity']
+                })
+        return {'items': items, 'total': sum(item['total'] for item in items)}
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_cart_summary: {e}')
+        raise e
+
+
 async def delete_product_from_cart(user_id: int, product_id: int) -> None:
     """
     Удаляет продукт из корзины пользователя
     """
     try:
-        async with session_maker() as session:
-            query = await session.scalar(select(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id))
-            await session.delete(query)
-            await session.commit()
+        await _change_cart(user_id, product_id, None)
     except Exception as e:
         Logger.error(f'Ошибка при обращении к delete_product_from_cart: {e}')
-        raise e
\ No newline at end of file
+        raise e
+
+
+async def _write_carts(user_ids: List[int], rows: List[dict]) -> None:
+    async with write_session(*(f'cart:{user_id}' for user_id in user_ids)) as session:
+        # Товары могли удалить, пока они лежали в корзине - такие строки не пишем
+        product_ids = {row['product_id'] for row in rows}
+        existing = set(await session.scalars(select(Product.id).where(Product.id.in_(product_ids)))) \
+            if product_ids else set()
+        rows = [row for row in rows if row['product_id'] in existing]
+
+        await session.execute(
+            delete(Cart).where(Cart.user_id.in_(user_ids),
+                               tuple_(Cart.user_id, Cart.product_id).not_in(
+                                   [(row['user_id'], row['product_id']) for row in rows]))
+        )
+        if rows:
+            statement = _dialect_insert(session)(Cart).values(rows)
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[Cart.user_id, Cart.product_id],
+                set_={'quantity': statement.excluded.quantity}
+            ))
+        await session.commit()
+
+
+async def flush_carts(batch_size: int = CART_FLUSH_BATCH) -> int:
+    """
+    Переносит изменённые корзины из Redis в таблицу Cart одной транзакцией на пачку.
+    Если БД отвергла пачку из-за данных, корзины записываются по одной, а отвергнутые уходят
+    в carts_dead, чтобы одна плохая корзина не возвращала в очередь всю пачку.
+    Возвращает количество обработанных корзин
+    """
+    user_ids = [int(user_id) for user_id in await redis.spop(DIRTY_CARTS_KEY, batch_size) or []]
+    if not user_ids:
+        return 0
+
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(_cart_key(user_id))
+            carts = await pipe.execute()
+
+        rows = []
+        for user_id, cart in zip(user_ids, carts):
+            for product_id, quantity in cart.items():
+                if product_id != b'_loaded' and int(quantity) > 0:
+                    rows.append({'user_id': user_id, 'product_id': int(product_id), 'quantity': int(quantity)})
+
+        try:
+            await _write_carts(user_ids, rows)
+        except IntegrityError:
+            failed = []
+            for user_id in user_ids:
+                try:
+                    await _write_carts([user_id], [row for row in rows if row['user_id'] == user_id])
+                except IntegrityError as e:
+                    Logger.error(f'Корзина пользователя {user_id} не записана в БД: {e}')
+                    failed.append(user_id)
+            if failed:
+                await redis.sadd(CARTS_DEAD_KEY, *failed)
+        return len(user_ids)
+    except Exception as e:
+        await redis.sadd(DIRTY_CARTS_KEY, *user_ids)
+        Logger.error(f'Ошибка при обращении к flush_carts: {e}')
+        raise e
+
+
+async def cart_flusher(interval: float = CART_FLUSH_INTERVAL) -> None:
+    """
+    Фоновая задача, которая периодически сбрасывает изменённые корзины в БД
+    """
+    while True:
+        try:
+            while await flush_carts() == CART_FLUSH_BATCH:
+                pass
+        except Exception:
+            pass  # уже залогировано, корзины вернутся в очередь и запишутся в следующий раз
+        await asyncio.sleep(interval)
+
+
+# Вычитает заказанные количества из корзины один раз на заказ: метка KEYS[3] не дает вычесть повторно,
+# если обработчик outbox упадет после вычитания и возьмет событие снова
+_subtract_order_script = redis.register_script("""
+if not redis.call('SET', KEYS[3], 1, 'NX', 'EX', %d) then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+redis.call('EXPIRE', KEYS[1], %d)
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+""" % (CART_TTL, CART_TTL))
+
+
+async def subtract_order_from_cart(user_id: int, order_id: int, items: List[dict]) -> bool:
+    """
+    Убирает из корзины пользователя заказанные количества товаров: то, что пользователь добавил
+    после выставления счета, остается в корзине. Повторный вызов для того же заказа ничего не меняет.
+    Возвращает False, если заказ уже вычитался
+    """
+    try:
+        await _ensure_cart_loaded(user_id)
+        args = [user_id]
+        for item in items:
+            args.extend((int(item['product_id']), int(item['quantity'])))
+        return bool(await _subtract_order_script(
+            keys=[_cart_key(user_id), DIRTY_CARTS_KEY, f'cart_order_subtracted:{order_id}'], args=args))
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к subtract_order_from_cart: {e}')
+        raise e
+
+
+# Заказы и оплаты
+# Хендлер оплаты одной транзакцией пишет заказ и событие в таблицу outbox и сразу отвечает пользователю,
+# а всё остальное (очистка корзины, сообщение на кухню, смена статуса) делает фоновый обработчик outbox
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', 50))
+# На сколько секунд событие закрепляется за обработчиком: если он упадет, событие заберут повторно
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 60))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+# Сколько секунд хранится снимок корзины выставленного счета: заказ собирается из него,
+# а не из корзины в момент оплаты, которую пользователь мог изменить после выставления счета
+INVOICE_TTL = int(os.getenv('INVOICE_TTL', 24 * 3600))
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', 5))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', 600))
+
+# Будит обработчик outbox в этом процессе сразу после записи нового события
+outbox_ready = asyncio.Event()
+
+
+def _invoice_key(payload: str) -> str:
+    return f'invoice:{payload}'
+
+
+async def create_invoice(user_id: int, delivery_method: Optional[str] = None, payment_method: Optional[str] = None,
+                         address: Optional[str] = None) -> Optional[dict]:
+    """
+    Снимает корзину пользователя для счета и сохраняет снимок в Redis под уникальным payload счета.
+    Возвращает снимок {'payload', 'user_id', 'items', 'total', ...} или None, если корзина пуста
+    """
+    try:
+        cart = await get_cart_summary(user_id)
+        if not cart['items']:
+            return None
+        invoice = {
+            'payload': f'order_{user_id}_{uuid.uuid4().hex}',
+            'user_id': user_id,
+            'items': cart['items'],
+            'total': cart['total'],
+            'delivery_method': delivery_method,
+            'payment_method': payment_method,
+            'address': address,
+        }
+        await redis.set(_invoice_key(invoice['payload']), json.dumps(invoice), ex=INVOICE_TTL)
+        return invoice
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к create_invoice: {e}')
+        raise e
+
+
+async def get_invoice(payload: str) -> Optional[dict]:
+    """
+    Возвращает снимок корзины выставленного счета по его payload или None, если счета нет или он истек
+    """
+    try:
+        invoice = await redis.get(_invoice_key(payload))
+        return json.loads(invoice) if invoice else None
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_invoice: {e}')
+        raise e
+
+
+async def create_paid_order(user_id: int, items: List[dict], payment: dict, delivery_method: Optional[str] = None,
+                            payment_method: Optional[str] = None, address: Optional[str] = None) -> int:
+    """
+    Сохраняет оплаченный заказ (позиции, платеж) и событие order_paid в outbox одной транзакцией.
+    items - позиции снимка счета (create_invoice), payment - данные SuccessfulPayment.
+    Повторное сообщение о той же оплате не создает второй заказ. Возвращает айди заказа
+    """
+    try:
+        async with write_session() as session:
+            order = Order(
+                user_id=user_id,
+                status='paid',
+                total=payment['total_amount'] // 100,
+                delivery_method=delivery_method,
+                payment_method=payment_method,
+                address=address,
+                items=[OrderItem(product_id=item['product_id'], name=item['name'], price=item['price'],
+                                 quantity=item['quantity']) for item in items],
+                payment=Payment(**payment),
+            )
+            session.add(order)
+            await session.flush()
+            session.add(OutboxEvent(event_type='order_paid', payload=json.dumps({'order_id': order.id}),
+                                    available_at=_utcnow()))
+            await session.commit()
+            outbox_ready.set()
+            return order.id
+    except IntegrityError as e:
+        # Повтор той же оплаты упирается в уникальный telegram_payment_charge_id: возвращаем уже созданный заказ.
+        # Любое другое нарушение ограничений - ошибка, заказ не сохранен
+        async with write_session() as session:
+            order_id = await session.scalar(select(Payment.order_id).where(
+                Payment.telegram_payment_charge_id == payment['telegram_payment_charge_id']))
+        if order_id is None:
+            Logger.error(f'Ошибка при обращении к create_paid_order: {e}')
+            raise e
+        return order_id
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к create_paid_order: {e}')
+        raise e
+
+
+async def get_order(order_id: int) -> Optional[dict]:
+    """
+    Возвращает заказ с позициями в виде словаря или None.
+    Читается из основной БД: событие outbox о заказе приходит раньше, чем заказ доезжает до реплики
+    """
+    try:
+        async with write_session() as session:
+            order = await session.get(Order, order_id)
+            if order is None:
+                return None
+            items = await session.scalars(select(OrderItem).where(OrderItem.order_id == order_id))
+            return {
+                'id': order.id,
+                'user_id': order.user_id,
+                'status': order.status,
+                'total': order.total,
+                'delivery_method': order.delivery_method,
+                'payment_method': order.payment_method,
+                'address': order.address,
+                'items': [{'product_id': item.product_id, 'name': item.name, 'price': item.price,
+                           'quantity': item.quantity} for item in items],
+            }
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к get_order: {e}')
+        raise e
+
+
+async def set_order_status(order_id: int, status: str) -> None:
+    try:
+        async with write_session() as session:
+            await session.execute(update(Order).where(Order.id == order_id).values(status=status))
+            await session.commit()
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к set_order_status: {e}')
+        raise e
+
+
+async def claim_outbox_events(batch_size: int = OUTBOX_BATCH) -> List[dict]:
+    """
+    Забирает пачку готовых к обработке событий и закрепляет их за собой на OUTBOX_LEASE секунд.
+    В PostgreSQL строки, уже забранные другим обработчиком, пропускаются (SKIP LOCKED)
+    """
+    try:
+        now = _utcnow()
+        async with write_session() as session:
+            events = list(await session.scalars(
+                select(OutboxEvent)
+                .where(OutboxEvent.status == 'pending', OutboxEvent.available_at <= now)
+                # Порядок по индексу (status, available_at): сортировка по id заставляла читать всю таблицу
+                .order_by(OutboxEvent.available_at, OutboxEvent.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ))
+            if not events:
+                return []
+            await session.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_([event.id for event in events]))
+                .values(attempts=OutboxEvent.attempts + 1, available_at=now + timedelta(seconds=OUTBOX_LEASE))
+            )
+            await session.commit()
+            return [{'id': event.id, 'event_type': event.event_type, 'payload': json.loads(event.payload),
+                     'attempts': event.attempts + 1} for event in events]
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к claim_outbox_events: {e}')
+        raise e
+
+
+async def complete_outbox_event(event_id: int) -> None:
+    try:
+        async with write_session() as session:
+            await session.execute(update(OutboxEvent).where(OutboxEvent.id == event_id)
+                                  .values(status='done', last_error=None))
+            await session.commit()
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к complete_outbox_event: {e}')
+        raise e
+
+
+async def retry_outbox_event(event_id: int, attempts: int, error: str) -> None:
+    """
+    Откладывает событие с экспоненциальной задержкой, а после OUTBOX_MAX_ATTEMPTS попыток помечает его failed
+    """
+    try:
+        delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+        async with write_session() as session:
+            await session.execute(
+                update(OutboxEvent).where(OutboxEvent.id == event_id).values(
+                    status='failed' if attempts >= OUTBOX_MAX_ATTEMPTS else 'pending',
+                    available_at=_utcnow() + timedelta(seconds=delay),
+                    last_error=error[:1000],
+                )
+            )
+            await session.commit()
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к retry_outbox_event: {e}')
+        raise e
+
@@ -1,21 +1,23 @@
-import os
 from typing import Union
 
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, FSInputFile
-from aiogram.filters import Command
+from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
 
-from ..utils.keyboard_builder import get_inline_buttons
+from ..utils.keyboard_builder import (ADMIN_MENU, ADMIN_TO_MAIN, ADMIN_CANCEL, ADMIN_CATEGORY_ACTIONS,
+                                      ADMIN_PRODUCT_ACTIONS, ADMIN_BROADCAST_CONFIRM, get_categories_keyboard,
+                                      get_products_keyboard)
 from ..database.requests import create_categorie, get_categories, change_categorie, delete_categorie
-from ..database.requests import create_product, get_products, get_product, delete_product
+from ..database.requests import create_product, get_products, get_product, delete_product, set_photo_file_id
+from ..database.requests import count_users
 
 from ..utils.admin_checker import AdminChecker
-
-
-FOLDER = 'images'
+from ..utils.images import process_image, save_renditions
+from ..utils.storage import storage, stream_telegram_file
+from ..utils.broadcast import create_broadcast, start_broadcast, stop_broadcast, get_active_broadcasts
 
 admin = Router()
 admin.message.filter(F.chat.type == 'private', AdminChecker())
@@ -43,17 +45,20 @@ class AddProduct(StatesGroup):
     category_id = State()
     photo = State()
 
+class Broadcast(StatesGroup):
+    message = State()
+    confirm = State()
+
 
 # Старт
 @admin.callback_query(F.data == 'to main admin')
 @admin.message(Command('admin'))
 async def start(event: Union[Message, CallbackQuery]):
-    buttons = {"Категория": "category", "Товар": "product"}
     if isinstance(event, Message):
         await event.answer(
             f"Здравствуйте, администратор <b>{event.from_user.full_name}</b>, выберите раздел взаимодействия.\n"
             f"<i>Будьте аккуратны с изменениями, неправильное действие может плохо отразиться на работе пиццерии.</i>",
-            reply_markup=await get_inline_buttons(btns=buttons),
+            reply_markup=ADMIN_MENU,
             parse_mode='HTML'
         )
 
@@ -62,7 +67,7 @@ async def start(event: Union[Message, CallbackQuery]):
         await event.message.answer(
             f"Здравствуйте, администратор <b>{event.from_user.full_name}</b>, выберите раздел взаимодействия.\n"
             f"<i>Будьте аккуратны с изменениями, неправильное действие может плохо отразиться на работе пиццерии.</i>",
-            reply_markup=await get_inline_buttons(btns=buttons),
+            reply_markup=ADMIN_MENU,
             parse_mode='HTML'
         )
 
@@ -73,12 +78,7 @@ async def start(event: Union[Message, CallbackQuery]):
 async def _(callback: CallbackQuery):
     await callback.answer()
     await callback.message.edit_text("<b>Выберите действие</b>",
-                         reply_markup=await get_inline_buttons(
-                             btns={"Список категорий": 'list category',
-                                   "Добавить категорию": 'new category',
-                                   "Изменить категорию": 'change category',
-                                   "Удалить категорию": 'delete category',
-                                   "Отмена": 'to main admin'}),
+                         reply_markup=ADMIN_CATEGORY_ACTIONS,
                          parse_mode='HTML'
                                  )
 
@@ -87,10 +87,7 @@ async def _(callback: CallbackQuery):
 async def _(callback: CallbackQuery):
     await callback.answer()
     await callback.message.edit_text("<b>Выберите действие</b>",
-                         reply_markup=await get_inline_buttons(
-                             btns={"Список товаров": 'list product',
-                                   "Добавить товар": 'new product',
-                                   "Удалить товар": 'delete product'}),
+                         reply_markup=ADMIN_PRODUCT_ACTIONS,
                         parse_mode = 'HTML'
                                 )
 
@@ -104,7 +101,7 @@ async def _(callback: CallbackQuery):
         await callback.answer()
         result = '\n'.join(f'{index}. {category['name']}' for index, category in enumerate(categories, start=1))
         await callback.message.edit_text(f'Список категорий: <b>\n{result}</b>', parse_mode='HTML',
-                                         reply_markup=await get_inline_buttons(btns={'Отмена': 'to main admin'}))
+                                         reply_markup=ADMIN_CANCEL)
     else:
         await callback.answer("Категории отсутствуют ❗")
 
@@ -135,10 +132,9 @@ async def _(callback: CallbackQuery, state: FSMContext):
     categories = await get_categories()
     if categories:
         await callback.answer()
-        categories_buttons = {category["name"]: f'change_category_{category["id"]}' for category in categories}
         await state.set_state(ChangeCategory.category_id)
         await callback.message.answer("<b>Выберите категорию которую хотите изменить</b>",
-                             reply_markup=await get_inline_buttons(btns=categories_buttons),
+                             reply_markup=await get_categories_keyboard('change_category_'),
                              parse_mode='HTML')
     else:
         await callback.answer("Список категорий отсутствует, добавьте хотя бы одну категорию ❗")
@@ -160,11 +156,11 @@ async def _(message: Message, state: FSMContext):
     try:
         await change_categorie(data['category_id'], data['new_name'])
         await message.answer("<b>Категория успешно изменена</b> 👌", parse_mode='HTML',
-                             reply_markup=await get_inline_buttons(btns={"Отмена": 'to main admin'}))
+                             reply_markup=ADMIN_CANCEL)
         await state.clear()
     except Exception as e:
         await message.answer("<i>Произошла ошибка в ходе изменения категории</i>", parse_mode='HTML',
-                                reply_markup=await get_inline_buttons(btns={'Отмена': 'to main admin'}))
+                                reply_markup=ADMIN_CANCEL)
         await state.clear()
         raise e
 
@@ -175,9 +171,8 @@ async def _(callback: CallbackQuery):
     categories = await get_categories()
     if categories:
         await callback.answer()
-        categories_buttons = {category['name']: f'delete_category_{category['id']}' for category in categories}
         await callback.message.answer("<b>Выберите категорию которую хотите удалить</b>",
-                             reply_markup=await get_inline_buttons(btns=categories_buttons),
+                             reply_markup=await get_categories_keyboard('delete_category_'),
                              parse_mode='HTML')
     else:
         await callback.answer("<i>Список категорий отсутствует, добавьте хотя бы одну категорию</i>", parse_mode='HTML')
@@ -190,10 +185,10 @@ async def _(callback: CallbackQuery):
     try:
         await delete_categorie(data)
         await callback.message.edit_text("<b>Категория успешно удалена</b> 👌", parse_mode='HTML',
-                                         reply_markup=await get_inline_buttons(btns={'На главную': 'to main admin'}))
+                                         reply_markup=ADMIN_TO_MAIN)
     except Exception as e:
         await callback.message.edit_text("<i>Произошла ошибка в ходе удаления категории...</i>", parse_mode='HTML',
-                                         reply_markup=await get_inline_buttons(btns={'На главную': 'to main admin'}))
+                                         reply_markup=ADMIN_TO_MAIN)
         raise e
 
 
@@ -203,10 +198,9 @@ async def _(callback: CallbackQuery):
     categories = await get_categories()
     if categories:
         await callback.answer()
-        categories_buttons = {category['name']: f'items_category_{category['id']}' for category in categories}
         await callback.message.answer(
             "<b>Выберите категорию товаров</b>",
-            reply_markup=await get_inline_buttons(btns=categories_buttons),
+            reply_markup=await get_categories_keyboard('items_category_'),
             parse_mode='HTML'
         )
     else:
@@ -231,10 +225,9 @@ async def _(callback: CallbackQuery, state: FSMContext):
     categories = await get_categories()
     if categories:
         await callback.answer()
-        categories_buttons = {category['name']: f'choose_category:{category['id']}' for category in categories}
         await state.set_state(AddProduct.category_id)
         await callback.message.edit_text("<b>Выберите категорию в которую хотите добавить товар</b>",
-                             reply_markup=await get_inline_buttons(btns=categories_buttons),
+                             reply_markup=await get_categories_keyboard('choose_category:'),
                              parse_mode='HTML'
                              )
     else:
@@ -276,33 +269,38 @@ async def _(message: Message, state: FSMContext, bot: Bot):
     try:
         await message.answer("<i>Данные приняты, создаю товар...</i> ⏳", parse_mode='HTML')
 
-        file_id = message.photo[-1].file_id
-        file_info = await bot.get_file(file_id)
-        file_path = file_info.file_path
-        downloaded_file = await bot.download_file(file_path)
+        file_info = await bot.get_file(message.photo[-1].file_id)
+        original_key = await storage.save_stream(stream_telegram_file(bot, file_info.file_path), 'jpg')
 
-        os.makedirs(FOLDER, exist_ok=True)
-        photo_path = f'{FOLDER}/{message.photo[-1].file_unique_id}.jpg'
-        with open(photo_path, 'wb') as f:
-            f.write(downloaded_file.read())
+        try:
+            renditions = await process_image(storage.local_path(original_key) or await storage.read(original_key))
+        except ValueError as e:
+            await message.answer(f"<i>{e}</i>\n<i>Отправьте другую фотографию товара</i>", parse_mode='HTML')
+            return
+        saved = await save_renditions(renditions, original_key)
+        photo_path = saved['full']['path']
 
         data = await state.get_data()
         name = data.get('name', 'N/A')
         des = data.get('description', 'N/A')
         price = data.get('price', 'N/A')
         cat_id = data.get("category_id", 'N/A')
-        await create_product(name, des, int(price), int(cat_id), photo_path)
+        await create_product(name, des, int(price), int(cat_id), photo_path, renditions=list(saved.values()))
         answer = (
             f'Был успешно добавлен товар "{name}"\n'
             f'Описание: {des}\n'
             f'Цена: {price} RUB'
         )
-        await bot.send_photo(chat_id=message.from_user.id, caption=answer, photo=FSInputFile(photo_path),
-                             reply_markup=await get_inline_buttons(btns={'На главную': 'to main admin'}))
+        # Отправляем уже уменьшенную версию и запоминаем ее file_id, его и будут получать пользователи
+        sent = await bot.send_photo(chat_id=message.from_user.id, caption=answer,
+                                    photo=BufferedInputFile(renditions['full'].data,
+                                                             filename=f"photo.{renditions['full'].extension}"),
+                                    reply_markup=ADMIN_TO_MAIN)
+        await set_photo_file_id(photo_path, sent.photo[-1].file_id)
         await state.clear()
     except Exception as e:
         await message.answer(f"Произошла ошибка в ходе добавления товара.",
-                             reply_markup=await get_inline_buttons(btns={'На главную': 'to main admin'}))
+                             reply_markup=ADMIN_TO_MAIN)
         await state.clear()
         raise e
 
@@ -320,10 +318,9 @@ async def _(callback: CallbackQuery, state: FSMContext):
     if categories:
         await callback.answer()
         await state.set_state(DeleteProduct.category_id)
-        categories_buttons = {category['name']: f'choose_category_{category['id']}' for category in categories}
         await callback.message.edit_text(
             "<b>Выберите категорию товара</b>",
-            reply_markup=await get_inline_buttons(btns=categories_buttons),
+            reply_markup=await get_categories_keyboard('choose_category_'),
             parse_mode='HTML'
         )
     else:
@@ -336,9 +333,8 @@ async def _(callback: CallbackQuery, state: FSMContext):
     await state.update_data(category_id=int(category_id))
     products = await get_products(category_id)
     if products:
-        products_buttons = {product['name']: f'delete_product_{product['id']}' for product in products}
         await callback.message.answer("<b>Выберите товар который хотите удалить</b>",
-                             reply_markup=await get_inline_buttons(btns=products_buttons)
+                             reply_markup=await get_products_keyboard(category_id, 'delete_product_')
                              )
     else:
         await callback.answer("Список категорий отсутствует, добавьте хотя бы одну категорию")
@@ -353,11 +349,52 @@ async def _(callback: CallbackQuery, state: FSMContext):
     try:
         await delete_product(product_id, category_id)
         await callback.message.answer(f'<b>Товар "{product['name']}" успешно удалён</b>', parse_mode='HTML',
-                                      reply_markup=await get_inline_buttons(btns={'На главную': 'to main admin'}))
+                                      reply_markup=ADMIN_TO_MAIN)
     except Exception as e:
         await callback.message.answer("<i>В ходе удаления товара возникла ошибка, обратитесь к разработчику</i>",
                                       parse_mode='HTML',
-                                      reply_markup=await get_inline_buttons(btns={'На главную': 'to main admin'}))
+                                      reply_markup=ADMIN_TO_MAIN)
         raise e
 
 
+
+
+# Рассылка
+@admin.message(Command('broadcast'))
+async def _(message: Message, state: FSMContext):
+    await state.set_state(Broadcast.message)
+    await message.answer("<b>Отправьте сообщение для рассылки</b>\n"
+                         "<i>Его копию получат все пользователи бота: текст, фото с подписью и т.д.</i>",
+                         parse_mode='HTML', reply_markup=ADMIN_CANCEL)
+
+
+@admin.message(Broadcast.message)
+async def _(message: Message, state: FSMContext):
+    await state.update_data(message_id=message.message_id)
+    await state.set_state(Broadcast.confirm)
+    await message.reply(f"Сообщение получат пользователей: <b>{await count_users()}</b>. Начать рассылку?",
+                        parse_mode='HTML', reply_markup=ADMIN_BROADCAST_CONFIRM)
+
+
+@admin.callback_query(Broadcast.confirm, F.data == 'start broadcast')
+async def _(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    data = await state.get_data()
+    await state.clear()
+    await callback.answer()
+    await callback.message.edit_text("<b>Рассылка запускается...</b>", parse_mode='HTML')
+    broadcast_id = await create_broadcast(callback.message.chat.id, data['message_id'],
+                                          callback.message.message_id)
+    start_broadcast(bot, broadcast_id)
+
+
+@admin.message(Command('broadcast_stop'))
+async def _(message: Message, command: CommandObject):
+    if command.args and command.args.strip().isdigit():
+        broadcast_ids = [int(command.args)]
+    else:
+        broadcast_ids = await get_active_broadcasts()
+    stopped = [str(broadcast_id) for broadcast_id in broadcast_ids if await stop_broadcast(broadcast_id)]
+    if stopped:
+        await message.answer(f"Рассылки остановлены: <b>{', '.join(stopped)}</b>", parse_mode='HTML')
+    else:
+        await message.answer("Активных рассылок нет")
@@ -3,24 +3,27 @@ from typing import Union
 
 from aiogram import Router, F, Bot
 from aiogram.enums import ContentType
-from aiogram.types import Message, CallbackQuery, InputMediaPhoto, FSInputFile, LabeledPrice, PreCheckoutQuery, \
-    SuccessfulPayment
+from aiogram.types import (Message, CallbackQuery, InputMediaPhoto, LabeledPrice, PreCheckoutQuery, InlineQuery,
+                           InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent)
 from aiogram.filters import CommandStart
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
-from ..utils.keyboard_builder import (get_inline_buttons, get_products_pagination,
-                                      get_delivery_options_keyboard, get_confirm_order)
-from ..database.requests import (get_categories, get_products, get_product,
-                                 add_product_to_cart, get_cart_product, delete_product_from_cart)
+from ..utils.keyboard_builder import (MAIN_MENU, TO_MAIN, CART_ACTIONS, DELIVERY_METHODS, DELIVERY_PAYMENT_METHODS,
+                                      PICKUP_PAYMENT_METHODS, DELIVERY_OPTIONS, CONFIRM_ORDER, get_inline_buttons,
+                                      get_categories_keyboard, get_products_pagination, get_product_card_keyboard)
+from ..database.requests import (get_products, get_catalog_version, get_photo_file_ids,
+                                 add_product_to_cart, get_cart_summary, delete_product_from_cart, create_paid_order,
+                                 create_invoice, get_invoice)
+from ..utils.logger import Logger
+from ..utils.photos import send_cached_photo
+from ..utils.search import SEARCH_LIMIT, SEARCH_CACHE_TIME, search_products
 
 
 user = Router()
 
 class UserChoose(StatesGroup):
     choose_category = State()
-    products_data = State()
-    page_product = State()
 
 
 class PlaceAnOrder(StatesGroup):
@@ -36,14 +39,12 @@ class PlaceAnOrder(StatesGroup):
 @user.callback_query(F.data == 'to main')
 @user.message(CommandStart())
 async def start(event: Union[Message, CallbackQuery]):
-    buttons = {"Меню 📖": 'menu', "Корзина 🗑": 'cart', "Наши адреса 🏪": 'my_address', "О нас 📑": "about_us"}
-
     if isinstance(event, Message):
         await event.answer(
             f'Здравствуйте, <b>{event.from_user.full_name}</b> 🖐. \n'
             f'Я бот пиццерии "Название", благодаря мне Вы сможете удобно и быстро заказать пиццу!\n'
             "Выберите, что Вас интересует",
-            reply_markup=await get_inline_buttons(btns=buttons)
+            reply_markup=MAIN_MENU
         )
     else:
         await event.answer()
@@ -51,20 +52,18 @@ async def start(event: Union[Message, CallbackQuery]):
             f'Здравствуйте, <b>{event.from_user.full_name}</b> 🖐. \n'
             f'Я бот пиццерии "Название", благодаря мне Вы сможете удобно и быстро заказать пиццу!\n'
             "Выберите, что Вас интересует",
-            reply_markup=await get_inline_buttons(btns=buttons)
+            reply_markup=MAIN_MENU
         )
 
 
 
 @user.callback_query(F.data == 'menu')
 async def _(callback: CallbackQuery, state: FSMContext):
-    categories = await get_categories()
-    categories_buttons = {category.name: f'category_{category.id}' for category in categories}
     await state.set_state(UserChoose.choose_category)
     await callback.answer()
     await callback.message.answer(
         "Выберите категорию пицц",
-        reply_markup=await get_inline_buttons(btns=categories_buttons)
+        reply_markup=await get_categories_keyboard('category_')
     )
 
 
@@ -77,51 +76,51 @@ async def _(callback: CallbackQuery):
                                   '<b>Адрес 1</b>\n'
                                   '<b>Адрес 2</b>\n'
                                   '<b>Адрес N..</b>',
-                                  reply_markup=await get_inline_buttons(btns={"На главную 🔙": 'to main'}),
+                                  reply_markup=TO_MAIN,
                                   parse_mode='HTML')
 
 @user.callback_query(F.data == 'about_us')
 async def _(callback: CallbackQuery):
     await callback.answer()
     await callback.message.answer('<i>Тут должно быть описание заведения...</i>',
-                                  reply_markup=await get_inline_buttons(btns={"На главную 🔙": 'to main'}),
+                                  reply_markup=TO_MAIN,
                                   parse_mode='HTML')
 
 
 
-@user.callback_query(F.data.startswith('category_'))
-async def _(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    data = callback.data.split('_')[1]
-
-    await state.update_data(choose_category=data)
-
-    products = await get_products(data)
-    products_data = [(product.name, product.id, product.description, product.price, product.photo_path) for product in products]
-    await state.update_data(products_data=products_data)
+async def get_product_page(category_id: int, page: int) -> tuple:
+    """
+    Возвращает (товары категории, номер страницы в допустимых пределах) из общего кеша каталога
+    """
+    products = await get_products(category_id)
+    return products, min(max(page, 0), max(len(products) - 1, 0))
 
-    data = await state.get_data()
-    page = data.get("page_product", 0)
 
-    if products_data:
-        name, _, description, price, photo_path = products_data[page]
-        if not os.path.exists(photo_path):
-            await callback.answer("Произошла ошибка, не найдена фотография ❗", show_alert=True)
-            await state.clear()
-            return
+@user.callback_query(F.data.startswith('category_'))
+async def _(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    category_id = int(callback.data.split('_')[1])
+    products, page = await get_product_page(category_id, 0)
+
+    if products:
+        # В состоянии только ссылка на страницу каталога, сами товары берутся из кеша
+        await state.update_data(category=category_id, catalog_version=await get_catalog_version(), page=page)
+        product = products[page]
+        keyboard = await get_products_pagination(category_id, page)
         try:
-            await bot.send_photo(
-                chat_id=callback.from_user.id,
-                photo=FSInputFile(photo_path),
-                caption=f"{name}\n{description}\nЦена: {price} руб.",
-                reply_markup=await get_products_pagination(btns=products_data, page=0),
-                parse_mode='HTML'
+            await send_cached_photo(
+                product['photo_path'],
+                lambda photo: bot.send_photo(
+                    chat_id=callback.from_user.id,
+                    photo=photo,
+                    caption=f"{product['name']}\n{product['description']}\nЦена: {product['price']} руб.",
+                    reply_markup=keyboard,
+                    parse_mode='HTML'
+                )
             )
             await callback.answer("Выберите пиццу из категории")
-            await callback.answer()
-        except FileNotFoundError as e:
-            await callback.answer("Извините, вышла ошибка: Изображение товара не найдено ❗", show_alert=True)
+        except FileNotFoundError:
+            await callback.answer("Произошла ошибка, не найдена фотография ❗", show_alert=True)
             await state.clear()
-            raise e
         except Exception as e:
             await state.clear()
             raise e
@@ -131,6 +130,37 @@ async def _(callback: CallbackQuery, state: FSMContext, bot: Bot):
         await callback.answer()
 
 
+@user.inline_query()
+async def _(inline_query: InlineQuery):
+    """
+    Inline-поиск товаров (@bot маргарита): карточки с фотографией по сохраненному file_id
+    и кнопкой добавления в корзину. Выдача одинакова для всех, поэтому Telegram кеширует ее на cache_time
+    """
+    offset = int(inline_query.offset or 0)
+    products = (await search_products(inline_query.query, offset + SEARCH_LIMIT))[offset:]
+    file_ids = await get_photo_file_ids([product['photo_path'] for product in products])
+
+    results = []
+    for product in products:
+        caption = f"{product['name']}\n{product['description']}\nЦена: {product['price']} руб."
+        keyboard = get_product_card_keyboard(product['id'])
+        file_id = file_ids.get(product['photo_path'])
+        if file_id:
+            results.append(InlineQueryResultCachedPhoto(id=str(product['id']), photo_file_id=file_id,
+                                                        title=product['name'], description=product['description'],
+                                                        caption=caption, reply_markup=keyboard))
+        else:
+            # Фотография еще ни разу не отправлялась в Telegram, file_id нет - карточка без фото
+            results.append(InlineQueryResultArticle(id=str(product['id']), title=product['name'],
+                                                    description=f"{product['price']} руб. {product['description']}",
+                                                    input_message_content=InputTextMessageContent(
+                                                        message_text=caption),
+                                                    reply_markup=keyboard))
+
+    await inline_query.answer(results, cache_time=SEARCH_CACHE_TIME, is_personal=False,
+                              next_offset=str(offset + SEARCH_LIMIT) if len(products) == SEARCH_LIMIT else '')
+
+
 @user.callback_query(F.data.startswith('product_'))
 async def _(callback: CallbackQuery):
     data = callback.data.split('_')[1]
@@ -142,18 +172,38 @@ async def _(callback: CallbackQuery):
 async def _(callback: CallbackQuery, state: FSMContext):
     page = int(callback.data.split(':')[1])
     data = await state.get_data()
-    products_data = data.get("products_data", [])
-    await state.update_data(page_product=page)
+    category_id = data.get('category')
+
+    if category_id is None:
+        await callback.answer()
+        await callback.message.answer("<i>Извините, данные о товарах не найдены</i> ❗",
+                                      parse_mode='HTML',
+                                      reply_markup=TO_MAIN)
+        return
 
-    if products_data:
+    version = await get_catalog_version()
+    notice = None
+    if data.get('catalog_version') != version:
+        # Каталог изменился после открытия категории: номер страницы мог указывать на другой товар
+        page, notice = 0, "Каталог обновился, показываю категорию сначала"
+    products, page = await get_product_page(category_id, page)
+    await state.update_data(catalog_version=version, page=page)
+
+    if products:
         try:
-            name, _, description, price, photo_path = products_data[page]
-            await callback.message.edit_media(
-                media=InputMediaPhoto(media=FSInputFile(photo_path), caption=f'{name}\n{description}\nЦена: {price} руб.',
-                parse_mode = 'HTML'),
-                reply_markup=await get_products_pagination(btns=products_data, page=page),
+            product = products[page]
+            keyboard = await get_products_pagination(category_id, page)
+            await send_cached_photo(
+                product['photo_path'],
+                lambda photo: callback.message.edit_media(
+                    media=InputMediaPhoto(media=photo,
+                                          caption=f"{product['name']}\n{product['description']}\n"
+                                                  f"Цена: {product['price']} руб.",
+                                          parse_mode='HTML'),
+                    reply_markup=keyboard,
+                )
             )
-            await callback.answer()
+            await callback.answer(notice)
         except FileNotFoundError:
             await callback.message.answer(f"<i>Извините, вышла ошибка: Изображение для товара не найдено</i> ❗",
                                           parse_mode='HTML')
@@ -163,7 +213,7 @@ async def _(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         await callback.message.answer("<i>Извините, данные о товарах не найдены</i> ❗",
                                       parse_mode='HTML',
-                                      reply_markup=await get_inline_buttons(btns={"На главную 🔙": 'to main'}))
+                                      reply_markup=TO_MAIN)
 
 
 @user.callback_query(F.data == 'cart')
@@ -173,40 +223,31 @@ async def display_cart(callback: CallbackQuery, state: FSMContext):
 
 async def update_cart_message(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
-    sum_of_payment = 0
     user_id = callback.from_user.id
-    cart = await get_cart_product(user_id)
+    cart = await get_cart_summary(user_id)
 
-    if not cart:
+    if not cart['items']:
         await callback.message.edit_text("Ваша корзина пуста.",
-                                         reply_markup=await get_inline_buttons(btns={"На главную 🔙": 'to main'}))
+                                         reply_markup=TO_MAIN)
         return
 
     text = "🛒 Ваша корзина:\n"
-    for item in cart:
-        product = await get_product(item.product_id)
-        if product:
-            product_name = product.name
-            quantity = int(item.quantity)
-            payment = product.price * quantity
-            sum_of_payment += payment
-            text += f'🍕Товар: {product_name} - {quantity} шт. \n💰Сумма - {payment} руб.\n\n'
+    for item in cart['items']:
+        text += f'🍕Товар: {item["name"]} - {item["quantity"]} шт. \n💰Сумма - {item["total"]} руб.\n\n'
+    sum_of_payment = cart['total']
 
     await state.set_state(PlaceAnOrder.payment)
     await state.update_data(payment=sum_of_payment)
     text += f'💳Общая сумма к оплате: {sum_of_payment} руб.'
 
-    buttons = {'Перейти к оплате 💸': 'go to pay', 'Удалить товар ❌': 'choose_delete', "Отмена ❌": 'to main'}
-    await callback.message.edit_text(text, reply_markup=await get_inline_buttons(btns=buttons))
+    await callback.message.edit_text(text, reply_markup=CART_ACTIONS)
 
 
 
 @user.callback_query(F.data == 'go to pay')
 async def go_to_pay(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text("Выберите тип доставки...",
-                                  reply_markup=await get_inline_buttons(
-                                      btns={"Доставка 🛵": 'delivery', "Самовывоз 🚶": 'pickup',
-                                            "Отмена ❌": 'cancel_delete'}))
+                                  reply_markup=DELIVERY_METHODS)
     await state.set_state(PlaceAnOrder.delivery_method)
 
 
@@ -219,19 +260,16 @@ async def _(callback: CallbackQuery, state: FSMContext):
 @user.callback_query(F.data == 'choose_delete')
 async def _(callback: CallbackQuery):
     user_id = callback.from_user.id
-    cart = await get_cart_product(user_id)
+    cart = await get_cart_summary(user_id)
     text = "🛒 Выберите что хотите удалить:\n"
     keyboard = []
-    for item in cart:
-        product = await get_product(item.product_id)
-        if product:
-            product_name = product.name
-            keyboard.append([f'❌{product_name}', f'delete_product:{item.product_id}'])
+    for item in cart['items']:
+        keyboard.append([f'❌{item["name"]}', f'delete_product:{item["product_id"]}'])
 
     keyboard.append(["Отмена ❌", 'cancel_delete'])
 
 
-    await callback.message.edit_text(text, reply_markup=await get_inline_buttons(btns=dict(keyboard)))
+    await callback.message.edit_text(text, reply_markup=get_inline_buttons(btns=dict(keyboard)))
     await callback.answer()
 
 
@@ -255,8 +293,7 @@ async def _(callback: CallbackQuery, state: FSMContext):
     await state.update_data(delivery_method=callback.data)
     await state.set_state(PlaceAnOrder.payment_method)
     await callback.message.edit_text("Выберите способ оплаты",
-                         reply_markup=await get_inline_buttons(
-                             btns={"Онлайн картой 💳": 'online card', "Наличными курьеру 💰": 'cash to courier'}))
+                         reply_markup=DELIVERY_PAYMENT_METHODS)
 
 
 @user.callback_query(PlaceAnOrder.delivery_method, F.data == 'pickup')
@@ -264,8 +301,7 @@ async def _(callback: CallbackQuery, state: FSMContext):
     await state.update_data(delivery_method=callback.data)
     await state.set_state(PlaceAnOrder.payment_method)
     await callback.message.edit_text("Выберите способ оплаты",
-                         reply_markup=await get_inline_buttons(
-                             btns={"Онлайн картой 💳": 'online card', "Наличными в пиццерии 💰": 'cash in pizzeria'}))
+                         reply_markup=PICKUP_PAYMENT_METHODS)
 
 
 @user.callback_query(PlaceAnOrder.payment_method, F.data == 'online card')
@@ -274,7 +310,7 @@ async def _(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     if data['delivery_method'] == 'delivery':
         await callback.message.edit_text("Выберите способ указания адреса:",
-                             reply_markup=get_delivery_options_keyboard())
+                             reply_markup=DELIVERY_OPTIONS)
         await state.set_state(PlaceAnOrder.waiting_for_address_option)  # Ожидаем выбора опции адреса
     else:  # data["delivery_method"] == "Самовывоз"
         #Пропускаем запрос адреса и сразу переходим к подтверждению заказа
@@ -286,7 +322,7 @@ async def _(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     if data['delivery_method'] == 'delivery':
         await callback.message.edit_text("Выберите способ указания адреса:",
-                                         reply_markup=get_delivery_options_keyboard())
+                                         reply_markup=DELIVERY_OPTIONS)
         await state.set_state(PlaceAnOrder.waiting_for_address_option)  # Ожидаем выбора опции адреса
     else:  # data["delivery_method"] == "Самовывоз"
         # Пропускаем запрос адреса и сразу переходим к подтверждению заказа
@@ -343,12 +379,18 @@ async def display_order_confirmation(message: Message, state: FSMContext):
                          f"Способ оплаты: {payment_method}\n"
                          f"Адрес: {address}\n\n"
                          f"Если всё правильно, <b>подтвердите заказ</b>",
-                         parse_mode='HTML', reply_markup=get_confirm_order())
+                         parse_mode='HTML', reply_markup=CONFIRM_ORDER)
 
 
 @user.callback_query(F.data == 'confirm order')
 async def _(callback: CallbackQuery, bot: Bot, state: FSMContext):
     data = await state.get_data()
+    # Заказ соберется из этого снимка корзины: изменения корзины после выставления счета в него не попадут
+    invoice = await create_invoice(callback.from_user.id, delivery_method=data.get('delivery_method'),
+                                   payment_method=data.get('payment_method'), address=data.get('enter_address'))
+    if invoice is None:
+        await callback.answer("Корзина пуста, добавьте товары перед оплатой", show_alert=True)
+        return
     await callback.answer("Отлично, переходим к оплате... 💸")
     await bot.send_invoice(chat_id=callback.from_user.id,
                            title='Оплата заказа в пиццерии',
@@ -356,28 +398,50 @@ async def _(callback: CallbackQuery, bot: Bot, state: FSMContext):
                            provider_token=os.getenv('PAY_TOKEN'),
                            is_flexible=False,
                            currency='RUB',
-                           prices=[LabeledPrice(label='Оплата заказа', amount=int(data['payment']) * 100)],
+                           prices=[LabeledPrice(label='Оплата заказа', amount=invoice['total'] * 100)],
                            start_parameter='pay_order',
-                           payload=f'order_{callback.from_user.id}'
+                           payload=invoice['payload']
                            ) # 4242 4242 4242 4242
 
 
 @user.pre_checkout_query()
 async def _(pre_checkout_query: PreCheckoutQuery):
+    invoice = await get_invoice(pre_checkout_query.invoice_payload)
+    if invoice is None or invoice['total'] * 100 != pre_checkout_query.total_amount:
+        await pre_checkout_query.answer(ok=False, error_message="Счет устарел, оформите заказ заново")
+        return
     await pre_checkout_query.answer(ok=True)
 
 
 @user.message(F.content_type == ContentType.SUCCESSFUL_PAYMENT)
-async def _(message: Message):
+async def _(message: Message, state: FSMContext):
     payment_info = message.successful_payment
+    invoice = await get_invoice(payment_info.invoice_payload)
+    if (invoice is None or invoice['user_id'] != message.from_user.id
+            or invoice['total'] * 100 != payment_info.total_amount):
+        Logger.error(f'Оплата {payment_info.telegram_payment_charge_id} не совпадает со счетом '
+                     f'{payment_info.invoice_payload}: {payment_info.total_amount} {payment_info.currency}')
+        await message.answer("Оплата получена, но мы не смогли сверить её со счетом. "
+                             "Мы свяжемся с вами, чтобы уточнить заказ.")
+        return
+    # Здесь только запись заказа и события в outbox, кухню и корзину обработает фоновый outbox_worker
+    await create_paid_order(
+        user_id=message.from_user.id,
+        items=invoice['items'],
+        payment={
+            'telegram_payment_charge_id': payment_info.telegram_payment_charge_id,
+            'provider_payment_charge_id': payment_info.provider_payment_charge_id,
+            'currency': payment_info.currency,
+            'total_amount': payment_info.total_amount,
+            'invoice_payload': payment_info.invoice_payload,
+        },
+        delivery_method=invoice['delivery_method'],
+        payment_method=invoice['payment_method'],
+        address=invoice['address'],
+    )
+    await state.clear()
     await message.answer("Оплата прошла успешно ✅\nСтатус своего заказа вы можете посмотреть в главном меню.")
 
-    # Дополнительный код:
-    # 1. Добавить в меню кнопку просмотра статуса
-    # 2. Отсылать заказ после оплаты в чат
-    # 3. Сохранять информацию о транзакции в БД.
-
-
 
 @user.callback_query(F.data == 'cancel order')
 async def _(callback: CallbackQuery, state: FSMContext):
@@ -0,0 +1,292 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from dotenv import load_dotenv
+from redis.exceptions import ResponseError
+
+from .database.redis_connection import redis
+from .utils.logger import Logger
+from .utils.metrics import Counter
+from .webhook import WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+
+load_dotenv()
+
+# Апдейты раскладываются по STREAM_PARTITIONS потокам Redis по from_user.id, каждый поток читает
+# ровно один воркер. Апдейты одного пользователя обрабатываются строго по порядку, разных - параллельно.
+# Число партиций больше числа воркеров, чтобы воркеры можно было добавлять, не перекладывая данные
+STREAM_PARTITIONS = int(os.getenv('STREAM_PARTITIONS', 16))
+STREAM_WORKERS = int(os.getenv('STREAM_WORKERS', 2))
+STREAM_PREFIX = os.getenv('STREAM_PREFIX', 'updates')
+STREAM_GROUP = os.getenv('STREAM_GROUP', 'bot')
+# Приблизительная длина потока: обработанные записи обрезаются, запас на отставание воркеров
+STREAM_MAXLEN = int(os.getenv('STREAM_MAXLEN', 100_000))
+STREAM_BATCH = int(os.getenv('STREAM_BATCH', 100))
+STREAM_BLOCK_MS = int(os.getenv('STREAM_BLOCK_MS', 5000))
+# Сколько апдейтов одной партиции обрабатываются одновременно (апдейты, ждущие предыдущих того же пользователя, не в счет)
+STREAM_CONCURRENCY = int(os.getenv('STREAM_CONCURRENCY', 20))
+# Записи, которые чужой потребитель держит без подтверждения дольше этого (мс), забираются себе
+STREAM_CLAIM_IDLE_MS = int(os.getenv('STREAM_CLAIM_IDLE_MS', 60_000))
+STREAM_CLAIM_INTERVAL = float(os.getenv('STREAM_CLAIM_INTERVAL', 30))
+# polling - приемник сам забирает апдейты через getUpdates, webhook - принимает их HTTP сервером
+STREAM_RECEIVER = os.getenv('STREAM_RECEIVER', 'polling')
+# all - приемник и STREAM_WORKERS воркеров в одном запуске, receiver или worker (номер в WORKER_INDEX) - по отдельности
+STREAM_ROLE = os.getenv('STREAM_ROLE', 'all')
+
+stream_updates = Counter('bot_stream_updates_total', 'Апдейты в очереди Redis Streams', ('stage',))
+
+
+def stream_key(partition: int) -> str:
+    return f'{STREAM_PREFIX}:{partition}'
+
+
+def order_key(update: dict) -> int:
+    """
+    Айди пользователя (from), а если его нет - чата: апдейты с одним ключом обрабатываются по порядку
+    """
+    for value in update.values():
+        if isinstance(value, dict):
+            if isinstance(value.get('from'), dict):
+                return value['from']['id']
+            if isinstance(value.get('chat'), dict):
+                return value['chat']['id']
+    return 0
+
+
+def partition_for(update: dict, partitions: int = STREAM_PARTITIONS) -> int:
+    """
+    Партиция апдейта по айди пользователя (from), а если его нет - по айди чата
+    """
+    return abs(order_key(update)) % partitions
+
+
+def worker_partitions(index: int, workers: int = STREAM_WORKERS) -> List[int]:
+    return [partition for partition in range(STREAM_PARTITIONS) if partition % workers == index]
+
+
+async def enqueue_updates(updates: List[dict]) -> None:
+    """
+    Кладет сырые апдейты в потоки их партиций одним пайплайном
+    """
+    async with redis.pipeline(transaction=False) as pipe:
+        for update in updates:
+            pipe.xadd(stream_key(partition_for(update)), {'update': json.dumps(update, ensure_ascii=False)},
+                      maxlen=STREAM_MAXLEN, approximate=True)
+        await pipe.execute()
+    stream_updates.inc(len(updates), stage='enqueued')
+
+
+# Приемник
+async def receive_polling(bot: Bot, allowed_updates: Optional[List[str]] = None, timeout: int = 30) -> None:
+    """
+    Забирает апдейты через getUpdates и складывает в Redis. offset сдвигается только после записи в Redis,
+    поэтому при сбое Redis апдейты будут запрошены у Telegram повторно, а не потеряны
+    """
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates,
+                                            request_timeout=timeout + 10)
+            if updates:
+                await enqueue_updates([update.model_dump(mode='json', exclude_unset=True, by_alias=True)
+                                       for update in updates])
+                offset = updates[-1].update_id + 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            Logger.error(f'Ошибка приемника апдейтов: {e}')
+            await asyncio.sleep(1)
+
+
+def build_receiver_app(secret_token: Optional[str] = WEBHOOK_SECRET) -> web.Application:
+    """
+    aiohttp приложение приемника в режиме вебхука: апдейт сразу пишется в Redis, 200 - после записи
+    """
+    async def handle(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+            return web.Response(status=401)
+        await enqueue_updates([await request.json()])
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    return app
+
+
+async def receive_webhook(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> None:
+    runner = web.AppRunner(build_receiver_app())
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    Logger.info(f'Приемник апдейтов слушает http://{host}:{port}{WEBHOOK_PATH}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# Воркер
+async def _ensure_group(stream: str) -> None:
+    try:
+        await redis.xgroup_create(stream, STREAM_GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise e
+
+
+async def _recover(stream: str, consumer: str) -> List[Tuple[bytes, dict]]:
+    """
+    Записи, выданные, но не подтвержденные: свои (воркер упал до XACK) и зависшие у других
+    потребителей (например, после изменения числа воркеров). Свои записи возвращаются до чтения новых,
+    поэтому порядок сохраняется; чужие забираются только после STREAM_CLAIM_IDLE_MS простоя
+    и могут прийти позже более новых апдейтов того же пользователя
+    """
+    own = await redis.xreadgroup(STREAM_GROUP, consumer, {stream: '0'}, count=STREAM_BATCH)
+    entries = list(own[0][1]) if own else []
+    start = '0-0'
+    while True:
+        start, claimed, *_ = await redis.xautoclaim(stream, STREAM_GROUP, consumer, STREAM_CLAIM_IDLE_MS,
+                                                    start_id=start, count=STREAM_BATCH)
+        entries.extend(entry for entry in claimed if entry[1])
+        if start in (b'0-0', '0-0') or not claimed:
+            break
+    return sorted(entries, key=lambda entry: tuple(map(int, entry[0].split(b'-'))))
+
+
+async def _handle(bot: Bot, dp: Dispatcher, stream: str, entry_id: bytes, data: dict) -> None:
+    """
+    Обрабатывает запись и подтверждает ее. Ошибка хендлера не блокирует пользователя:
+    она логируется, а запись подтверждается, как в polling
+    """
+    try:
+        update = Update.model_validate(data, context={'bot': bot})
+        await dp.feed_update(bot, update)
+        stream_updates.inc(stage='processed')
+    except Exception as e:
+        stream_updates.inc(stage='failed')
+        Logger.exception(f'Ошибка при обработке апдейта {entry_id} из {stream}: {e}')
+    try:
+        await redis.xack(stream, STREAM_GROUP, entry_id)
+    except Exception as e:
+        # Запись останется неподтвержденной и придет повторно при следующем восстановлении
+        Logger.error(f'Ошибка при подтверждении апдейта {entry_id} из {stream}: {e}')
+
+
+async def _process(bot: Bot, dp: Dispatcher, stream: str, queue: asyncio.Queue, in_flight: set) -> None:
+    """
+    Раздает записи одной партиции по пользователям: у каждого пользователя с необработанными записями
+    своя очередь и одна задача, которая обрабатывает их строго по порядку. Слот из STREAM_CONCURRENCY
+    задача занимает только на время обработки записи, поэтому всплеск апдейтов одного пользователя
+    не занимает слоты остальных. Разобранных, но не обработанных записей не больше STREAM_BATCH
+    """
+    slots = asyncio.Semaphore(STREAM_CONCURRENCY)
+    backlog = asyncio.Semaphore(STREAM_BATCH)
+    lanes: Dict[int, Deque[Tuple[bytes, dict]]] = {}
+    tasks = set()
+
+    async def run_lane(key: int, lane: Deque[Tuple[bytes, dict]]) -> None:
+        try:
+            while lane:
+                entry_id, data = lane.popleft()
+                try:
+                    async with slots:
+                        await _handle(bot, dp, stream, entry_id, data)
+                finally:
+                    in_flight.discard((stream, entry_id))
+                    backlog.release()
+                    queue.task_done()
+        finally:
+            # Между проверкой пустой очереди и удалением нет await, поэтому новая запись не потеряется
+            del lanes[key]
+
+    try:
+        while True:
+            await backlog.acquire()
+            entry_id, fields = await queue.get()
+            try:
+                data = json.loads(fields[b'update'])
+                key = order_key(data)
+            except Exception:
+                data, key = {}, 0  # запись не разобрать: _handle залогирует ошибку и подтвердит ее
+            lane = lanes.get(key)
+            if lane is None:
+                lane = lanes[key] = deque()
+                task = asyncio.create_task(run_lane(key, lane))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            lane.append((entry_id, data))
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def consume_updates(bot: Bot, dp: Dispatcher, index: int, workers: int = STREAM_WORKERS) -> None:
+    """
+    Воркер index читает свои партиции одним блокирующим XREADGROUP и раскладывает записи
+    по очередям партиций, у каждой партиции свой обработчик
+    """
+    consumer = f'worker-{index}'
+    streams = [stream_key(partition) for partition in worker_partitions(index, workers)]
+    queues: Dict[str, asyncio.Queue] = {stream: asyncio.Queue(maxsize=STREAM_BATCH) for stream in streams}
+    # Записи (поток, айди), которые уже лежат в очередях или обрабатываются: повторное восстановление
+    # их пропускает. Айди уникальны только в пределах потока, поэтому ключ включает поток
+    in_flight = set()
+    processors = [asyncio.create_task(_process(bot, dp, stream, queue, in_flight))
+                  for stream, queue in queues.items()]
+
+    async def put(stream: str, entry: Tuple[bytes, dict]) -> bool:
+        if (stream, entry[0]) in in_flight:
+            return False
+        in_flight.add((stream, entry[0]))
+        await queues[stream].put(entry)
+        return True
+
+    Logger.info(f'Воркер {index}: партиции {", ".join(streams)}')
+    try:
+        for stream in streams:
+            await _ensure_group(stream)
+        recovered_at = 0.0
+        while True:
+            try:
+                if time.monotonic() - recovered_at > STREAM_CLAIM_INTERVAL:
+                    for stream in streams:
+                        for entry in await _recover(stream, consumer):
+                            if await put(stream, entry):
+                                stream_updates.inc(stage='redelivered')
+                    recovered_at = time.monotonic()
+                response = await redis.xreadgroup(STREAM_GROUP, consumer, {stream: '>' for stream in streams},
+                                                  count=STREAM_BATCH, block=STREAM_BLOCK_MS)
+            except Exception as e:
+                Logger.error(f'Ошибка при чтении очереди апдейтов: {e}')
+                await asyncio.sleep(1)
+                continue
+            for stream, entries in response or []:
+                stream = stream.decode() if isinstance(stream, bytes) else stream
+                for entry in entries:
+                    await put(stream, entry)
+    finally:
+        for processor in processors:
+            processor.cancel()
+        await asyncio.gather(*processors, return_exceptions=True)
+
+
+async def run_stream_worker(bot: Bot, dp: Dispatcher, index: int, workers: int = STREAM_WORKERS) -> None:
+    """
+    Запускает воркер с обычным жизненным циклом диспетчера (startup/shutdown хендлеры)
+    """
+    workflow_data = {'dispatcher': dp, 'bots': [bot], **dp.workflow_data}
+    await dp.emit_startup(bot=bot, **workflow_data)
+    try:
+        await consume_updates(bot, dp, index, workers)
+    finally:
+        try:
+            await dp.emit_shutdown(bot=bot, **workflow_data)
+        finally:
+            await bot.session.close()
@@ -0,0 +1,312 @@
+import asyncio
+import os
+import time
+from typing import Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from dotenv import load_dotenv
+from redis.exceptions import LockError
+
+from ..database.redis_connection import redis
+from ..database.requests import count_users, get_user_ids_after
+from .logger import Logger
+from .metrics import Counter
+from .scheduler import BACKGROUND, bot_api_priority
+
+load_dotenv()
+
+# Telegram пропускает около 30 сообщений в секунду на бота. Рассылка берет только часть этого лимита,
+# остальное остается на ответы пользователям, которые идут мимо ведра рассылки
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 20))
+BROADCAST_BURST = int(os.getenv('BROADCAST_BURST', 5))
+BROADCAST_BATCH = int(os.getenv('BROADCAST_BATCH', 500))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', 5))
+# Как часто обновлять сообщение с ходом рассылки у администратора, секунды
+BROADCAST_REPORT_INTERVAL = float(os.getenv('BROADCAST_REPORT_INTERVAL', 5))
+# Блокировка рассылки продлевается каждую треть этого времени, пока рассылка идет. По умолчанию -
+# с запасом на пачку: если процесс зависнет, другой подхватит рассылку не раньше, чем эта пачка могла бы кончиться
+BROADCAST_LOCK_TIMEOUT = float(os.getenv('BROADCAST_LOCK_TIMEOUT', max(60, 3 * BROADCAST_BATCH / BROADCAST_RATE)))
+
+BROADCAST_ID_KEY = 'broadcast:last_id'
+BROADCAST_ACTIVE_KEY = 'broadcast:active'
+BROADCAST_BUCKET_KEY = 'broadcast:bucket'
+# Пока ключ жив, рассылка не отправляет ничего: Telegram вернул retry_after
+BROADCAST_PAUSE_KEY = 'broadcast:pause'
+
+broadcast_messages = Counter('bot_broadcast_messages_total', 'Сообщения рассылок', ('result',))
+
+# Общее для всех процессов ведро: возвращает 0, если токен взят, иначе сколько миллисекунд подождать
+_take_token_script = redis.register_script("""
+local pause = redis.call('PTTL', KEYS[2])
+if pause > 0 then
+    return pause
+end
+
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return wait
+""")
+
+_tasks: Set[asyncio.Task] = set()
+
+
+def _key(broadcast_id: int, suffix: str = '') -> str:
+    return f'broadcast:{broadcast_id}{":" + suffix if suffix else ""}'
+
+
+async def _take_token() -> None:
+    while True:
+        wait = await _take_token_script(keys=[BROADCAST_BUCKET_KEY, BROADCAST_PAUSE_KEY],
+                                        args=[BROADCAST_RATE, BROADCAST_BURST])
+        if not wait:
+            return
+        await asyncio.sleep(wait / 1000)
+
+
+async def _pause(retry_after: float) -> None:
+    """
+    Останавливает рассылки во всех процессах на время, которое попросил Telegram
+    """
+    await redis.set(BROADCAST_PAUSE_KEY, 1, px=int(retry_after * 1000))
+    Logger.warning(f'Рассылка приостановлена Telegram на {retry_after} с')
+    await asyncio.sleep(retry_after)
+
+
+async def _deliver(bot: Bot, chat_id: int, from_chat_id: int, message_id: int) -> str:
+    """
+    Копирует сообщение рассылки одному получателю. Возвращает sent, blocked или failed
+    """
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await _take_token()
+        try:
+            await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+            return 'sent'
+        except TelegramRetryAfter as e:
+            await _pause(e.retry_after)
+        except TelegramForbiddenError:
+            return 'blocked'
+        except TelegramBadRequest:
+            return 'failed'
+        except Exception as e:
+            Logger.warning(f'Ошибка при отправке рассылки пользователю {chat_id}: {e}')
+            await asyncio.sleep(2 ** attempt)
+    return 'failed'
+
+
+async def create_broadcast(from_chat_id: int, message_id: int, progress_message_id: int) -> int:
+    """
+    Регистрирует рассылку копии сообщения from_chat_id/message_id всем пользователям.
+    Ход рассылки хранится в хэше broadcast:{id}, возвращает айди рассылки
+    """
+    try:
+        broadcast_id = await redis.incr(BROADCAST_ID_KEY)
+        await redis.hset(_key(broadcast_id), mapping={
+            'status': 'running', 'from_chat_id': from_chat_id, 'message_id': message_id,
+            'progress_message_id': progress_message_id, 'cursor': 0, 'total': await count_users(),
+            'sent': 0, 'blocked': 0, 'failed': 0, 'started': time.time(),
+        })
+        await redis.sadd(BROADCAST_ACTIVE_KEY, broadcast_id)
+        return broadcast_id
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к create_broadcast: {e}')
+        raise e
+
+
+async def get_broadcast(broadcast_id: int) -> Optional[dict]:
+    data = await redis.hgetall(_key(broadcast_id))
+    if not data:
+        return None
+    data = {key.decode(): value.decode() for key, value in data.items()}
+    for field in ('from_chat_id', 'message_id', 'progress_message_id', 'cursor', 'total', 'sent', 'blocked',
+                  'failed'):
+        data[field] = int(data[field])
+    data['started'] = float(data['started'])
+    data['id'] = broadcast_id
+    return data
+
+
+async def stop_broadcast(broadcast_id: int) -> bool:
+    """
+    Отменяет рассылку, процесс, который ее ведет, остановится после текущей пачки
+    """
+    if not await redis.srem(BROADCAST_ACTIVE_KEY, broadcast_id):
+        return False
+    await redis.hset(_key(broadcast_id), 'status', 'cancelled')
+    return True
+
+
+async def get_active_broadcasts() -> list:
+    return sorted(int(broadcast_id) for broadcast_id in await redis.smembers(BROADCAST_ACTIVE_KEY))
+
+
+def _processed(broadcast: dict) -> int:
+    return broadcast['sent'] + broadcast['blocked'] + broadcast['failed']
+
+
+def format_progress(broadcast: dict, rate: float) -> str:
+    done = _processed(broadcast)
+    status = {'running': 'идет', 'done': 'завершена', 'cancelled': 'отменена'}.get(broadcast['status'],
+                                                                                broadcast['status'])
+    text = (f'<b>Рассылка №{broadcast["id"]}</b> ({status})\n\n'
+            f'Обработано: {done} из {broadcast["total"]}\n'
+            f'Доставлено: {broadcast["sent"]}\n'
+            f'Заблокировали бота: {broadcast["blocked"]}\n'
+            f'Ошибки: {broadcast["failed"]}\n')
+    if broadcast['status'] == 'running':
+        left = max(broadcast['total'] - done, 0)
+        text += f'Скорость: {rate:.1f} сообщ./с'
+        if rate:
+            text += f', осталось ~{int(left / rate // 60)} мин.'
+    else:
+        text += f'Время: {int(time.time() - broadcast["started"])} с'
+    return text
+
+
+async def _show_progress(bot: Bot, broadcast: dict, rate: float) -> None:
+    try:
+        await bot.edit_message_text(format_progress(broadcast, rate), chat_id=broadcast['from_chat_id'],
+                                    message_id=broadcast['progress_message_id'], parse_mode='HTML')
+    except TelegramBadRequest:
+        pass  # сообщение не изменилось или удалено администратором
+
+
+async def _report(bot: Bot, broadcast_id: int, interval: float) -> None:
+    """
+    Обновляет у администратора сообщение с ходом рассылки и текущей скоростью доставки
+    """
+    broadcast = await get_broadcast(broadcast_id)
+    last_done, last_time = _processed(broadcast), time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            broadcast = await get_broadcast(broadcast_id)
+            done, now = _processed(broadcast), time.monotonic()
+            rate = (done - last_done) / (now - last_time)
+            last_done, last_time = done, now
+            await _show_progress(bot, broadcast, rate)
+        except Exception:
+            pass  # отчет не важнее самой рассылки, попробуем в следующий раз
+
+
+async def _keep_lock(lock, interval: float) -> None:
+    """
+    Продлевает блокировку рассылки, пока ее не отменят: пачка с паузами retry_after
+    может идти дольше времени жизни блокировки
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await lock.reacquire()
+        except LockError as e:
+            # Блокировка уже истекла: после пачки run_broadcast тоже не сможет ее продлить и остановится
+            Logger.error(f'Ошибка при продлении блокировки рассылки {lock.name}: {e}')
+            return
+        except Exception as e:
+            Logger.error(f'Ошибка при продлении блокировки рассылки {lock.name}: {e}')
+
+
+async def run_broadcast(bot: Bot, broadcast_id: int) -> None:
+    """
+    Ведет рассылку: берет пользователей пачками по возрастанию айди, отмечая каждого получателя
+    в Redis, а после пачки сдвигает курсор. После перезапуска рассылка продолжается с курсора
+    без повторной отправки уже получившим. Рассылку ведет только процесс, взявший блокировку
+    """
+    lock = redis.lock(_key(broadcast_id, 'lock'), timeout=BROADCAST_LOCK_TIMEOUT)
+    if not await lock.acquire(blocking=False):
+        return
+
+    # Сообщения рассылки уступают в очереди к Bot API ответам пользователям
+    bot_api_priority.set(BACKGROUND)
+
+    reporter = asyncio.create_task(_report(bot, broadcast_id, BROADCAST_REPORT_INTERVAL))
+    keeper = asyncio.create_task(_keep_lock(lock, BROADCAST_LOCK_TIMEOUT / 3))
+    try:
+        broadcast = await get_broadcast(broadcast_id)
+        cursor = broadcast['cursor']
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def send(chat_id: int) -> None:
+            async with semaphore:
+                result = await _deliver(bot, chat_id, broadcast['from_chat_id'], broadcast['message_id'])
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.sadd(_key(broadcast_id, 'done'), chat_id)
+                pipe.hincrby(_key(broadcast_id), result, 1)
+                await pipe.execute()
+            broadcast_messages.inc(result=result)
+
+        while await redis.hget(_key(broadcast_id), 'status') == b'running':
+            chat_ids = await get_user_ids_after(cursor, BROADCAST_BATCH)
+            if not chat_ids:
+                await redis.hset(_key(broadcast_id), 'status', 'done')
+                await redis.srem(BROADCAST_ACTIVE_KEY, broadcast_id)
+                break
+
+            # Получатели этой пачки, до которых рассылка дошла до перезапуска
+            delivered = {int(chat_id) for chat_id in await redis.smembers(_key(broadcast_id, 'done'))}
+            await asyncio.gather(*(send(chat_id) for chat_id in chat_ids if chat_id not in delivered))
+
+            cursor = chat_ids[-1]
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.hset(_key(broadcast_id), 'cursor', cursor)
+                pipe.delete(_key(broadcast_id, 'done'))
+                await pipe.execute()
+            await lock.reacquire()
+
+        broadcast = await get_broadcast(broadcast_id)
+        Logger.info(f'Рассылка {broadcast_id} остановлена со статусом {broadcast["status"]}: '
+                    f'доставлено {broadcast["sent"]}, заблокировали {broadcast["blocked"]}, '
+                    f'ошибок {broadcast["failed"]}')
+        await _show_progress(bot, broadcast, 0)
+    except Exception as e:
+        Logger.error(f'Ошибка при обращении к run_broadcast {broadcast_id}: {e}')
+        raise e
+    finally:
+        reporter.cancel()
+        keeper.cancel()
+        try:
+            await lock.release()
+        except LockError:
+            pass
+
+
+def start_broadcast(bot: Bot, broadcast_id: int) -> asyncio.Task:
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def resume_broadcasts(bot: Bot) -> None:
+    """
+    Продолжает незавершенные рассылки после перезапуска бота
+    """
+    for broadcast_id in await get_active_broadcasts():
+        Logger.info(f'Продолжаем рассылку {broadcast_id}')
+        start_broadcast(bot, broadcast_id)
+
+
+async def cancel_broadcast_tasks() -> None:
+    """
+    Прерывает рассылки этого процесса при остановке бота, они продолжатся при следующем запуске
+    """
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
@@ -0,0 +1,70 @@
+import functools
+import json
+import os
+
+from aiogram.fsm.storage.redis import RedisStorage
+from dotenv import load_dotenv
+
+from ..database.redis_connection import redis
+from .logger import Logger
+
+load_dotenv()
+
+# Срок жизни состояния и данных FSM в Redis, секунды (0 - бессрочно)
+FSM_TTL = int(os.getenv('FSM_TTL', 24 * 60 * 60))
+FSM_PREFIX = 'fsm'
+FSM_MIGRATION_KEY = 'fsm_migrated:compact_catalog_state'
+
+# Компактный JSON без пробелов и \u-экранирования кириллицы
+compact_dumps = functools.partial(json.dumps, ensure_ascii=False, separators=(',', ':'))
+
+
+def create_storage() -> RedisStorage:
+    return RedisStorage(redis=redis, state_ttl=FSM_TTL or None, data_ttl=FSM_TTL or None,
+                        json_dumps=compact_dumps)
+
+
+def _compact_state_data(data: dict) -> dict:
+    """
+    Переводит старые данные каталога (весь список товаров категории) в (категория, версия, страница)
+    """
+    data.pop('products_data', None)
+    category_id = data.pop('choose_category', None)
+    page = data.pop('page_product', None)
+    if category_id is not None and str(category_id).isdigit():
+        data.setdefault('category', int(category_id))
+        data.setdefault('catalog_version', -1)
+        data.setdefault('page', int(page or 0))
+    return data
+
+
+async def migrate_fsm_states(batch_size: int = 500) -> int:
+    """
+    Однократно переписывает сохраненные данные FSM в компактный вид и ставит ключам FSM срок жизни.
+    Выполняется один раз (отметка в Redis), возвращает количество переписанных ключей
+    """
+    try:
+        if not await redis.set(FSM_MIGRATION_KEY, 1, nx=True):
+            return 0
+
+        migrated = 0
+        async for key in redis.scan_iter(match=f'{FSM_PREFIX}:*', count=batch_size):
+            key = key.decode() if isinstance(key, bytes) else key
+            if key.endswith(':data'):
+                raw = await redis.get(key)
+                if raw is None:
+                    continue
+                data = json.loads(raw)
+                if 'products_data' in data or 'choose_category' in data or 'page_product' in data:
+                    data = _compact_state_data(data)
+                    await redis.set(key, compact_dumps(data), ex=FSM_TTL or None)
+                    migrated += 1
+                    continue
+            if FSM_TTL and key.endswith((':data', ':state')) and await redis.ttl(key) == -1:
+                await redis.expire(key, FSM_TTL)
+        Logger.info(f'Миграция FSM: переписано ключей {migrated}')
+        return migrated
+    except Exception as e:
+        await redis.delete(FSM_MIGRATION_KEY)
+        Logger.error(f'Ошибка при обращении к migrate_fsm_states: {e}')
+        raise e
@@ -0,0 +1,122 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+
+from .storage import storage
+
+load_dotenv()
+
+# Длинная сторона основной фотографии и превью, пиксели
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 1280))
+IMAGE_THUMB_EDGE = int(os.getenv('IMAGE_THUMB_EDGE', 320))
+# JPEG или WEBP
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 82))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', 20 * 1024 * 1024))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', min(2, os.cpu_count() or 1)))
+
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass
+class Rendition:
+    kind: str
+    data: Optional[bytes]
+    format: str
+    width: int
+    height: int
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+
+def _encode(image, image_format: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    if image_format == 'JPEG':
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, 'WEBP', quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def build_renditions(source: Union[bytes, str], max_edge: int = IMAGE_MAX_EDGE, thumb_edge: int = IMAGE_THUMB_EDGE,
+                     image_format: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY) -> Dict[str, Tuple]:
+    """
+    Проверяет изображение, поворачивает по EXIF и убирает метаданные, уменьшает до max_edge по длинной
+    стороне и перекодирует, а также делает превью. Выполняется в отдельном процессе, поэтому
+    возвращает простые кортежи (данные, формат, ширина, высота), а PIL импортируется здесь же.
+    source - содержимое файла или путь к нему (тогда файл читается уже в процессе-обработчике)
+    """
+    from PIL import Image, ImageOps
+    from ..database.admin_schemas import ImageProductSchema
+
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            data = f.read()
+    else:
+        data = source
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ValueError(f'Изображение больше {IMAGE_MAX_BYTES // (1024 * 1024)} МБ')
+    ImageProductSchema.validate_image(data)
+
+    with Image.open(BytesIO(data)) as original:
+        result = {'original': (None, original.format, *original.size)}
+        original.draft('RGB', (max_edge, max_edge))
+        # exif_transpose применяет поворот, а при сохранении без exif= метаданные не попадают в файл
+        image = ImageOps.exif_transpose(original).convert('RGB')
+
+    image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    result['full'] = (_encode(image, image_format, quality), image_format, *image.size)
+
+    image.thumbnail((thumb_edge, thumb_edge), Image.Resampling.LANCZOS)
+    result['thumb'] = (_encode(image, image_format, quality), image_format, *image.size)
+    return result
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def process_image(source: Union[bytes, str]) -> Dict[str, Rendition]:
+    """
+    Обрабатывает загруженную фотографию в пуле процессов, не блокируя цикл событий.
+    Возвращает основную версию, превью и описание оригинала (без данных).
+    При невалидном изображении выбрасывает ValueError
+    """
+    loop = asyncio.get_running_loop()
+    renditions = await loop.run_in_executor(get_executor(), build_renditions, source)
+    return {kind: Rendition(kind, *values) for kind, values in renditions.items()}
+
+
+async def save_renditions(renditions: Dict[str, Rendition], original_key: str) -> Dict[str, dict]:
+    """
+    Сохраняет версии фотографии в хранилище и возвращает их описание для БД.
+    Оригинал к этому моменту уже лежит в хранилище под ключом original_key
+    """
+    saved = {}
+    for kind, rendition in renditions.items():
+        if rendition.data is None:
+            key, size = original_key, None
+        else:
+            key, size = await storage.save(rendition.data, rendition.extension), len(rendition.data)
+        saved[kind] = {'kind': kind, 'path': key, 'format': rendition.format,
+                       'width': rendition.width, 'height': rendition.height, 'size': size}
+    return saved
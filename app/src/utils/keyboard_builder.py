@@ -1,10 +1,16 @@
+import os
+from typing import Awaitable, Callable
+
 from aiogram.types import (InlineKeyboardButton, KeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup,
                            ReplyKeyboardRemove)
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+from cachetools import LRUCache
+
+from ..database.requests import get_catalog_version, get_categories, get_products
 
 delete_kb = ReplyKeyboardRemove
 
-async def get_inline_buttons(
+def get_inline_buttons(
         *,
         btns: dict[str, str],
         sizes: tuple[int] = (2,)) -> InlineKeyboardMarkup:
@@ -16,32 +22,115 @@ async def get_inline_buttons(
     return keyboard.adjust(*sizes).as_markup()
 
 
-async def get_products_pagination(btns: list[tuple], page: int = 0, per_page: int = 1) -> InlineKeyboardMarkup:
-        try:
-            start_index = page * per_page
-            end_index = start_index + per_page
+# Постоянные клавиатуры собираются один раз при импорте и переиспользуются во всех ответах
+MAIN_MENU = get_inline_buttons(btns={"Меню 📖": 'menu', "Корзина 🗑": 'cart',
+                                     "Наши адреса 🏪": 'my_address', "О нас 📑": "about_us"})
+TO_MAIN = get_inline_buttons(btns={"На главную 🔙": 'to main'})
+CART_ACTIONS = get_inline_buttons(btns={'Перейти к оплате 💸': 'go to pay', 'Удалить товар ❌': 'choose_delete',
+                                        "Отмена ❌": 'to main'})
+DELIVERY_METHODS = get_inline_buttons(btns={"Доставка 🛵": 'delivery', "Самовывоз 🚶": 'pickup',
+                                            "Отмена ❌": 'cancel_delete'})
+DELIVERY_PAYMENT_METHODS = get_inline_buttons(btns={"Онлайн картой 💳": 'online card',
+                                                    "Наличными курьеру 💰": 'cash to courier'})
+PICKUP_PAYMENT_METHODS = get_inline_buttons(btns={"Онлайн картой 💳": 'online card',
+                                                  "Наличными в пиццерии 💰": 'cash in pizzeria'})
+
+ADMIN_MENU = get_inline_buttons(btns={"Категория": "category", "Товар": "product"})
+ADMIN_TO_MAIN = get_inline_buttons(btns={'На главную': 'to main admin'})
+ADMIN_CANCEL = get_inline_buttons(btns={'Отмена': 'to main admin'})
+ADMIN_CATEGORY_ACTIONS = get_inline_buttons(btns={"Список категорий": 'list category',
+                                                  "Добавить категорию": 'new category',
+                                                  "Изменить категорию": 'change category',
+                                                  "Удалить категорию": 'delete category',
+                                                  "Отмена": 'to main admin'})
+ADMIN_PRODUCT_ACTIONS = get_inline_buttons(btns={"Список товаров": 'list product',
+                                                 "Добавить товар": 'new product',
+                                                 "Удалить товар": 'delete product'})
+ADMIN_BROADCAST_CONFIRM = get_inline_buttons(btns={"Начать рассылку 📣": 'start broadcast',
+                                                   "Отмена": 'to main admin'})
+
+# Клавиатуры из каталога (списки категорий, листание товаров) кешируются по версии каталога:
+# при изменении каталога версия меняется и старые клавиатуры выбрасываются
+_catalog_keyboards = LRUCache(maxsize=int(os.getenv('KEYBOARD_CACHE_SIZE', 2048)))
+_catalog_keyboards_version = None
+
+
+async def _catalog_keyboard(key: tuple, build: Callable[[], Awaitable[InlineKeyboardMarkup]]) -> InlineKeyboardMarkup:
+    global _catalog_keyboards_version
+    version = await get_catalog_version()
+    if version != _catalog_keyboards_version:
+        _catalog_keyboards.clear()
+        _catalog_keyboards_version = version
+    keyboard = _catalog_keyboards.get(key)
+    if keyboard is None:
+        keyboard = await build()
+        if version == _catalog_keyboards_version:
+            _catalog_keyboards[key] = keyboard
+    return keyboard
+
+
+async def get_categories_keyboard(callback_prefix: str) -> InlineKeyboardMarkup:
+    """
+    Клавиатура со всеми категориями, callback_data - callback_prefix + айди категории
+    """
+    async def build() -> InlineKeyboardMarkup:
+        return get_inline_buttons(btns={category['name']: f'{callback_prefix}{category["id"]}'
+                                        for category in await get_categories()})
+
+    return await _catalog_keyboard(('categories', callback_prefix), build)
+
+
+async def get_products_keyboard(category_id: int, callback_prefix: str) -> InlineKeyboardMarkup:
+    """
+    Клавиатура со всеми товарами категории, callback_data - callback_prefix + айди товара
+    """
+    async def build() -> InlineKeyboardMarkup:
+        return get_inline_buttons(btns={product['name']: f'{callback_prefix}{product["id"]}'
+                                        for product in await get_products(category_id)})
+
+    return await _catalog_keyboard(('products', int(category_id), callback_prefix), build)
+
+
+def build_products_pagination(products: list[dict], page: int = 0, per_page: int = 1) -> InlineKeyboardMarkup:
+    start_index = page * per_page
+    end_index = start_index + per_page
 
-            keyboard = InlineKeyboardBuilder()
-            for name, product_id, _, _, _ in btns[start_index:end_index]:
-                keyboard.row(InlineKeyboardButton(text='Добавить в корзину', callback_data=f'product_{product_id}'))
+    keyboard = InlineKeyboardBuilder()
+    for product in products[start_index:end_index]:
+        keyboard.row(InlineKeyboardButton(text='Добавить в корзину', callback_data=f'product_{product["id"]}'))
+
+    previous_page = page > 0
+    next_page = end_index < len(products)
+
+    navigation_buttons = []
+
+    if previous_page:
+        navigation_buttons.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'page:{page - 1}'))
+
+    if next_page:
+        navigation_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"page:{page + 1}"))
+
+    if navigation_buttons:
+        keyboard.row(*navigation_buttons)
+    keyboard.row(InlineKeyboardButton(text='На главную 🔙', callback_data='to main'))
+    return keyboard.as_markup()
 
-            previous_page = page > 0
-            next_page = end_index < len(btns)
 
-            navigation_buttons = []
+def get_product_card_keyboard(product_id: int) -> InlineKeyboardMarkup:
+    """
+    Клавиатура карточки товара из inline-поиска
+    """
+    return get_inline_buttons(btns={'Добавить в корзину': f'product_{product_id}'})
 
-            if previous_page:
-                navigation_buttons.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'page:{page - 1}'))
 
-            if next_page:
-                navigation_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"page:{page + 1}"))
+async def get_products_pagination(category_id: int, page: int = 0, per_page: int = 1) -> InlineKeyboardMarkup:
+    """
+    Клавиатура листания товаров категории для страницы page
+    """
+    async def build() -> InlineKeyboardMarkup:
+        return build_products_pagination(await get_products(category_id), page, per_page)
 
-            if navigation_buttons:
-                keyboard.row(*navigation_buttons)
-            keyboard.row(InlineKeyboardButton(text='На главную 🔙', callback_data='to main'))
-            return keyboard.as_markup()
-        except Exception as e:
-            raise e
+    return await _catalog_keyboard(('pagination', int(category_id), page, per_page), build)
 
 
 async def get_reply_buttons(
@@ -81,30 +170,24 @@ async def get_reply_buttons(
         resize_keyboard=True, input_field_placeholder=placeholder)
 
 
-def get_delivery_options_keyboard():
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Указать адрес вручную 📝", callback_data='enter address manually')],
-                [InlineKeyboardButton(text="Отправить местоположение 📳", callback_data='send location', request_location=True),
-            ],
-            [
-                InlineKeyboardButton(text="Отмена ❌", callback_data='cancel_delete')
-            ]
+DELIVERY_OPTIONS = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Указать адрес вручную 📝", callback_data='enter address manually')],
+            [InlineKeyboardButton(text="Отправить местоположение 📳", callback_data='send location', request_location=True),
         ],
-    )
-    return keyboard
-
-
-def get_confirm_order():
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Подтвердить заказ ✅", callback_data='confirm order'),
-                InlineKeyboardButton(text="Отменить заказ ❌", callback_data='cancel order')
-            ]
+        [
+            InlineKeyboardButton(text="Отмена ❌", callback_data='cancel_delete')
         ]
-    )
-    return keyboard
+    ],
+)
 
 
+CONFIRM_ORDER = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Подтвердить заказ ✅", callback_data='confirm order'),
+            InlineKeyboardButton(text="Отменить заказ ❌", callback_data='cancel order')
+        ]
+    ]
+)
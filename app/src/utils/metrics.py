@@ -0,0 +1,142 @@
+import bisect
+import os
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from aiohttp import web
+
+from .logger import Logger
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# 0 - не запускать эндпоинт метрик
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 10)
+
+_metrics: List['_Metric'] = []
+_collectors: List[Callable[[], Iterable[str]]] = []
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+def sample(name: str, value: float, **labels) -> str:
+    """
+    Одна строка метрики в текстовом формате Prometheus
+    """
+    return f'{name}{_format_labels(labels)} {value}'
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        yield from self._samples()
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        self._values[self._key(labels)] += amount
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield sample(self.name, value, **dict(zip(self.labelnames, key)))
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # ключ меток -> [счетчики по корзинам..., +Inf], сумма
+        self._counts: Dict[tuple, List[int]] = {}
+        self._sums: Dict[tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def _samples(self) -> Iterable[str]:
+        for key, counts in self._counts.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield sample(f'{self.name}_bucket', cumulative, **labels, le='+Inf' if bound == float('inf') else bound)
+            yield sample(f'{self.name}_sum', self._sums[key], **labels)
+            yield sample(f'{self.name}_count', cumulative, **labels)
+
+
+def register_collector(collector: Callable[[], Iterable[str]]) -> None:
+    """
+    Регистрирует функцию, которая при каждом запросе /metrics отдает готовые строки метрик
+    (для значений, которые удобнее считать в момент сбора, например состояние пула соединений)
+    """
+    _collectors.append(collector)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            Logger.error(f'Ошибка при сборе метрик: {e}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=render_metrics().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    """
+    Запускает небольшой aiohttp сервер с эндпоинтом /metrics в формате Prometheus
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    Logger.info(f'Метрики доступны на http://{host}:{port}/metrics')
+    return runner
+
+
+handler_latency = Histogram('bot_handler_seconds', 'Время обработки апдейта хендлером',
+                            ('router', 'event', 'route'))
+handler_errors = Counter('bot_handler_errors_total', 'Исключения в хендлерах', ('router', 'event', 'route'))
+db_query_latency = Histogram('bot_db_query_seconds', 'Время выполнения SQL запросов', ('engine', 'operation'))
+bot_api_latency = Histogram('bot_api_request_seconds', 'Время запросов к Bot API', ('method',))
@@ -1,40 +1,124 @@
-from typing import Callable, Awaitable, Dict, Any
+import asyncio
+import json
+import os
+import re
+import time
+from collections import defaultdict
+from typing import Callable, Awaitable, Dict, Any, Optional, Set
 
-from aiogram import BaseMiddleware
+from aiogram import BaseMiddleware, Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
 from aiogram.types import Message, CallbackQuery, TelegramObject
-from cachetools import TTLCache
 
-from ..database.requests import is_user_exists, add_user
+from ..database.redis_connection import redis
+from ..database.requests import is_user_exists, register_user
 from .logger import Logger
+from .metrics import handler_latency, handler_errors, bot_api_latency, register_collector, sample, Counter
+from .scheduler import BotAPIScheduler, BOT_API_MAX_RETRIES, bot_api_priority, create_scheduler
 
 class UserMiddleware(BaseMiddleware):
     """
-    Проверяет находиться ли пользователь в базе данных, если нет то добавляет
+    Проверяет находиться ли пользователь в базе данных, если нет то ставит его в очередь на регистрацию.
+    Вешается и на сообщения, и на callback-запросы
     """
 
     async def __call__(
             self,
-            handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
-            event: Message,
+            handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+            event: Message | CallbackQuery,
             data: Dict[str, Any]
     ) -> Any:
-        if not await is_user_exists(event.from_user.id):
-            await add_user(user_id=event.from_user.id, name=event.from_user.full_name,
-                           username=event.from_user.username)
-
-            Logger.info(f'Пользователь {event.from_user.id} успешно зарегистрирован!')
+        if event.from_user and not await is_user_exists(event.from_user.id):
+            if await register_user(user_id=event.from_user.id, name=event.from_user.full_name,
+                                   username=event.from_user.username):
+                Logger.info(f'Пользователь {event.from_user.id} успешно зарегистрирован!')
 
         return await handler(event, data)
 
 
 
+# Лимиты для троттлинга: префикс callback_data (или 'message' для сообщений) -> (емкость корзины, токенов в секунду).
+# Емкость - сколько запросов можно сделать подряд, скорость - как быстро они восстанавливаются
+THROTTLE_LIMITS = {
+    'default': (5, 1),
+    'message': (3, 1),
+    'menu': (5, 1),
+    'category_': (5, 1),
+    'page:': (10, 3),
+    'product_': (10, 2),
+    'delete_product:': (10, 2),
+    'go to pay': (2, 0.2),
+    'confirm order': (2, 0.1),
+}
+# Переопределение из окружения, например THROTTLE_LIMITS='{"page:": [20, 5]}'
+THROTTLE_LIMITS.update({route: tuple(limit) for route, limit in json.loads(os.getenv('THROTTLE_LIMITS', '{}')).items()})
+# Не чаще одного предупреждения "не флудите" на пользователя за это время (мс)
+THROTTLE_WARN_INTERVAL = int(os.getenv('THROTTLE_WARN_INTERVAL', 10_000))
+
+# Токен-бакет целиком внутри Redis, чтобы лимит был общим для всех процессов бота
+_token_bucket_script = redis.register_script("""
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+
+local warn = 0
+if allowed == 0 and redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[3]) then
+    warn = 1
+end
+return {allowed, warn}
+""")
+
+# Решения троттлинга по маршрутам: allowed, throttled, warned
+throttle_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+
+def _collect_throttle_metrics():
+    yield '# HELP bot_throttle_decisions_total Решения троттлинга по маршрутам'
+    yield '# TYPE bot_throttle_decisions_total counter'
+    for route, decisions in throttle_stats.items():
+        for decision, value in decisions.items():
+            yield sample('bot_throttle_decisions_total', value, route=route, decision=decision)
+
+
+register_collector(_collect_throttle_metrics)
+
+
 class ThrottlingMiddleware(BaseMiddleware):
-    """Уменьшает частоту обработки сообщений при спаме
-    Если пользователь флудит /start или inline кнопками,
-    то в течение 1 секунды запросы не обрабатываются"""
-    def __init__(self, time_limit: int=1) -> None:
-        self.limit = TTLCache(maxsize=10_000, ttl=time_limit)
+    """Уменьшает частоту обработки сообщений при спаме.
+    Для каждого пользователя и маршрута (префикса callback_data) в Redis хранится токен-бакет,
+    поэтому лимит работает одинаково при любом количестве процессов бота.
+    Предупреждение о флуде отправляется не чаще раза в THROTTLE_WARN_INTERVAL"""
+    def __init__(self, limits: Dict[str, tuple] = None, warn_interval: int = THROTTLE_WARN_INTERVAL) -> None:
+        self.limits = limits or THROTTLE_LIMITS
+        self.warn_interval = warn_interval
+        # Длинные префиксы проверяем раньше коротких
+        self.prefixes = sorted((route for route in self.limits if route not in ('default', 'message')),
+                               key=len, reverse=True)
 
+    def route(self, event: Message | CallbackQuery) -> str:
+        if isinstance(event, Message):
+            return 'message' if 'message' in self.limits else 'default'
+        for prefix in self.prefixes:
+            if event.data and event.data.startswith(prefix):
+                return prefix
+        return 'default'
 
     async def __call__(
             self,
@@ -42,9 +126,139 @@ class ThrottlingMiddleware(BaseMiddleware):
             event: Message | CallbackQuery,
             data: Dict[str,  Any]
     ) -> Any:
-        if event.from_user.id in self.limit:
+        route = self.route(event)
+        capacity, rate = self.limits[route]
+        try:
+            allowed, warn = await _token_bucket_script(
+                keys=[f'throttle:{route}:{event.from_user.id}', f'throttle_warned:{event.from_user.id}'],
+                args=[capacity, rate, self.warn_interval]
+            )
+        except Exception as e:
+            Logger.error(f'Ошибка троттлинга, пропускаю запрос: {e}')
+            return await handler(event, data)
+
+        if allowed:
+            throttle_stats[route]['allowed'] += 1
+            return await handler(event, data)
+
+        throttle_stats[route]['throttled'] += 1
+        if warn:
+            throttle_stats[route]['warned'] += 1
             await event.answer("Пожалуйста, не флудите!")
-            return
+        elif isinstance(event, CallbackQuery):
+            # Без ответа у пользователя будут крутиться часики на кнопке, пока Telegram не сдастся
+            await event.answer()
+
+
+# Больше разных меток маршрута в метриках не заводится, остальные маршруты идут под меткой 'other':
+# callback_data и текст присылает клиент, и без предела каждое новое значение стало бы отдельной серией
+ROUTE_LABELS_LIMIT = int(os.getenv('ROUTE_LABELS_LIMIT', 200))
+_route_labels: Set[str] = set()
+
+
+def event_route(event: TelegramObject, handler: Any = None) -> str:
+    """
+    Метка маршрута для метрик: имя хендлера, а у безымянных хендлеров - callback_data до первого айди
+    ('change_category_17' -> 'change_category_', 'page:3' -> 'page:'), команда для сообщений ('/start')
+    или тип содержимого. Разных меток не больше ROUTE_LABELS_LIMIT
+    """
+    name = getattr(getattr(handler, 'callback', None), '__name__', '_')
+    if name not in ('_', '<lambda>'):
+        route = name
+    elif isinstance(event, CallbackQuery):
+        route = re.sub(r'[-\d].*$', '', event.data or '') or 'empty'
+    elif isinstance(event, Message):
+        if event.text and event.text.startswith('/'):
+            route = event.text.split()[0].split('@')[0]
         else:
-            self.limit[event.from_user.id] = None
-        return await handler(event, data)
\ No newline at end of file
+            route = event.content_type
+    else:
+        route = type(event).__name__
+
+    if route not in _route_labels:
+        if len(_route_labels) >= ROUTE_LABELS_LIMIT:
+            return 'other'
+        _route_labels.add(route)
+    return route
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    """
+    Замеряет время работы хендлеров роутера, метки - имя роутера, тип события и маршрут
+    """
+
+    def __init__(self, router_name: str) -> None:
+        self.router_name = router_name
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        labels = {'router': self.router_name, 'event': type(event).__name__,
+                  'route': event_route(event, data.get('handler'))}
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(**labels)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, **labels)
+
+
+class BotAPITimingMiddleware(BaseRequestMiddleware):
+    """
+    Замеряет время каждого запроса к Bot API по методам
+    """
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            bot_api_latency.observe(time.perf_counter() - started, method=method.__api_method__)
+
+
+bot_api_retries = Counter('bot_api_retry_after_total', 'Повторы запросов к Bot API после 429 retry_after', ('method',))
+
+
+class BotAPISchedulerMiddleware(BaseRequestMiddleware):
+    """
+    Пропускает исходящие сообщения через планировщик с общим лимитом и лимитами чатов,
+    а при 429 ждет retry_after и повторяет запрос, не роняя хендлер
+    """
+    # Лимиты Telegram считаются по сообщениям: отправка, пересылка и редактирование
+    limited_prefixes = ('send', 'copy', 'forward', 'edit')
+
+    def __init__(self, scheduler: Optional[BotAPIScheduler] = None) -> None:
+        self.scheduler = scheduler or create_scheduler()
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        limited = method.__api_method__.startswith(self.limited_prefixes)
+        chat_id = getattr(method, 'chat_id', None)
+        for attempt in range(BOT_API_MAX_RETRIES + 1):
+            if limited:
+                await self.scheduler.acquire(chat_id, bot_api_priority.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == BOT_API_MAX_RETRIES:
+                    raise e
+                bot_api_retries.inc(method=method.__api_method__)
+                Logger.warning(f'Bot API {method.__api_method__}: 429, повтор через {e.retry_after} с')
+                # Каждый следующий повтор ждет дольше, чем просит Telegram
+                self.scheduler.pause(chat_id, e.retry_after + attempt)
+                if not limited:
+                    await asyncio.sleep(e.retry_after + attempt)
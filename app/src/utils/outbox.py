@@ -0,0 +1,99 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict
+
+from aiogram import Bot
+from dotenv import load_dotenv
+
+from ..database.requests import (claim_outbox_events, complete_outbox_event, retry_outbox_event, get_order,
+                                 set_order_status, subtract_order_from_cart, outbox_ready, OUTBOX_BATCH)
+from .logger import Logger
+from .metrics import Counter
+from .scheduler import BACKGROUND, bot_api_priority
+
+load_dotenv()
+
+# Чат кухни, куда уходят оплаченные заказы (если не задан - заказы только сохраняются)
+KITCHEN_CHAT_ID = os.getenv('KITCHEN_CHAT_ID')
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1))
+
+outbox_events = Counter('bot_outbox_events_total', 'Обработанные события outbox', ('event_type', 'result'))
+
+DELIVERY_NAMES = {'delivery': 'Доставка 🛵', 'pickup': 'Самовывоз 🚶'}
+PAYMENT_NAMES = {'online card': 'Онлайн картой 💳', 'cash to courier': 'Наличными курьеру 💰',
+                 'cash in pizzeria': 'Наличными в пиццерии 💰'}
+
+
+def format_order(order: dict) -> str:
+    lines = '\n'.join(f'🍕 {item["name"]} - {item["quantity"]} шт. x {item["price"]} руб.' for item in order['items'])
+    return (f'<b>Заказ №{order["id"]}</b> (оплачен)\n\n'
+            f'{lines}\n\n'
+            f'💳 Сумма: {order["total"]} руб.\n'
+            f'Способ доставки: {DELIVERY_NAMES.get(order["delivery_method"], "N/A")}\n'
+            f'Способ оплаты: {PAYMENT_NAMES.get(order["payment_method"], "N/A")}\n'
+            f'Адрес: {order["address"] or "N/A"}\n'
+            f'Покупатель: <a href="tg://user?id={order["user_id"]}">{order["user_id"]}</a>')
+
+
+async def handle_order_paid(bot: Bot, payload: dict) -> None:
+    """
+    Оплаченный заказ: вычесть заказанные товары из корзины, отправить заказ на кухню.
+    Шаги привязаны к статусу заказа, поэтому при повторе уже сделанные шаги пропускаются
+    """
+    order = await get_order(payload['order_id'])
+    if order is None:
+        Logger.warning(f'Заказ {payload["order_id"]} из outbox не найден')
+        return
+
+    if order['status'] == 'paid':
+        await subtract_order_from_cart(order['user_id'], order['id'], order['items'])
+        await set_order_status(order['id'], 'confirmed')
+        order['status'] = 'confirmed'
+
+    if order['status'] == 'confirmed':
+        if KITCHEN_CHAT_ID:
+            await bot.send_message(chat_id=KITCHEN_CHAT_ID, text=format_order(order), parse_mode='HTML')
+        else:
+            Logger.warning(f'KITCHEN_CHAT_ID не задан, заказ {order["id"]} не отправлен на кухню')
+        await set_order_status(order['id'], 'sent_to_kitchen')
+
+
+EVENT_HANDLERS: Dict[str, Callable[[Bot, dict], Awaitable[None]]] = {
+    'order_paid': handle_order_paid,
+}
+
+
+async def process_outbox(bot: Bot, batch_size: int = OUTBOX_BATCH) -> int:
+    """
+    Обрабатывает одну пачку событий outbox. Упавшие события откладываются на повтор.
+    Возвращает количество забранных событий
+    """
+    events = await claim_outbox_events(batch_size)
+    for event in events:
+        try:
+            await EVENT_HANDLERS[event['event_type']](bot, event['payload'])
+            await complete_outbox_event(event['id'])
+            outbox_events.inc(event_type=event['event_type'], result='done')
+        except Exception as e:
+            Logger.error(f'Ошибка при обработке события outbox {event["id"]} ({event["event_type"]}): {e}')
+            await retry_outbox_event(event['id'], event['attempts'], repr(e))
+            outbox_events.inc(event_type=event['event_type'], result='retry')
+    return len(events)
+
+
+async def outbox_worker(bot: Bot, interval: float = OUTBOX_POLL_INTERVAL) -> None:
+    """
+    Фоновая задача: разбирает outbox пачками, просыпаясь по таймеру или сразу после новой оплаты
+    """
+    bot_api_priority.set(BACKGROUND)
+    while True:
+        outbox_ready.clear()
+        try:
+            while await process_outbox(bot) == OUTBOX_BATCH:
+                pass
+        except Exception:
+            pass  # уже залогировано, события останутся в outbox и будут забраны снова
+        try:
+            await asyncio.wait_for(outbox_ready.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,41 @@
+from typing import Any, Awaitable, Callable, Union
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputFile, Message
+
+from ..database.requests import get_photo_file_id, set_photo_file_id, delete_photo_file_id
+from .logger import Logger
+from .storage import storage
+
+# Ответы Telegram, означающие, что сам file_id больше не годится (а не ошибку в остальном запросе)
+STALE_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'invalid file',
+                        'file_id', 'http url content', 'wrong type of the web page content')
+
+
+def is_stale_file_id(error: TelegramBadRequest) -> bool:
+    message = error.message.lower()
+    return any(marker in message for marker in STALE_FILE_ID_ERRORS)
+
+
+async def send_cached_photo(photo_path: str,
+                            send: Callable[[Union[str, InputFile]], Awaitable[Any]]) -> Any:
+    """
+    Отправляет фотографию по сохраненному file_id, а если его нет или Telegram его отклонил -
+    загружает файл из хранилища и запоминает полученный file_id.
+    send - корутина, которая принимает file_id или файл и делает сам запрос к Telegram
+    """
+    file_id = await get_photo_file_id(photo_path)
+    if file_id:
+        try:
+            return await send(file_id)
+        except TelegramBadRequest as e:
+            # Ошибки подписи, клавиатуры или чата повторная загрузка не исправит
+            if not is_stale_file_id(e):
+                raise e
+            Logger.warning(f'Telegram отклонил file_id для {photo_path}, загружаю файл заново: {e}')
+            await delete_photo_file_id(photo_path)
+
+    result = await send(await storage.input_file(photo_path))
+    if isinstance(result, Message) and result.photo:
+        await set_photo_file_id(photo_path, result.photo[-1].file_id)
+    return result
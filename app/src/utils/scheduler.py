@@ -0,0 +1,202 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional, Union
+
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+from .metrics import Histogram, register_collector, sample
+
+load_dotenv()
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота, 1 в секунду в личный чат и 20 в минуту в группу.
+# Короткие всплески в чат Telegram прощает, поэтому у ведер чатов есть небольшой запас
+BOT_API_GLOBAL_RATE = float(os.getenv('BOT_API_GLOBAL_RATE', 30))
+BOT_API_GLOBAL_BURST = int(os.getenv('BOT_API_GLOBAL_BURST', 30))
+BOT_API_PRIVATE_RATE = float(os.getenv('BOT_API_PRIVATE_RATE', 1))
+BOT_API_PRIVATE_BURST = int(os.getenv('BOT_API_PRIVATE_BURST', 3))
+BOT_API_GROUP_RATE = float(os.getenv('BOT_API_GROUP_RATE', 20 / 60))
+BOT_API_GROUP_BURST = int(os.getenv('BOT_API_GROUP_BURST', 5))
+# Сколько раз повторять запрос после 429 retry_after, прежде чем отдать ошибку вызывающему
+BOT_API_MAX_RETRIES = int(os.getenv('BOT_API_MAX_RETRIES', 3))
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Приоритет исходящих запросов текущей задачи: ответы на апдейты - interactive,
+# фоновые задачи (рассылки, outbox) переключаются на background
+bot_api_priority: ContextVar[str] = ContextVar('bot_api_priority', default=INTERACTIVE)
+
+queue_wait = Histogram('bot_api_queue_wait_seconds', 'Ожидание запроса к Bot API в очереди планировщика',
+                       ('priority',))
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """
+        Через сколько секунд в ведре будет токен (0 - уже есть)
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class _Waiter:
+    __slots__ = ('chat', 'future', 'queued')
+
+    def __init__(self, chat: Optional[str], future: asyncio.Future) -> None:
+        self.chat = chat
+        self.future = future
+        self.queued = time.monotonic()
+
+
+class BotAPIScheduler:
+    """
+    Очередь исходящих запросов к Bot API процесса. Запрос получает разрешение, когда есть токен
+    в общем ведре и в ведре его чата. Интерактивные запросы обслуживаются раньше фоновых,
+    а запрос в чат, упершийся в свой лимит, не задерживает запросы в другие чаты
+    """
+
+    def __init__(self, global_rate: float = BOT_API_GLOBAL_RATE, global_burst: int = BOT_API_GLOBAL_BURST) -> None:
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        # Ведро простаивающего чата все равно полное, поэтому его можно забыть
+        self.chat_buckets: Dict[str, TokenBucket] = TTLCache(maxsize=100_000, ttl=120)
+        # Паузы чатов после retry_after хранятся отдельно от ведер: TTLCache может вытеснить ведро
+        # раньше, чем пауза кончится. Истекшие паузы удаляются при проверке и при новой паузе
+        self.chat_pauses: Dict[str, float] = {}
+        self.queues: Dict[str, Deque[_Waiter]] = {INTERACTIVE: deque(), BACKGROUND: deque()}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _chat_bucket(self, chat: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat)
+        if bucket is None:
+            if chat.startswith(('-', '@')):
+                bucket = TokenBucket(BOT_API_GROUP_RATE, BOT_API_GROUP_BURST)
+            else:
+                bucket = TokenBucket(BOT_API_PRIVATE_RATE, BOT_API_PRIVATE_BURST)
+        # Обращение продлевает жизнь ведра в TTLCache
+        self.chat_buckets[chat] = bucket
+        return bucket
+
+    async def acquire(self, chat_id: Union[int, str, None], priority: str = INTERACTIVE) -> None:
+        """
+        Ждет своей очереди на отправку запроса в чат chat_id (None - запрос без чата)
+        """
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        waiter = _Waiter(None if chat_id is None else str(chat_id), asyncio.get_running_loop().create_future())
+        self.queues[priority].append(waiter)
+        self._wakeup.set()
+        try:
+            await waiter.future
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+            queue_wait.observe(time.monotonic() - waiter.queued, priority=priority)
+
+    def pause(self, chat_id: Union[int, str, None], seconds: float) -> None:
+        """
+        Telegram ответил retry_after: останавливает отправку в чат (или всю отправку, если чата нет)
+        """
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            now = time.monotonic()
+            for chat in [chat for chat, until in self.chat_pauses.items() if until <= now]:
+                del self.chat_pauses[chat]
+            chat = str(chat_id)
+            self.chat_pauses[chat] = max(self.chat_pauses.get(chat, 0.0), now + seconds)
+            self._chat_bucket(chat).tokens = 0.0
+        self._wakeup.set()
+
+    def _chat_delay(self, chat: str, now: float) -> float:
+        paused_until = self.chat_pauses.get(chat)
+        if paused_until is not None:
+            if now < paused_until:
+                return paused_until - now
+            del self.chat_pauses[chat]
+        return self._chat_bucket(chat).delay(now)
+
+    def _grant(self, now: float) -> float:
+        """
+        Пропускает первый готовый запрос в порядке приоритета. Возвращает 0, если запрос пропущен,
+        иначе сколько секунд ждать до готовности ближайшего
+        """
+        nearest = float('inf')
+        for queue in self.queues.values():
+            for waiter in list(queue):
+                if waiter.future.done():
+                    queue.remove(waiter)
+                    continue
+                delay = self._chat_delay(waiter.chat, now) if waiter.chat is not None else 0.0
+                if delay <= 0:
+                    if waiter.chat is not None:
+                        self._chat_bucket(waiter.chat).take()
+                    self.global_bucket.take()
+                    queue.remove(waiter)
+                    waiter.future.set_result(None)
+                    return 0.0
+                nearest = min(nearest, delay)
+        return nearest
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            if any(self.queues.values()):
+                wait = self.global_bucket.delay(time.monotonic())
+                if wait <= 0:
+                    wait = self._grant(time.monotonic())
+                    if wait <= 0:
+                        continue
+                if wait != float('inf'):
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+            await self._wakeup.wait()
+
+    def depth(self) -> Dict[str, int]:
+        return {priority: len(queue) for priority, queue in self.queues.items()}
+
+
+_schedulers = []
+
+
+def create_scheduler(global_rate: float = BOT_API_GLOBAL_RATE) -> BotAPIScheduler:
+    scheduler = BotAPIScheduler(global_rate, min(BOT_API_GLOBAL_BURST, max(int(global_rate), 1)))
+    _schedulers.append(scheduler)
+    return scheduler
+
+
+def _collect_scheduler_metrics():
+    yield '# HELP bot_api_queue_depth Запросы к Bot API, ожидающие в очереди планировщика'
+    yield '# TYPE bot_api_queue_depth gauge'
+    for priority in (INTERACTIVE, BACKGROUND):
+        yield sample('bot_api_queue_depth', sum(s.depth()[priority] for s in _schedulers), priority=priority)
+
+
+register_collector(_collect_scheduler_metrics)
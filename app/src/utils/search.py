@@ -0,0 +1,181 @@
+import asyncio
+import os
+import re
+import time
+from collections import Counter, defaultdict
+from itertools import chain
+from typing import Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from ..database.requests import get_catalog_version, get_categories, get_products
+from .logger import Logger
+from .metrics import Histogram
+
+load_dotenv()
+
+# Сколько товаров максимум отдается на один inline-запрос (больше 50 Telegram не принимает)
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', 50))
+# Сколько секунд Telegram может отдавать сохраненную выдачу на повторный такой же запрос
+SEARCH_CACHE_TIME = int(os.getenv('SEARCH_CACHE_TIME', 300))
+# Доля триграмм запроса, которая должна найтись в товаре, чтобы он попал в выдачу
+SEARCH_MIN_SCORE = float(os.getenv('SEARCH_MIN_SCORE', 0.5))
+# Совпадение в названии весит больше, чем в описании
+NAME_WEIGHT = 2
+DESCRIPTION_WEIGHT = 1
+
+search_latency = Histogram('bot_search_seconds', 'Время поиска по индексу товаров',
+                           buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+
+_word_re = re.compile(r'\w+')
+
+
+def _words(text: str) -> List[str]:
+    return _word_re.findall(text.lower().replace('ё', 'е'))
+
+
+def _trigrams(text: str, partial_last: bool = False) -> Set[str]:
+    """
+    Триграммы слов текста. Слово дополняется пробелами слева, поэтому начала слов дают
+    собственные триграммы и короткий запрос работает как поиск по префиксу.
+    partial_last - последнее слово еще набирается, его конец не фиксируется пробелом
+    """
+    words = _words(text)
+    trigrams = set()
+    for index, word in enumerate(words):
+        padded = f'  {word}' if partial_last and index == len(words) - 1 else f'  {word} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+class ProductIndex:
+    """
+    Триграммный индекс товаров в памяти процесса. Строится из кеша каталога и обновляется
+    по товарам: при изменении версии каталога перечитываются списки товаров категорий (из кеша),
+    и в индекс добавляются только новые и измененные товары, а пропавшие удаляются
+    """
+
+    def __init__(self) -> None:
+        self.products: Dict[int, dict] = {}
+        # триграмма -> айди товаров, у которых она есть в названии (в описании - только если ее нет в названии)
+        self.name_postings: Dict[str, Set[int]] = defaultdict(set)
+        self.description_postings: Dict[str, Set[int]] = defaultdict(set)
+        self.version: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _product_trigrams(product: dict) -> tuple:
+        name = _trigrams(product['name'])
+        return name, _trigrams(product['description'] or '') - name
+
+    def add(self, product: dict) -> None:
+        if product['id'] in self.products:
+            self.remove(product['id'])
+        self.products[product['id']] = product
+        name, description = self._product_trigrams(product)
+        for trigram in name:
+            self.name_postings[trigram].add(product['id'])
+        for trigram in description:
+            self.description_postings[trigram].add(product['id'])
+
+    def remove(self, product_id: int) -> None:
+        product = self.products.pop(product_id, None)
+        if product is None:
+            return
+        for trigrams, postings in zip(self._product_trigrams(product),
+                                      (self.name_postings, self.description_postings)):
+            for trigram in trigrams:
+                postings[trigram].discard(product_id)
+                if not postings[trigram]:
+                    del postings[trigram]
+
+    def _weight(self, product_id: int, trigram: str) -> int:
+        if product_id in self.name_postings.get(trigram, ()):
+            return NAME_WEIGHT
+        if product_id in self.description_postings.get(trigram, ()):
+            return DESCRIPTION_WEIGHT
+        return 0
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> List[dict]:
+        """
+        Товары, похожие на запрос, от лучших к худшим. Пустой запрос - весь каталог по порядку.
+        Совпадения по редким триграммам считаются сразу для всех товаров (Counter в C), а триграммы,
+        которые есть у большей части каталога (например, "пицца"), проверяются только у кандидатов
+        """
+        started = time.perf_counter()
+        trigrams = _trigrams(query, partial_last=not query.endswith(' '))
+        if not trigrams:
+            result = [self.products[product_id] for product_id in sorted(self.products)[:limit]]
+            search_latency.observe(time.perf_counter() - started)
+            return result
+
+        common_size = len(self.products) // 2
+        rare, common = [], []
+        for trigram in trigrams:
+            size = len(self.name_postings.get(trigram, ())) + len(self.description_postings.get(trigram, ()))
+            if size:
+                (common if size > common_size else rare).append(trigram)
+        names = [self.name_postings[trigram] for trigram in rare if trigram in self.name_postings]
+        scores = Counter(chain(*names, *names,
+                               *(self.description_postings[trigram] for trigram in rare
+                                 if trigram in self.description_postings)))
+
+        threshold = SEARCH_MIN_SCORE * len(trigrams) * DESCRIPTION_WEIGHT
+        common_max = NAME_WEIGHT * len(common)
+        # Кандидаты по убыванию совпадений редких триграмм, за ними - товары без них
+        candidates = chain(scores.most_common(),
+                           ((product_id, 0) for product_id in self.products if product_id not in scores)
+                           if common else ())
+        result = []
+        for product_id, score in candidates:
+            if score + common_max < threshold:
+                break
+            if score + sum(self._weight(product_id, trigram) for trigram in common) >= threshold:
+                result.append(self.products[product_id])
+                if len(result) == limit:
+                    break
+        search_latency.observe(time.perf_counter() - started)
+        return result
+
+    async def sync(self) -> None:
+        """
+        Приводит индекс к текущей версии каталога. Списки товаров берутся из кеша get_products,
+        в памяти процесса лежат и неизмененные категории, поэтому обновление почти бесплатно
+        """
+        version = await get_catalog_version()
+        if version == self.version:
+            return
+        async with self._lock:
+            if version == self.version:
+                return
+            current = {}
+            for category in await get_categories():
+                for product in await get_products(category['id']):
+                    current[product['id']] = product
+            added = removed = 0
+            for product_id in set(self.products) - set(current):
+                self.remove(product_id)
+                removed += 1
+            for product_id, product in current.items():
+                if self.products.get(product_id) != product:
+                    self.add(product)
+                    added += 1
+            self.version = version
+            if added or removed:
+                Logger.info(f'Индекс поиска обновлен до версии каталога {version}: '
+                            f'+{added}, -{removed}, всего {len(self.products)}')
+
+
+product_index = ProductIndex()
+
+
+async def search_products(query: str, limit: int = SEARCH_LIMIT) -> List[dict]:
+    """
+    Ищет товары по названию и описанию в индексе процесса, предварительно догоняя каталог
+    """
+    try:
+        await product_index.sync()
+    except Exception as e:
+        # Поиск по чуть устаревшему индексу лучше, чем пустая выдача
+        Logger.error(f'Ошибка при обновлении индекса поиска: {e}')
+    return product_index.search(query, limit)
@@ -0,0 +1,301 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import re
+import uuid
+import xml.etree.ElementTree as ElementTree
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import AsyncIterator, Iterable, Optional, Tuple
+from urllib.parse import quote
+
+import aiofiles
+import aiofiles.os
+import aiohttp
+from aiogram.types import BufferedInputFile, FSInputFile, InputFile
+from dotenv import load_dotenv
+from yarl import URL
+
+from .logger import Logger
+
+load_dotenv()
+
+# local - файлы на диске, s3 - S3-совместимое хранилище (например MinIO), общее для нескольких контейнеров
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+STORAGE_ROOT = os.getenv('STORAGE_ROOT', '.')
+STORAGE_PREFIX = os.getenv('IMAGES_FOLDER', 'images')
+STORAGE_SPOOL = os.getenv('STORAGE_SPOOL', os.path.join(STORAGE_ROOT, STORAGE_PREFIX, '.spool'))
+CHUNK_SIZE = int(os.getenv('STORAGE_CHUNK_SIZE', 64 * 1024))
+
+S3_ENDPOINT = os.getenv('S3_ENDPOINT', 'http://localhost:9000')
+S3_BUCKET = os.getenv('S3_BUCKET', 'pizza-bot')
+S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY', '')
+S3_SECRET_KEY = os.getenv('S3_SECRET_KEY', '')
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+def content_key(digest: str, extension: str) -> str:
+    """
+    Ключ файла по хэшу содержимого: одинаковые файлы получают один и тот же ключ
+    """
+    return f'{STORAGE_PREFIX}/{digest[:2]}/{digest}.{extension.lstrip(".")}'
+
+
+_content_key_re = re.compile(rf'^{re.escape(STORAGE_PREFIX)}/([0-9a-f]{{2}})/\1[0-9a-f]{{62}}\.\w+$')
+
+
+def is_content_key(key: str) -> bool:
+    """
+    Ключ выдан content_key: файлы с другими ключами (загруженные до хранилища, положенные вручную)
+    хранилище не создавало и сборщику мусора не принадлежат
+    """
+    return _content_key_re.match(key) is not None
+
+
+async def _single_chunk(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+class Storage(ABC):
+    """
+    Хранилище фотографий с адресацией по содержимому. Ключ файла - путь вида images/ab/abcdef....jpg,
+    он же хранится в Product.photo_path, поэтому ключи, сохраненные до появления хранилища
+    (images/{file_unique_id}.jpg), остаются рабочими.
+
+    Поток данных сначала пишется во временный файл (с подсчетом хэша по ходу записи),
+    а затем переносится в хранилище под ключом из хэша, так что одинаковые фотографии хранятся один раз.
+    Файлы удаляет только сборщик мусора (requests.collect_garbage), когда на них не осталось ссылок
+    """
+
+    async def save_stream(self, chunks: AsyncIterator[bytes], extension: str) -> str:
+        os.makedirs(STORAGE_SPOOL, exist_ok=True)
+        spool_path = os.path.join(STORAGE_SPOOL, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        try:
+            async with aiofiles.open(spool_path, 'wb') as f:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    await f.write(chunk)
+            key = content_key(digest.hexdigest(), extension)
+            await self._commit(spool_path, key, digest.hexdigest())
+            return key
+        except Exception as e:
+            Logger.error(f'Ошибка при сохранении файла в хранилище: {e}')
+            raise e
+        finally:
+            if await aiofiles.os.path.exists(spool_path):
+                await aiofiles.os.remove(spool_path)
+
+    async def save(self, data: bytes, extension: str) -> str:
+        return await self.save_stream(_single_chunk(data), extension)
+
+    def local_path(self, key: str) -> Optional[str]:
+        """
+        Путь к файлу на диске, если хранилище локальное
+        """
+        return None
+
+    async def input_file(self, key: str) -> InputFile:
+        """
+        Файл для отправки в Telegram
+        """
+        return BufferedInputFile(await self.read(key), filename=os.path.basename(key))
+
+    @abstractmethod
+    async def _commit(self, spool_path: str, key: str, digest: str) -> None:
+        """
+        Переносит временный файл в хранилище под ключом key
+        """
+        ...
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def read(self, key: str) -> bytes:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def keys(self) -> AsyncIterator[Tuple[str, float]]:
+        """
+        Все ключи хранилища с временем последнего изменения (unix time)
+        """
+        ...
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: str = STORAGE_ROOT) -> None:
+        self.root = root
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    async def input_file(self, key: str) -> InputFile:
+        return FSInputFile(self.local_path(key))
+
+    async def _commit(self, spool_path: str, key: str, digest: str) -> None:
+        # Замена атомарна и обновляет время изменения, поэтому уже существующий файл-сирота
+        # не будет удален сборщиком мусора сразу после повторной загрузки
+        path = self.local_path(key)
+        await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+        await aiofiles.os.replace(spool_path, path)
+
+    async def exists(self, key: str) -> bool:
+        return await aiofiles.os.path.exists(self.local_path(key))
+
+    async def read(self, key: str) -> bytes:
+        async with aiofiles.open(self.local_path(key), 'rb') as f:
+            return await f.read()
+
+    async def delete(self, key: str) -> None:
+        try:
+            await aiofiles.os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    async def keys(self) -> AsyncIterator[Tuple[str, float]]:
+        def scan() -> list:
+            found = []
+            for directory, subdirectories, files in os.walk(os.path.join(self.root, STORAGE_PREFIX)):
+                subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+                for name in files:
+                    path = os.path.join(directory, name)
+                    found.append((os.path.relpath(path, self.root).replace(os.sep, '/'), os.path.getmtime(path)))
+            return found
+
+        for item in await asyncio.to_thread(scan):
+            yield item
+
+
+class S3Storage(Storage):
+    """
+    Минимальный клиент S3 API (подпись AWS Signature V4, path-style адреса) поверх aiohttp.
+    Подходит для MinIO и других S3-совместимых хранилищ, когда бот запущен в нескольких контейнерах
+    """
+
+    def __init__(self, endpoint: str = S3_ENDPOINT, bucket: str = S3_BUCKET, access_key: str = S3_ACCESS_KEY,
+                 secret_key: str = S3_SECRET_KEY, region: str = S3_REGION) -> None:
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self) -> None:
+        if self._session:
+            await self._session.close()
+
+    @staticmethod
+    def _canonical_query(query: dict) -> str:
+        return '&'.join(f'{quote(k, safe="-_.~")}={quote(str(v), safe="-_.~")}' for k, v in sorted(query.items()))
+
+    def _signed_headers(self, method: str, path: str, query: dict, payload_hash: str) -> dict:
+        canonical_query = self._canonical_query(query)
+        now = datetime.now(timezone.utc)
+        amz_date, date = now.strftime('%Y%m%dT%H%M%SZ'), now.strftime('%Y%m%d')
+        headers = {'host': URL(self.endpoint).raw_authority, 'x-amz-content-sha256': payload_hash,
+                   'x-amz-date': amz_date}
+        signed = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method, path, canonical_query,
+            ''.join(f'{name}:{headers[name]}\n' for name in sorted(headers)), signed, payload_hash
+        ])
+        scope = f'{date}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+        signing_key = f'AWS4{self.secret_key}'.encode()
+        for part in (date, self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        headers['authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={signed}, Signature={signature}')
+        del headers['host']
+        return headers
+
+    async def _request(self, method: str, key: str = '', query: Optional[dict] = None, data=None,
+                       payload_hash: str = EMPTY_SHA256, expected: Iterable[int] = (200,)) -> Tuple[int, bytes]:
+        query = query or {}
+        path = quote(f'/{self.bucket}/{key}' if key else f'/{self.bucket}', safe='/-_.~')
+        headers = self._signed_headers(method, path, query, payload_hash)
+        url = URL(f'{self.endpoint}{path}' + (f'?{self._canonical_query(query)}' if query else ''), encoded=True)
+        session = await self._get_session()
+        async with session.request(method, url, headers=headers, data=data) as response:
+            body = await response.read()
+            if response.status not in expected:
+                raise RuntimeError(f'S3 {method} {key}: {response.status} {body[:200]!r}')
+            return response.status, body
+
+    async def _commit(self, spool_path: str, key: str, digest: str) -> None:
+        if await self.exists(key):
+            return
+
+        async def body() -> AsyncIterator[bytes]:
+            async with aiofiles.open(spool_path, 'rb') as f:
+                while chunk := await f.read(CHUNK_SIZE):
+                    yield chunk
+
+        size = (await aiofiles.os.stat(spool_path)).st_size
+        session = await self._get_session()
+        path = quote(f'/{self.bucket}/{key}', safe='/-_.~')
+        headers = {**self._signed_headers('PUT', path, {}, digest), 'content-length': str(size)}
+        async with session.put(URL(f'{self.endpoint}{path}', encoded=True), headers=headers, data=body()) as response:
+            if response.status != 200:
+                raise RuntimeError(f'S3 PUT {key}: {response.status} {(await response.read())[:200]!r}')
+
+    async def exists(self, key: str) -> bool:
+        status, _ = await self._request('HEAD', key, expected=(200, 404))
+        return status == 200
+
+    async def read(self, key: str) -> bytes:
+        return (await self._request('GET', key))[1]
+
+    async def delete(self, key: str) -> None:
+        await self._request('DELETE', key, expected=(200, 204))
+
+    async def keys(self) -> AsyncIterator[Tuple[str, float]]:
+        namespace = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+        query = {'list-type': '2', 'prefix': f'{STORAGE_PREFIX}/'}
+        while True:
+            _, body = await self._request('GET', query=query)
+            root = ElementTree.fromstring(body)
+            for item in root.findall('s3:Contents', namespace):
+                modified = item.findtext('s3:LastModified', namespaces=namespace).replace('Z', '+00:00')
+                yield item.findtext('s3:Key', namespaces=namespace), datetime.fromisoformat(modified).timestamp()
+            token = root.findtext('s3:NextContinuationToken', namespaces=namespace)
+            if not token:
+                break
+            query['continuation-token'] = token
+
+
+def create_storage() -> Storage:
+    if STORAGE_BACKEND == 's3':
+        return S3Storage()
+    return LocalStorage()
+
+
+storage = create_storage()
+
+
+async def stream_telegram_file(bot, file_path: str) -> AsyncIterator[bytes]:
+    """
+    Читает файл с серверов Telegram по частям, не загружая его целиком в память
+    """
+    url = bot.session.api.file_url(bot.token, file_path)
+    async for chunk in bot.session.stream_content(url=url, chunk_size=CHUNK_SIZE, raise_for_status=True):
+        yield chunk
@@ -0,0 +1,82 @@
+import os
+import time
+from typing import Dict
+
+from dotenv import load_dotenv
+from redis.exceptions import LockError
+
+from ..database.redis_connection import redis
+from ..database.requests import load_known_users, warm_catalog_cache, warm_photo_cache
+from .logger import Logger
+from .metrics import register_collector, sample
+from .search import product_index
+
+load_dotenv()
+
+# wait - бот начинает принимать апдейты только после прогрева, background - прогрев идет параллельно,
+# off - кеши заполняются при обращениях
+CACHE_WARMUP = os.getenv('CACHE_WARMUP', 'wait')
+# Redis прогревает один процесс из всех (воркеры вебхука, воркеры потоков), остальные ждут его
+# не дольше WARMUP_TIMEOUT секунд и прогревают только свою память
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 60))
+WARMUP_LOCK_KEY = 'cache_warmup_lock'
+# Прогрев Redis, сделанный меньше WARMUP_FRESH секунд назад, не повторяется
+WARMUP_DONE_KEY = 'cache_warmup_done'
+WARMUP_FRESH = int(os.getenv('WARMUP_FRESH', 60))
+
+# Длительность этапов последнего прогрева, секунды
+_timings: Dict[str, float] = {}
+
+
+def _collect_warmup_metrics():
+    yield '# HELP bot_cache_warmup_seconds Длительность этапов прогрева кеша при запуске'
+    yield '# TYPE bot_cache_warmup_seconds gauge'
+    for stage, seconds in _timings.items():
+        yield sample('bot_cache_warmup_seconds', seconds, stage=stage)
+
+
+register_collector(_collect_warmup_metrics)
+
+
+async def _warm_redis(counts: Dict[str, int]) -> None:
+    for stage, warm in (('known_users', load_known_users), ('catalog', warm_catalog_cache),
+                        ('photos', warm_photo_cache)):
+        started = time.perf_counter()
+        counts[stage] = await warm()
+        _timings[stage] = time.perf_counter() - started
+
+
+async def warm_up_caches() -> Dict[str, float]:
+    """
+    Прогревает кеши после запуска: известных пользователей, каталог и file_id фотографий в Redis,
+    затем кеш каталога и индекс поиска в памяти процесса. Возвращает длительность этапов
+    """
+    started = time.perf_counter()
+    counts = {}
+    try:
+        lock = redis.lock(WARMUP_LOCK_KEY, timeout=WARMUP_TIMEOUT, blocking_timeout=WARMUP_TIMEOUT)
+        acquired = await lock.acquire()
+        try:
+            if not await redis.exists(WARMUP_DONE_KEY):
+                await _warm_redis(counts)
+                await redis.set(WARMUP_DONE_KEY, 1, ex=WARMUP_FRESH)
+        finally:
+            if acquired:
+                try:
+                    await lock.release()
+                except LockError:
+                    pass  # прогрев шел дольше WARMUP_TIMEOUT, блокировка уже истекла
+
+        local_started = time.perf_counter()
+        await product_index.sync()
+        _timings['local'] = time.perf_counter() - local_started
+        _timings['total'] = time.perf_counter() - started
+        Logger.info(f'Прогрев кеша за {_timings["total"]:.2f} с: '
+                    + ', '.join(f'{stage} {seconds:.2f} с' for stage, seconds in _timings.items() if stage != 'total')
+                    + (f' (пользователей {counts["known_users"]}, товаров {counts["catalog"]}, '
+                       f'фотографий {counts["photos"]})' if counts else ' (Redis уже прогрет другим процессом)'))
+        return dict(_timings)
+    except Exception as e:
+        # Без прогрева бот работает, просто первые запросы медленнее
+        Logger.error(f'Ошибка при прогреве кеша: {e}')
+        return dict(_timings)
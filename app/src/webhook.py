@@ -0,0 +1,66 @@
+import asyncio
+import os
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from dotenv import load_dotenv
+
+from .utils.logger import Logger
+
+load_dotenv()
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1))
+
+
+def build_webhook_app(bot: Bot, dp: Dispatcher, secret_token: Optional[str] = WEBHOOK_SECRET) -> web.Application:
+    """
+    Создает aiohttp приложение, которое принимает обновления от Telegram.
+    Ответ 200 отдается сразу, а сам апдейт обрабатывается в фоне
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret_token,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def set_webhook(bot: Bot) -> None:
+    """
+    Регистрирует адрес вебхука в Telegram (вызывается один раз, а не в каждом воркере)
+    """
+    if not WEBHOOK_BASE_URL:
+        raise ValueError('Для режима вебхука необходимо указать WEBHOOK_BASE_URL')
+
+    await bot.set_webhook(
+        url=f'{WEBHOOK_BASE_URL.rstrip("/")}{WEBHOOK_PATH}',
+        secret_token=WEBHOOK_SECRET,
+        drop_pending_updates=True
+    )
+
+
+async def serve_webhook(bot: Bot, dp: Dispatcher, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                        reuse_port: bool = WEBHOOK_WORKERS > 1) -> None:
+    """
+    Запускает сервер вебхука и ждет его остановки.
+    reuse_port позволяет нескольким процессам слушать один и тот же порт
+    """
+    runner = web.AppRunner(build_webhook_app(bot, dp))
+    await runner.setup()
+    site = web.TCPSite(runner, host=host, port=port, reuse_port=reuse_port)
+    await site.start()
+    Logger.info(f'Вебхук слушает http://{host}:{port}{WEBHOOK_PATH} (pid {os.getpid()})')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,57 @@
+"""
+Общие настройки тестов: временная SQLite база через aiosqlite и fakeredis вместо Redis.
+Окружение настраивается до импорта src, потому что движок БД и клиент Redis создаются при импорте модулей.
+Реплика - отдельный движок на тот же файл, поэтому по session.bind видно, куда ушел запрос.
+
+Запуск из папки app (нужен fakeredis с Lua: pip install "fakeredis[lua]"):
+    python -m pytest -q
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+_db_path = os.path.join(tempfile.mkdtemp(prefix='bot-tests-'), 'test.sqlite')
+os.environ['DB_URL'] = f'sqlite+aiosqlite:///{_db_path}'
+os.environ['DB_REPLICA_URL'] = f'sqlite+aiosqlite:///{_db_path}'
+os.environ['DB_ECHO'] = 'false'
+
+import src.database.redis_connection as redis_connection  # noqa: E402
+
+redis_connection.redis = fakeredis.FakeAsyncRedis()
+
+# Движки и fakeredis привязаны к циклу событий, поэтому все тесты работают в одном цикле
+_loop = asyncio.new_event_loop()
+
+
+@pytest.fixture
+def run():
+    return _loop.run_until_complete
+
+
+@pytest.fixture(autouse=True)
+def clean_state(run):
+    """
+    Пустые БД (схема через миграции), Redis и кеши процесса перед каждым тестом
+    """
+    from src.database import cache, engine, requests
+
+    async def reset() -> None:
+        async with engine.engine.begin() as connection:
+            await connection.run_sync(engine.Base.metadata.drop_all)
+            await connection.exec_driver_sql('DROP TABLE IF EXISTS alembic_version')
+        await engine.upgrade_db()
+        await redis_connection.redis.flushall()
+
+    run(reset())
+    cache._local.clear()
+    requests._known_users.clear()
+    engine._written_locally.clear()
+    yield
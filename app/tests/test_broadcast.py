@@ -0,0 +1,19 @@
+import asyncio
+
+from src.database.redis_connection import redis
+from src.utils.broadcast import _keep_lock
+
+
+def test_lock_outlives_timeout_while_kept(run):
+    async def scenario():
+        lock = redis.lock('broadcast:1:lock', timeout=0.3)
+        assert await lock.acquire(blocking=False)
+        keeper = asyncio.create_task(_keep_lock(lock, 0.1))
+        # Пачка идет вдвое дольше времени жизни блокировки
+        await asyncio.sleep(0.6)
+        owned = await lock.owned()
+        keeper.cancel()
+        await asyncio.sleep(0.4)
+        return owned, await lock.owned()
+
+    assert run(scenario()) == (True, False)
@@ -0,0 +1,35 @@
+from cachetools import TTLCache
+
+from src.database import cache
+from src.database.cache import cached, local_get
+
+
+def test_local_cache_is_bounded(run, monkeypatch):
+    monkeypatch.setattr(cache, '_local', TTLCache(maxsize=3, ttl=60))
+    loads = []
+
+    @cached('test_search:{query}', local=True)
+    async def search(query: str):
+        loads.append(query)
+        return [query] if query != 'missing' else None
+
+    for query in ('a', 'b', 'c', 'd', 'missing'):
+        run(search(query))
+    assert len(cache._local) == 3
+    assert local_get('test_search:missing') == (True, None)
+    assert local_get('test_search:a') == (False, None)
+
+    # Вытесненный ключ читается из Redis, а не из БД
+    assert run(search('a')) == ['a']
+    assert loads == ['a', 'b', 'c', 'd', 'missing']
+
+
+def test_invalidation_evicts_local_copy(run):
+    @cached('test_product:{product_id}', local=True)
+    async def product(product_id: int):
+        return {'id': product_id}
+
+    run(product(1))
+    assert local_get('test_product:1') == (True, {'id': 1})
+    run(product.invalidate(1))
+    assert local_get('test_product:1') == (False, None)
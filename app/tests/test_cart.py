@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from sqlalchemy import event, select
+
+from src.database import engine
+from src.database.engine import session_maker
+from src.database.models import Cart
+from src.database.redis_connection import redis
+from src.database.requests import (CARTS_DEAD_KEY, DIRTY_CARTS_KEY, add_product_to_cart, add_user, create_categorie,
+                                   create_product, flush_carts, get_cart_product, get_categorie_id,
+                                   increment_cart_item, subtract_order_from_cart)
+
+PARALLEL_ADDS = 200
+
+
+def _add(run, user_id: int, product_id: int, quantity: int) -> None:
+    for _ in range(quantity):
+        run(add_product_to_cart(user_id, product_id))
+
+
+async def _cart_rows(user_id: int) -> list:
+    async with session_maker() as session:
+        return (await session.execute(select(Cart.product_id, Cart.quantity).where(Cart.user_id == user_id))).all()
+
+
+async def _product() -> int:
+    await create_categorie('Пиццы')
+    return await create_product('Маргарита', 'Сыр', 500, await get_categorie_id('Пиццы'),
+                                'images/AQADrfExG64QOUp9.jpg')
+
+
+def test_parallel_upserts_leave_one_row(run):
+    async def add_concurrently():
+        product_id = await _product()
+        await asyncio.gather(*(increment_cart_item(1, product_id) for _ in range(PARALLEL_ADDS)))
+        return product_id
+
+    product_id = run(add_concurrently())
+    assert run(_cart_rows(1)) == [(product_id, PARALLEL_ADDS)]
+
+
+def test_parallel_adds_through_redis_leave_one_row(run):
+    async def add_concurrently():
+        product_id = await _product()
+        await asyncio.gather(*(add_product_to_cart(1, product_id) for _ in range(PARALLEL_ADDS)))
+        return product_id
+
+    product_id = run(add_concurrently())
+    assert run(get_cart_product(1)) == [{'product_id': product_id, 'quantity': PARALLEL_ADDS}]
+    assert run(flush_carts()) == 1
+    assert run(_cart_rows(1)) == [(product_id, PARALLEL_ADDS)]
+
+
+@pytest.fixture
+def foreign_keys(run):
+    """
+    SQLite проверяет внешние ключи, как PostgreSQL
+    """
+    def enable(connection, record):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+    event.listen(engine.engine.sync_engine, 'connect', enable)
+    run(engine.engine.dispose())
+    yield
+    event.remove(engine.engine.sync_engine, 'connect', enable)
+    run(engine.engine.dispose())
+
+
+def test_rejected_cart_does_not_block_batch(run, foreign_keys):
+    product_id = run(_product())
+    run(add_user(1, 'a', 'alice'))
+    # Корзина пользователя, строки которого нет в users: БД отвергнет ее по внешнему ключу
+    for user_id in (1, 2):
+        run(add_product_to_cart(user_id, product_id))
+
+    assert run(flush_carts()) == 2
+    assert run(_cart_rows(1)) == [(product_id, 1)]
+    assert run(_cart_rows(2)) == []
+    assert run(redis.smembers(CARTS_DEAD_KEY)) == {b'2'}
+    assert run(redis.scard(DIRTY_CARTS_KEY)) == 0
+
+
+def test_paid_order_subtracts_ordered_quantities_once(run):
+    # В счет попали две пиццы 1 и одна 2, а после выставления счета пользователь добавил еще пиццу 1 и 3
+    _add(run, 1, 1, 3)
+    _add(run, 1, 2, 1)
+    _add(run, 1, 3, 1)
+    items = [{'product_id': 1, 'quantity': 2}, {'product_id': 2, 'quantity': 1}]
+
+    assert run(subtract_order_from_cart(1, 10, items)) is True
+    expected = [{'product_id': 1, 'quantity': 1}, {'product_id': 3, 'quantity': 1}]
+    assert sorted(run(get_cart_product(1)), key=lambda item: item['product_id']) == expected
+
+    # Повтор события outbox после сбоя не вычитает заказ второй раз
+    assert run(subtract_order_from_cart(1, 10, items)) is False
+    assert sorted(run(get_cart_product(1)), key=lambda item: item['product_id']) == expected
+
+
+def test_subtracting_more_than_in_cart_removes_the_item(run):
+    _add(run, 1, 1, 1)
+    run(flush_carts())
+
+    run(subtract_order_from_cart(1, 11, [{'product_id': 1, 'quantity': 2}, {'product_id': 5, 'quantity': 1}]))
+    assert run(get_cart_product(1)) == []
+    assert run(redis.hkeys('cart:1')) == [b'_loaded']
+    assert run(flush_carts()) == 1
@@ -0,0 +1,43 @@
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+from src.utils import middlewares
+from src.utils.middlewares import event_route
+
+_user = User(id=42, is_bot=False, first_name='A')
+
+
+def _callback(data: str) -> CallbackQuery:
+    return CallbackQuery(id='1', from_user=_user, chat_instance='1', data=data)
+
+
+def _message(text: str) -> Message:
+    return Message(message_id=1, date=0, chat=Chat(id=42, type='private'), from_user=_user, text=text)
+
+
+async def _(event):
+    pass
+
+
+async def process_address(event):
+    pass
+
+
+def test_route_label_has_no_ids(monkeypatch):
+    monkeypatch.setattr(middlewares, '_route_labels', set())
+    anonymous = HandlerObject(callback=_)
+    assert event_route(_callback('change_category_17'), anonymous) == 'change_category_'
+    assert event_route(_callback('delete_product:42'), anonymous) == 'delete_product:'
+    assert event_route(_callback('page:-1'), anonymous) == 'page:'
+    assert event_route(_callback('confirm order'), anonymous) == 'confirm order'
+    assert event_route(_message('/start 123'), anonymous) == '/start'
+    # Именованный хендлер дает метку по имени, какой бы текст ни прислал пользователь
+    assert event_route(_message('ул. Ленина, 5'), HandlerObject(callback=process_address)) == 'process_address'
+
+
+def test_route_labels_are_capped(monkeypatch):
+    monkeypatch.setattr(middlewares, '_route_labels', set())
+    monkeypatch.setattr(middlewares, 'ROUTE_LABELS_LIMIT', 3)
+    routes = {event_route(_message(f'/command{index}')) for index in range(10)}
+    assert routes == {'/command0', '/command1', '/command2', 'other'}
+    assert event_route(_message('/command1')) == '/command1'
@@ -0,0 +1,153 @@
+import socket
+import time
+
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
+from sqlalchemy.exc import IntegrityError
+
+from loadtest.fake_api import FakeBotAPI
+from src.database.requests import (add_product_to_cart, create_categorie, create_paid_order, create_product,
+                                   delete_product_from_cart, get_cart_product, get_categorie_id, get_order)
+from src.handlers.user import user
+from src.utils.outbox import handle_order_paid
+
+USER_ID = 1001
+
+
+class _RecordingAPI(FakeBotAPI):
+    """
+    Замена Bot API, которая запоминает параметры вызовов
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.requests = []
+
+    async def respond(self, method, params):
+        self.requests.append((method, params))
+        return await super().respond(method, params)
+
+    def last(self, method: str) -> dict:
+        return [params for name, params in self.requests if name == method][-1]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+_dp = Dispatcher(storage=MemoryStorage())
+_dp.include_router(user)
+
+
+@pytest.fixture
+def api(run):
+    api = _RecordingAPI(port=_free_port())
+    run(api.start())
+    yield api
+    run(api.stop())
+
+
+@pytest.fixture
+def bot(run, api):
+    bot = Bot('42:TEST', session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+    yield bot
+    run(bot.session.close())
+
+
+_from = {'id': USER_ID, 'is_bot': False, 'first_name': 'user'}
+_chat = {'id': USER_ID, 'type': 'private'}
+
+
+def _feed(run, bot: Bot, update_id: int, **event) -> None:
+    run(_dp.feed_update(bot, Update.model_validate({'update_id': update_id, **event}, context={'bot': bot})))
+
+
+def _confirm(run, bot: Bot) -> None:
+    _feed(run, bot, 1, callback_query={
+        'id': '1', 'from': _from, 'chat_instance': '1', 'data': 'confirm order',
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': _chat, 'text': 'order'}})
+
+
+def _pre_checkout(run, bot: Bot, payload: str, amount: int) -> None:
+    _feed(run, bot, 2, pre_checkout_query={'id': '2', 'from': _from, 'currency': 'RUB', 'total_amount': amount,
+                                           'invoice_payload': payload})
+
+
+def _pay(run, bot: Bot, payload: str, amount: int) -> None:
+    _feed(run, bot, 3, message={
+        'message_id': 2, 'date': int(time.time()), 'chat': _chat, 'from': _from,
+        'successful_payment': {'currency': 'RUB', 'total_amount': amount, 'invoice_payload': payload,
+                               'telegram_payment_charge_id': 'tg-1', 'provider_payment_charge_id': 'provider-1'}})
+
+
+def _products(run) -> tuple:
+    run(create_categorie('Пиццы'))
+    category_id = run(get_categorie_id('Пиццы'))
+    return (run(create_product('Маргарита', 'Сыр', 500, category_id, 'images/AQADrfExG64QOUp9.jpg')),
+            run(create_product('Пепперони', 'Колбаса', 700, category_id, 'images/AQADrfExG64QOUp9.jpg')))
+
+
+def test_order_is_built_from_invoice_snapshot(run, api, bot):
+    margherita, pepperoni = _products(run)
+    run(add_product_to_cart(USER_ID, margherita))
+    run(add_product_to_cart(USER_ID, margherita))
+
+    _confirm(run, bot)
+    invoice = api.last('sendInvoice')
+    assert '"amount": 100000' in invoice['prices']
+
+    # Пока счет не оплачен, пользователь меняет корзину
+    run(delete_product_from_cart(USER_ID, margherita))
+    run(add_product_to_cart(USER_ID, pepperoni))
+
+    _pre_checkout(run, bot, invoice['payload'], 100000)
+    assert api.last('answerPreCheckoutQuery')['ok'] == 'true'
+    _pay(run, bot, invoice['payload'], 100000)
+
+    order = run(get_order(1))
+    assert order['total'] == 1000
+    assert order['items'] == [{'product_id': margherita, 'name': 'Маргарита', 'price': 500, 'quantity': 2}]
+
+    # Outbox вычитает из корзины только оплаченное, добавленная после счета пицца остается
+    run(handle_order_paid(bot, {'order_id': order['id']}))
+    assert run(get_cart_product(USER_ID)) == [{'product_id': pepperoni, 'quantity': 1}]
+
+
+def test_payment_not_matching_invoice_creates_no_order(run, api, bot):
+    margherita, _ = _products(run)
+    run(add_product_to_cart(USER_ID, margherita))
+    _confirm(run, bot)
+    payload = api.last('sendInvoice')['payload']
+
+    _pre_checkout(run, bot, payload, 40000)
+    assert api.last('answerPreCheckoutQuery')['ok'] == 'false'
+    _pay(run, bot, payload, 40000)
+    assert run(get_order(1)) is None
+
+
+def test_empty_cart_gets_no_invoice(run, api, bot):
+    _confirm(run, bot)
+    assert 'sendInvoice' not in api.calls
+    assert api.last('answerCallbackQuery')['show_alert'] == 'true'
+
+
+_payment = {'telegram_payment_charge_id': 'tg-1', 'provider_payment_charge_id': 'provider-1', 'currency': 'RUB',
+            'total_amount': 50000, 'invoice_payload': 'order_1'}
+_items = [{'product_id': 1, 'name': 'Маргарита', 'price': 500, 'quantity': 1}]
+
+
+def test_repeated_payment_returns_existing_order(run):
+    order_id = run(create_paid_order(USER_ID, _items, dict(_payment)))
+    assert run(create_paid_order(USER_ID, _items, dict(_payment))) == order_id
+
+
+def test_other_integrity_errors_are_raised(run):
+    with pytest.raises(IntegrityError):
+        run(create_paid_order(USER_ID, [{**_items[0], 'name': None}], dict(_payment)))
+    assert run(get_order(1)) is None
@@ -0,0 +1,40 @@
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendPhoto
+from aiogram.types import InputFile
+
+from src.database.requests import get_photo_file_id, set_photo_file_id
+from src.utils.photos import send_cached_photo
+
+PHOTO_PATH = 'images/AQADrfExG64QOUp9.jpg'
+
+
+def _sender(error_message: str):
+    sent = []
+
+    async def send(photo):
+        sent.append(photo)
+        if isinstance(photo, str):
+            raise TelegramBadRequest(SendPhoto(chat_id=1, photo=photo), error_message)
+        return 'uploaded'
+
+    return send, sent
+
+
+def test_rejected_file_id_falls_back_to_upload(run):
+    run(set_photo_file_id(PHOTO_PATH, 'stale'))
+    send, sent = _sender('Bad Request: wrong file identifier/HTTP URL specified')
+
+    assert run(send_cached_photo(PHOTO_PATH, send)) == 'uploaded'
+    assert sent[0] == 'stale' and isinstance(sent[1], InputFile)
+    assert run(get_photo_file_id(PHOTO_PATH)) is None
+
+
+def test_other_bad_request_is_raised(run):
+    run(set_photo_file_id(PHOTO_PATH, 'valid'))
+    send, sent = _sender("Bad Request: can't parse entities: unsupported start tag")
+
+    with pytest.raises(TelegramBadRequest):
+        run(send_cached_photo(PHOTO_PATH, send))
+    assert sent == ['valid']
+    assert run(get_photo_file_id(PHOTO_PATH)) == 'valid'
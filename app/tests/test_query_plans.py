@@ -0,0 +1,41 @@
+import pytest
+
+from benchmarks.data_access import seed
+from benchmarks.query_plans import FULL_SCAN_ALLOWED, _plan_scans, hot_queries, seed_rest, seed_users
+from src.database.engine import engine
+
+
+async def _plans() -> dict:
+    await seed_users(200)
+    await seed(10, 50, 200, 3)
+    await seed_rest(200, 500, 500)
+    plans = {}
+    async with engine.connect() as connection:
+        await connection.exec_driver_sql('ANALYZE')
+        for name, statement in hot_queries().items():
+            sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+            plans[name] = [row[-1] for row in
+                           (await connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)).fetchall()]
+    return plans
+
+
+@pytest.fixture
+def plans(run):
+    return run(_plans())
+
+
+@pytest.mark.parametrize('name, index', [
+    ('delete_product: FK carts.product_id', 'ix_carts_product_id'),
+    ('get_products (products.category_id)', 'ix_products_category_id'),
+    ('delete_categorie: FK products.category_id', 'ix_products_category_id'),
+])
+def test_hot_query_uses_index(plans, name, index):
+    assert any(f'USING INDEX {index}' in row or f'USING COVERING INDEX {index}' in row for row in plans[name]), \
+        plans[name]
+
+
+def test_hot_queries_avoid_full_scans(plans):
+    scans = {name: [table for table in _plan_scans('sqlite', [(row,) for row in plan])
+                    if table not in FULL_SCAN_ALLOWED]
+             for name, plan in plans.items()}
+    assert not {name: tables for name, tables in scans.items() if tables}
@@ -0,0 +1,63 @@
+import asyncio
+
+from sqlalchemy import select
+
+from src.database.engine import session_maker
+from src.database.models import User
+from src.database.redis_connection import redis
+from src.database import requests
+from src.database.requests import (REGISTRATION_DEAD_KEY, REGISTRATION_QUEUE_KEY, add_user, flush_registrations,
+                                   register_user)
+
+
+async def _usernames() -> dict:
+    async with session_maker() as session:
+        return dict((await session.execute(select(User.telegram_id, User.username))).all())
+
+
+def test_user_without_username_does_not_block_queue(run):
+    run(register_user(1, 'a', None))
+    run(register_user(2, 'b', 'bob'))
+
+    assert run(flush_registrations()) == 2
+    assert run(_usernames()) == {1: '', 2: 'bob'}
+    assert run(redis.llen(REGISTRATION_QUEUE_KEY)) == 0
+
+
+def test_rejected_row_goes_to_dead_letter_list(run):
+    run(register_user(1, 'a', 'alice'))
+    # Запись из очереди, которую БД не примет (например, поставленная старой версией бота)
+    run(redis.rpush(REGISTRATION_QUEUE_KEY, '{"telegram_id": 2, "name": "b", "username": null, "phone": null}'))
+    run(register_user(3, 'c', 'carol'))
+
+    assert run(flush_registrations()) == 3
+    assert run(_usernames()) == {1: 'alice', 3: 'carol'}
+    assert run(redis.llen(REGISTRATION_QUEUE_KEY)) == 0
+    assert run(redis.llen(REGISTRATION_DEAD_KEY)) == 1
+
+
+def test_concurrent_registration_of_same_user(run):
+    async def register_concurrently():
+        return await asyncio.gather(*(register_user(1, 'a', 'alice') for _ in range(20)))
+
+    assert sorted(run(register_concurrently())) == [False] * 19 + [True]
+    # Другой процесс с пустой памятью тоже не ставит пользователя в очередь второй раз
+    requests._known_users.clear()
+    assert run(register_user(1, 'a', 'alice')) is False
+
+    assert run(flush_registrations()) == 1
+    assert run(_usernames()) == {1: 'alice'}
+
+
+def test_duplicate_queue_entries_insert_one_row(run):
+    run(register_user(1, 'a', 'alice'))
+    # Та же запись, поставленная повторно (например, после возврата пачки в очередь)
+    run(redis.rpush(REGISTRATION_QUEUE_KEY, run(redis.lindex(REGISTRATION_QUEUE_KEY, 0))))
+    async def add_concurrently():
+        await asyncio.gather(add_user(1, 'a', 'alice'), add_user(1, 'a', 'alice'))
+
+    run(add_concurrently())
+
+    run(flush_registrations())
+    assert run(_usernames()) == {1: 'alice'}
+    assert run(redis.llen(REGISTRATION_DEAD_KEY)) == 0
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from src.database import engine
+from src.database.engine import read_session, write_session
+
+
+@pytest.fixture(autouse=True)
+def short_sticky_window(monkeypatch):
+    monkeypatch.setattr(engine, 'DB_STICKY_SECONDS', 0.3)
+
+
+async def _read_engine(*scopes: str):
+    async with read_session(*scopes) as session:
+        return session.bind
+
+
+def test_reads_go_to_replica_without_writes(run):
+    assert engine.replica_engine is not engine.engine
+    assert run(_read_engine('catalog')) is engine.replica_engine
+    assert run(_read_engine()) is engine.replica_engine
+
+
+def test_reads_stick_to_primary_during_and_after_write(run):
+    async def scenario():
+        async with write_session('catalog'):
+            # Здесь сбрасывается кеш: чтение, пришедшее в этот момент, не должно попасть на реплику
+            during = await _read_engine('catalog')
+        return during, await _read_engine('catalog'), await _read_engine('cart:1')
+
+    during, after, other_scope = run(scenario())
+    assert during is engine.engine
+    assert after is engine.engine
+    assert other_scope is engine.replica_engine
+
+
+def test_reads_return_to_replica_after_window(run):
+    async def write():
+        async with write_session('catalog'):
+            pass
+
+    run(write())
+    time.sleep(0.4)
+    assert run(_read_engine('catalog')) is engine.replica_engine
+
+
+def test_sticky_window_is_shared_between_processes(run):
+    async def write():
+        async with write_session('catalog'):
+            pass
+
+    run(write())
+    # Память процесса пуста, как у другого воркера: метка в Redis все равно отправляет в основную БД
+    engine._written_locally.clear()
+    assert run(_read_engine('catalog')) is engine.engine
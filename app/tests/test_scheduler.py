@@ -0,0 +1,33 @@
+import time
+
+from src.utils.scheduler import BotAPIScheduler
+
+
+def test_chat_pause_survives_bucket_eviction(run):
+    async def scenario():
+        scheduler = BotAPIScheduler()
+        scheduler.pause(1, 0.3)
+        # Ведро вытеснено из TTLCache (истек ttl или кончилось место), пауза должна остаться
+        scheduler.chat_buckets.clear()
+        started = time.monotonic()
+        await scheduler.acquire(1)
+        waited = time.monotonic() - started
+        await scheduler.acquire(2)
+        scheduler._dispatcher.cancel()
+        return waited, scheduler.chat_pauses
+
+    waited, pauses = run(scenario())
+    assert waited >= 0.25
+    assert pauses == {}
+
+
+def test_other_chats_are_not_paused(run):
+    async def scenario():
+        scheduler = BotAPIScheduler()
+        scheduler.pause(1, 5)
+        started = time.monotonic()
+        await scheduler.acquire(2)
+        scheduler._dispatcher.cancel()
+        return time.monotonic() - started
+
+    assert run(scenario()) < 0.1
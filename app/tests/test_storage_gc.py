@@ -0,0 +1,30 @@
+import hashlib
+import os
+
+from src.database.requests import collect_garbage
+from src.utils.storage import STORAGE_PREFIX, content_key, storage
+
+
+def _write(root, key: str, age: float = 3600) -> None:
+    path = os.path.join(root, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'data')
+    modified = os.path.getmtime(path) - age
+    os.utime(path, (modified, modified))
+
+
+def test_gc_removes_only_content_addressed_orphans(run, monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, 'root', str(tmp_path))
+    orphan = content_key(hashlib.sha256(b'orphan').hexdigest(), 'jpg')
+    fresh = content_key(hashlib.sha256(b'fresh').hexdigest(), 'jpg')
+    legacy = f'{STORAGE_PREFIX}/AQADrfExG64QOUp9.jpg'
+    manual = f'{STORAGE_PREFIX}/banners/menu.png'
+    for key in (orphan, legacy, manual):
+        _write(tmp_path, key)
+    _write(tmp_path, fresh, age=0)
+
+    assert run(collect_garbage(grace=60)) == [orphan]
+    assert not os.path.exists(tmp_path / orphan)
+    for key in (fresh, legacy, manual):
+        assert os.path.exists(tmp_path / key)
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+from aiogram import Bot
+
+from src.database.redis_connection import redis
+from src import streams
+from src.streams import STREAM_GROUP, _ensure_group, _process
+
+STREAM = 'updates:test'
+
+
+def _update(update_id: int, user_id: int) -> dict:
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': str(update_id),
+                        'chat': {'id': user_id, 'type': 'private'},
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'}}}
+
+
+class _Dispatcher:
+    """
+    Записывает начало и конец обработки апдейтов, первый апдейт пользователя 1 обрабатывается медленно
+    """
+
+    def __init__(self) -> None:
+        self.events = []
+
+    async def feed_update(self, bot, update) -> None:
+        self.events.append(('start', update.update_id))
+        await asyncio.sleep(0.3 if update.update_id == 1 else 0.01)
+        self.events.append(('end', update.update_id))
+
+
+async def _run_partition(dp, updates) -> None:
+    await _ensure_group(STREAM)
+    for update_id, user_id in updates:
+        await redis.xadd(STREAM, {'update': json.dumps(_update(update_id, user_id))})
+    entries = (await redis.xreadgroup(STREAM_GROUP, 'worker-0', {STREAM: '>'}))[0][1]
+    queue, in_flight = asyncio.Queue(), set()
+    for entry in entries:
+        in_flight.add((STREAM, entry[0]))
+        queue.put_nowait(entry)
+    processor = asyncio.create_task(_process(Bot('42:TEST'), dp, STREAM, queue, in_flight))
+    await asyncio.wait_for(queue.join(), 5)
+    processor.cancel()
+
+
+class _SlowDispatcher(_Dispatcher):
+    async def feed_update(self, bot, update) -> None:
+        self.events.append(('start', update.update_id))
+        await asyncio.sleep(0.05)
+        self.events.append(('end', update.update_id))
+
+
+def test_burst_from_one_user_does_not_take_all_slots(run, monkeypatch):
+    monkeypatch.setattr(streams, 'STREAM_CONCURRENCY', 2)
+    dp = _SlowDispatcher()
+    # Десять апдейтов пользователя 1 подряд, за ними один апдейт пользователя 2
+    run(_run_partition(dp, [(update_id, 1) for update_id in range(1, 11)] + [(11, 2)]))
+
+    # Пользователь 2 обрабатывается рядом с первым апдейтом пользователя 1, а не после всего всплеска
+    assert dp.events.index(('end', 11)) < dp.events.index(('end', 2))
+    user_events = [update_id for stage, update_id in dp.events if stage == 'start' and update_id != 11]
+    assert user_events == list(range(1, 11))
+
+
+def test_users_of_one_partition_are_processed_concurrently_in_order(run):
+    async def scenario():
+        await _ensure_group(STREAM)
+        for update_id, user_id in ((1, 1), (2, 1), (3, 2), (4, 2)):
+            await redis.xadd(STREAM, {'update': json.dumps(_update(update_id, user_id))})
+        entries = (await redis.xreadgroup(STREAM_GROUP, 'worker-0', {STREAM: '>'}))[0][1]
+
+        dp, queue, in_flight = _Dispatcher(), asyncio.Queue(), set()
+        for entry in entries:
+            in_flight.add((STREAM, entry[0]))
+            queue.put_nowait(entry)
+        processor = asyncio.create_task(_process(Bot('42:TEST'), dp, STREAM, queue, in_flight))
+        await asyncio.wait_for(queue.join(), 2)
+        processor.cancel()
+        pending = await redis.xpending(STREAM, STREAM_GROUP)
+        return dp.events, in_flight, pending['pending']
+
+    events, in_flight, pending = run(scenario())
+    # Пользователь 2 не ждет медленный апдейт пользователя 1
+    assert events.index(('end', 4)) < events.index(('end', 1))
+    # Апдейты одного пользователя не обгоняют друг друга
+    assert events.index(('end', 1)) < events.index(('start', 2))
+    assert events.index(('end', 3)) < events.index(('start', 4))
+    assert not in_flight and pending == 0
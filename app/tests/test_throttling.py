@@ -0,0 +1,36 @@
+from aiogram.types import CallbackQuery, User
+
+from src.utils.middlewares import ThrottlingMiddleware
+
+
+class _Callback(CallbackQuery):
+    """
+    CallbackQuery, который запоминает ответы вместо запроса к Bot API
+    """
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        object.__setattr__(self, 'answers', [])
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def _callback() -> _Callback:
+    return _Callback(id='1', from_user=User(id=42, is_bot=False, first_name='A'), chat_instance='1', data='menu')
+
+
+def test_throttled_callback_is_always_answered(run):
+    middleware = ThrottlingMiddleware(limits={'default': (1, 0.001), 'message': (1, 0.001)})
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+
+    events = [_callback() for _ in range(3)]
+    for event in events:
+        run(middleware(handler, event, {}))
+
+    assert handled == events[:1]
+    # Первый отказ - с предупреждением, следующие - пустой ответ, чтобы кнопка не зависала
+    assert events[1].answers == ['Пожалуйста, не флудите!']
+    assert events[2].answers == [None]